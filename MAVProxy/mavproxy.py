@@ -9,14 +9,12 @@ Released under the GNU GPL version 3 or later
 
 import sys, os, time, socket, signal
 import fnmatch, errno, threading
-import serial, select
+import serial
 import traceback
-import select
 import shlex
 import math
 import platform
 import json
-import struct
 
 from imp import reload
 
@@ -33,6 +31,11 @@ from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import dumpstacks
 from MAVProxy.modules.lib import mp_substitute
 from MAVProxy.modules.lib import multiproc
+from MAVProxy.modules.lib import mp_select
+from MAVProxy.modules.lib import mp_forward
+from MAVProxy.modules.lib import mp_logwriter
+from MAVProxy.modules.lib import mp_tlogindex
+from MAVProxy.modules.lib import mp_profile
 from MAVProxy.modules.mavproxy_link import preferred_ports
 
 # adding all this allows pyinstaller to build a working windows executable
@@ -108,6 +111,8 @@ class MPStatus(object):
                 f.write('%s:%s ' % (c, self.counters[c]))
             f.write('\n')
             f.write('MAV Errors: %u\n' % self.mav_error)
+            if mpstate.logwriter is not None:
+                f.write(mpstate.logwriter.status_string() + '\n')
             f.write(str(self.gps)+'\n')
         for m in sorted(self.msgs.keys()):
             if pattern is not None and not fnmatch.fnmatch(str(m).upper(), pattern.upper()):
@@ -186,6 +191,10 @@ class MPState(object):
               MPSetting('script_fatal', bool, False, 'fatal error on bad script', tab='Debug'),
               MPSetting('compdebug', int, 0, 'Computation Debug Mask', range=(0,3), tab='Debug'),
               MPSetting('flushlogs', bool, False, 'Flush logs on every packet'),
+              MPSetting('log_flush_interval', float, 1.0, 'Log flush interval (s)', range=(0,3600)),
+              MPSetting('log_fsync_interval', float, 0, 'Log fsync interval (s), 0 to disable', range=(0,3600)),
+              MPSetting('log_buffer_kb', int, 4096, 'Log buffer size (KB)', range=(64,1048576)),
+              MPSetting('log_index', bool, False, 'Write a sidecar index for the telemetry log'),
               MPSetting('requireexit', bool, False, 'Require exit command'),
               MPSetting('wpupdates', bool, True, 'Announce waypoint updates'),
               MPSetting('wpterrainadjust', bool, True, 'Adjust alt of moved wp using terrain'),
@@ -213,6 +222,7 @@ class MPState(object):
               MPSetting('checkdelay', bool, True, 'check for link delay'),
 
               MPSetting('vehicle_name', str, '', 'Vehicle Name', tab='Vehicle'),
+              MPSetting('param_cache', bool, True, 'Cache parameters by vehicle for fast reconnects'),
 
               MPSetting('sys_status_error_warn_interval', int, 30, 'interval to warn of autopilot software failure'),
 
@@ -224,6 +234,9 @@ class MPState(object):
             "script"         : ["(FILENAME)"],
             "set"            : ["(SETTING)"],
             "status"         : ["(VARIABLE)"],
+            "profile"        : ["<start|stop|status|reset>",
+                                "start <timing|cprofile|sample>",
+                                "dump (FILENAME)"],
             "module"    : ["list",
                            "load (AVAILMODULES)",
                            "<unload|reload> (LOADEDMODULES)"]
@@ -241,12 +254,24 @@ class MPState(object):
         # SITL output
         self.sitl_output = None
 
+        # fan out of packets from masters to outputs
+        self.forwarder = mp_forward.PacketForwarder()
+
+        # main loop timing, see the profile command
+        self.profiler = mp_profile.HotPathProfiler()
+
         self.mav_param_by_sysid = {}
         self.mav_param_by_sysid[(self.settings.target_system,self.settings.target_component)] = mavparm.MAVParmDict()
         self.modules = []
         self.public_modules = {}
         self.functions = MAVFunctions()
-        self.select_extra = {}
+        # registry of file descriptors for the main loop
+        self.select_registry = mp_select.SelectRegistry()
+        self.select_extra = mp_select.SelectExtra(self.select_registry)
+        # writing to an output can reconnect it or drop its client
+        self.forwarder.on_reconnect = self.output_reconnected
+        # bumped when modules load, unload or change subscriptions
+        self.dispatch_generation = 0
         self.continue_mode = False
         self.aliases = {}
         import platform
@@ -256,6 +281,7 @@ class MPState(object):
         self.is_sitl = False
         self.start_time_s = time.time()
         self.attitude_time_s = 0
+        self.logwriter = None
 
     @property
     def mav_param(self):
@@ -274,6 +300,10 @@ class MPState(object):
             return self.public_modules[name]
         return None
 
+    def output_reconnected(self, conn):
+        '''re-register an output whose socket changed on a write'''
+        self.select_registry.update_connection(conn, 'output')
+
     def master(self):
         '''return the currently chosen mavlink master object'''
         if len(self.mav_master) == 0:
@@ -347,6 +377,52 @@ def cmd_status(args):
         for pattern in args:
             mpstate.status.show(sys.stdout, pattern=pattern, verbose=verbose)
 
+def cmd_profile(args):
+    '''main loop profiling'''
+    usage = "usage: profile <start [timing|cprofile|sample]|stop|status|dump [FILENAME]|reset>"
+    profiler = mpstate.profiler
+    if len(args) < 1:
+        print(usage)
+        return
+    if args[0] == "start":
+        mode = None
+        if len(args) > 1 and args[1] != 'timing':
+            mode = args[1]
+            if not mode in ['cprofile', 'sample']:
+                print(usage)
+                return
+        profiler.start(mode)
+        print("Profiling started")
+    elif args[0] == "stop":
+        profiler.stop()
+        print("Profiling stopped")
+    elif args[0] == "status":
+        print(profiler.report())
+    elif args[0] == "dump":
+        if len(args) > 1:
+            filename = args[1]
+        else:
+            if profiler.cprofile is not None:
+                ext = 'prof'
+            elif profiler.sampler is not None:
+                ext = 'folded'
+            else:
+                ext = 'txt'
+            filename = os.path.join(mpstate.status.logdir or '.', 'mavproxy-profile.%s' % ext)
+        try:
+            kind = profiler.dump(filename)
+        except Exception as ex:
+            print("Failed to write %s: %s" % (filename, ex))
+            return
+        print("Wrote %s to %s" % (kind, filename))
+    elif args[0] == "reset":
+        if profiler.enabled:
+            profiler.stop()
+        profiler.reset()
+        profiler.clear_profilers()
+    else:
+        print(usage)
+
 def cmd_setup(args):
     mpstate.status.setup_mode = True
     mpstate.rl.set_prompt("")
@@ -354,7 +430,9 @@ def cmd_setup(args):
 
 def cmd_reset(args):
     print("Resetting master")
-    mpstate.master().reset()
+    master = mpstate.master()
+    master.reset()
+    mpstate.select_registry.update_connection(master, 'master')
 
 def cmd_click(args):
     '''synthesise click at lat/lon; no arguments is "unclick"'''
@@ -407,6 +485,7 @@ def load_module(modname, quiet=False, **kwargs):
             module = m.init(mpstate, **kwargs)
             if isinstance(module, mp_module.MPModule):
                 mpstate.modules.append((module, m))
+                mpstate.dispatch_generation += 1
                 if not quiet:
                     if kwargs:
                         print("Loaded module %s with kwargs = %s" % (modname, kwargs))
@@ -438,8 +517,10 @@ def unload_module(modname):
                 if t.isAlive():
                     print("unload on module %s did not complete" % m.name)
                     mpstate.modules.remove((m,pm))
+                    mpstate.dispatch_generation += 1
                     return False
             mpstate.modules.remove((m,pm))
+            mpstate.dispatch_generation += 1
             if modname in mpstate.public_modules:
                 del mpstate.public_modules[modname]
             print("Unloaded module %s" % modname)
@@ -573,6 +654,7 @@ command_map = {
     'reset'   : (cmd_reset,    'reopen the connection to the MAVLink master'),
     'click'   : (cmd_click,    'set click location'),
     'status'  : (cmd_status,   'show status'),
+    'profile' : (cmd_profile,  'main loop profiling'),
     'set'     : (cmd_set,      'mavproxy settings'),
     'watch'   : (cmd_watch,    'watch a MAVLink pattern'),
     'module'  : (cmd_module,   'module commands'),
@@ -678,7 +760,7 @@ def process_master(m):
         return
 
     if mpstate.logqueue_raw:
-        mpstate.logqueue_raw.put(bytearray(s))
+        mpstate.logqueue_raw.put(s)
 
     if mpstate.status.setup_mode:
         if mpstate.system == 'Windows':
@@ -694,7 +776,13 @@ def process_master(m):
     global mavversion
     if m.first_byte and mavversion is None:
         m.auto_mavlink_version(s)
-    msgs = m.mav.parse_buffer(s)
+    # forwarded packets are queued during the parse and written
+    # to each output in one batch
+    mpstate.forwarder.begin()
+    try:
+        msgs = m.mav.parse_buffer(s)
+    finally:
+        mpstate.forwarder.end()
     if msgs:
         for msg in msgs:
             sysid = msg.get_srcSystem()
@@ -732,7 +820,7 @@ def process_mavlink(slave):
             mpstate.master().write(mbuf)
             if mpstate.logqueue:
                 usec = int(time.time() * 1.0e6)
-                mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+                mpstate.logqueue.put_packet(usec, mbuf)
             if mpstate.status.watch:
                 for msg_type in mpstate.status.watch:
                     if fnmatch.fnmatch(m.get_type().upper(), msg_type.upper()):
@@ -753,19 +841,6 @@ def mkdir_p(dir):
     mkdir_p(os.path.dirname(dir))
     os.mkdir(dir)
 
-def log_writer():
-    '''log writing thread'''
-    while True:
-        mpstate.logfile_raw.write(bytearray(mpstate.logqueue_raw.get()))
-        timeout = time.time() + 10
-        while not mpstate.logqueue_raw.empty() and time.time() < timeout:
-            mpstate.logfile_raw.write(mpstate.logqueue_raw.get())
-        while not mpstate.logqueue.empty() and time.time() < timeout:
-            mpstate.logfile.write(mpstate.logqueue.get())
-        if mpstate.settings.flushlogs or time.time() >= timeout:
-            mpstate.logfile.flush()
-            mpstate.logfile_raw.flush()
-
 # If state_basedir is NOT set then paths for logs and aircraft
 # directories are relative to mavproxy's cwd
 def log_paths():
@@ -833,9 +908,20 @@ def open_telemetry_logs(logpath_telem, logpath_telem_raw):
         # use a separate thread for writing to the logfile to prevent
         # delays during disk writes (important as delays can be long if camera
         # app is running)
-        t = threading.Thread(target=log_writer, name='log_writer')
-        t.daemon = True
-        t.start()
+        mpstate.logwriter.resize(mpstate.settings.log_buffer_kb * 1024)
+        indexfile = None
+        indexer = None
+        if mpstate.settings.log_index:
+            indexpath = mp_tlogindex.index_filename(logpath_telem)
+            if mode == 'ab' and os.path.exists(indexpath) and os.path.getsize(indexpath) > 0:
+                indexfile = open(indexpath, mode='ab')
+            else:
+                indexfile = open(indexpath, mode='wb')
+                indexfile.write(mp_tlogindex.INDEX_MAGIC)
+            indexer = mp_tlogindex.TlogIndexer()
+            print("Telemetry log index: %s" % indexpath)
+        mpstate.logwriter.start(mpstate.logfile, mpstate.logfile_raw,
+                                indexfile=indexfile, indexer=indexer)
     except Exception as e:
         print("ERROR: opening log file for writing: %s" % e)
         mpstate.status.exit = True
@@ -870,6 +956,8 @@ def check_link_status():
         if not master.linkerror and (tnow > master.last_message + 5 or master.portdead):
             say("link %s down" % (mp_module.MPModule.link_label(master)))
             master.linkerror = True
+        # catch ports that have gone dead or been reopened by a write
+        mpstate.select_registry.update_connection(master, 'master')
 
 def send_heartbeat(master):
     if master.mavlink10():
@@ -902,10 +990,17 @@ def periodic_tasks():
     set_stream_rates()
 
     # call optional module idle tasks. These are called at several hundred Hz
+    profiler = mpstate.profiler
+    timing = profiler.enabled
     for (m,pm) in mpstate.modules:
         if hasattr(m, 'idle_task'):
             try:
-                m.idle_task()
+                if timing:
+                    t0 = mp_profile.clock()
+                    m.idle_task()
+                    profiler.idle_time(m.name, mp_profile.clock() - t0)
+                else:
+                    m.idle_task()
             except Exception as msg:
                 if mpstate.settings.moddebug == 1:
                     print(msg)
@@ -964,65 +1059,53 @@ def main_loop():
 
         periodic_tasks()
 
-        rin = []
-        for master in mpstate.mav_master:
-            if master.fd is not None and not master.portdead:
-                rin.append(master.fd)
-        for m in mpstate.mav_outputs:
-            rin.append(m.fd)
-        for sysid in mpstate.sysid_outputs:
-            m = mpstate.sysid_outputs[sysid]
-            rin.append(m.fd)
-        if rin == []:
+        # connections are registered once, and the registry checks a
+        # connection for a new socket after reading from it
+        if len(mpstate.select_registry) == 0:
             time.sleep(0.0001)
             continue
 
-        for fd in mpstate.select_extra:
-            rin.append(fd)
-        try:
-            (rin, win, xin) = select.select(rin, [], [], mpstate.settings.select_timeout)
-        except select.error:
-            continue
+        if mpstate.profiler.enabled:
+            mpstate.profiler.loop()
+            t0 = mp_profile.clock()
+            ready = mpstate.select_registry.select(mpstate.settings.select_timeout)
+            mpstate.profiler.select_time(mp_profile.clock() - t0)
+        else:
+            ready = mpstate.select_registry.select(mpstate.settings.select_timeout)
 
         if mpstate is None:
             return
 
-        for fd in rin:
-            if mpstate is None:
-                  return
-            for master in mpstate.mav_master:
-                  if fd == master.fd:
-                        process_master(master)
-                        if mpstate is None:
-                              return
-                        continue
-            for m in mpstate.mav_outputs:
-                if fd == m.fd:
-                    process_mavlink(m)
-                    if mpstate is None:
-                          return
-                    continue
-
-            for sysid in mpstate.sysid_outputs:
-                m = mpstate.sysid_outputs[sysid]
-                if fd == m.fd:
-                    process_mavlink(m)
-                    if mpstate is None:
-                          return
-                    continue
-
-            # this allow modules to register their own file descriptors
-            # for the main select loop
-            if fd in mpstate.select_extra:
-                try:
-                    # call the registered read function
-                    (fn, args) = mpstate.select_extra[fd]
-                    fn(args)
-                except Exception as msg:
-                    if mpstate.settings.moddebug == 1:
-                        print(msg)
-                    # on an exception, remove it from the select list
-                    mpstate.select_extra.pop(fd)
+        mpstate.select_registry.dispatch(ready, select_handlers)
+
+def dispatch_master(fd, master):
+    '''read from a master link'''
+    if mpstate is not None:
+        process_master(master)
+
+def dispatch_output(fd, output):
+    '''read from an output'''
+    if mpstate is not None:
+        process_mavlink(output)
+
+def dispatch_extra(fd, obj):
+    '''this allow modules to register their own file descriptors
+    for the main select loop'''
+    if mpstate is None or fd not in mpstate.select_extra:
+        return
+    try:
+        # call the registered read function
+        (fn, args) = mpstate.select_extra[fd]
+        fn(args)
+    except Exception as msg:
+        if mpstate.settings.moddebug == 1:
+            print(msg)
+        # on an exception, remove it from the select list
+        mpstate.select_extra.pop(fd)
+
+select_handlers = { 'master' : dispatch_master,
+                    'output' : dispatch_output,
+                    'extra' : dispatch_extra }
 
 
 
@@ -1189,9 +1272,10 @@ if __name__ == '__main__':
     mpstate.status.exit = False
     mpstate.command_map = command_map
     mpstate.continue_mode = opts.continue_mode
-    # queues for logging
-    mpstate.logqueue = Queue.Queue()
-    mpstate.logqueue_raw = Queue.Queue()
+    # buffers for logging
+    mpstate.logwriter = mp_logwriter.LogWriter(mpstate.settings, mpstate.settings.log_buffer_kb * 1024)
+    mpstate.logqueue = mpstate.logwriter.logqueue
+    mpstate.logqueue_raw = mpstate.logwriter.logqueue_raw
 
 
     if opts.speech:
@@ -1264,7 +1348,9 @@ if __name__ == '__main__':
 
     # open any mavlink output ports
     for port in opts.output:
-        mpstate.mav_outputs.append(mavutil.mavlink_connection(port, baud=int(opts.baudrate), input=False))
+        conn = mavutil.mavlink_connection(port, baud=int(opts.baudrate), input=False)
+        mpstate.mav_outputs.append(conn)
+        mpstate.select_registry.add_connection(conn, 'output')
 
     if opts.sitl:
         mpstate.sitl_output = mavutil.mavudp(opts.sitl, input=False)
@@ -1383,4 +1469,6 @@ if __name__ == '__main__':
             print("Unloading module %s" % m.name)
             m.unload()
 
+    mpstate.logwriter.stop()
+
     sys.exit(1)
@@ -5,14 +5,24 @@
 '''
 
 import ast
+import copy
 import sys, struct, time, os, datetime
 import math, re
 import matplotlib
 from math import *
 from pymavlink.mavextra import *
 import pylab
+import numpy
 from pymavlink import mavutil
 import threading
+from MAVProxy.modules.lib import mp_parallel
+
+try:
+    from MAVProxy.modules.lib import mp_vecexpr
+    from MAVProxy.modules.lib import mp_logcache
+except ImportError:
+    mp_vecexpr = None
+    mp_logcache = None
 
 colors = [ 'red', 'green', 'blue', 'orange', 'olive', 'black', 'grey', 'yellow', 'brown', 'darkcyan',
            'cornflowerblue', 'darkmagenta', 'deeppink', 'darkred']
@@ -41,6 +51,37 @@ edge_colour = (0.1, 0.1, 0.1)
 
 graph_num = 1
 
+class LogSource(object):
+    '''a log file to be opened when it is processed, which may be in a
+    worker process'''
+    def __init__(self, filename, **kwargs):
+        self.filename = filename
+        self.kwargs = kwargs
+
+    def open(self, progress=None):
+        '''open the log, using its column cache if there is one'''
+        if (mp_logcache is not None and
+            not self.kwargs.get('notimestamps', False) and
+            not self.kwargs.get('zero_time_base', False)):
+            columns = mp_logcache.load_cache(self.filename)
+            if columns is not None:
+                return mp_logcache.LogReplay(columns, self.filename)
+        return mavutil.mavlink_connection(self.filename, progress_callback=progress, **self.kwargs)
+
+def process_logsource(index, args):
+    '''process one log in a worker, returning lists of x and y arrays,
+    one for each field. Times are returned as raw timestamps'''
+    (graph, source, flightmode_selections) = args
+    # work on a copy, as without a pool this runs in the parent
+    graph = copy.copy(graph)
+    graph.x = [ [] for f in graph.fields ]
+    graph.y = [ [] for f in graph.fields ]
+    graph.raw_timestamps = True
+    graph.progress = lambda pct: mp_parallel.report_progress(index, 50 + pct//2)
+    mlog = source.open(progress=lambda pct: mp_parallel.report_progress(index, pct//2))
+    graph.process_mav(mlog, flightmode_selections)
+    return ([ numpy.array(x) for x in graph.x ], [ numpy.array(y) for y in graph.y ])
+
 class MavGraph(object):
     def __init__(self, flightmode_colourmap=None):
         self.lowest_x = None
@@ -77,6 +118,14 @@ class MavGraph(object):
         self.tday_base = None
         self.tday_basetime = None
         self.title = None
+        # fields evaluated over log columns rather than per message
+        self.vector_fields = set()
+        # number of processes for multiple logs, 0 for one per CPU
+        self.workers = 1
+        # progress callback, called with a percentage
+        self.progress = None
+        # use timestamps rather than days for the x axis, for workers
+        self.raw_timestamps = False
 
     def add_field(self, field):
         '''add another field to plot'''
@@ -126,6 +175,14 @@ class MavGraph(object):
         '''set multiple graph option'''
         self.multi = multi
 
+    def set_workers(self, workers):
+        '''set number of processes used for multiple logs'''
+        self.workers = workers
+
+    def set_progress(self, progress):
+        '''set progress callback'''
+        self.progress = progress
+
     def make_format(self, current, other):
         # current and other are axes
         def format_coord(x, y):
@@ -336,7 +393,7 @@ class MavGraph(object):
         '''add some data'''
         mtype = msg.get_type()
         for i in range(0, len(self.fields)):
-            if mtype not in self.field_types[i]:
+            if mtype not in self.field_types[i] or i in self.vector_fields:
                 continue
             f = self.fields[i]
             simple = self.simple_field[i]
@@ -362,6 +419,8 @@ class MavGraph(object):
 
     def timestamp_to_days(self, timestamp):
         '''convert log timestamp to days'''
+        if self.raw_timestamps:
+            return timestamp
         if self.tday_base is None:
             try:
                 self.tday_base = matplotlib.dates.date2num(datetime.datetime.fromtimestamp(timestamp+self.timeshift))
@@ -373,15 +432,53 @@ class MavGraph(object):
         sec_to_days = 1.0 / (60*60*24)
         return self.tday_base + (timestamp - self.tday_basetime) * sec_to_days
 
-    def process_mav(self, mlog, flightmode_selections):
-        '''process one file'''
-        self.vars = {}
-        idx = 0
-        all_false = True
-        for s in flightmode_selections:
-            if s:
-                all_false = False
-
+    def timestamps_to_days(self, timestamps):
+        '''convert an array of log timestamps to days'''
+        if self.raw_timestamps or len(timestamps) == 0:
+            return timestamps
+        self.timestamp_to_days(timestamps[0])
+        if self.tday_base is None:
+            return numpy.zeros(len(timestamps))
+        return self.tday_base + (timestamps - self.tday_basetime) * (1.0 / (60*60*24))
+
+    def process_columns(self, columns, flightmode_selections):
+        '''evaluate fields over the columns of a cached log, returning
+        the set of field indexes that need per message evaluation'''
+        time_ranges = None
+        if any(flightmode_selections):
+            time_ranges = []
+            for i in range(min(len(flightmode_selections), len(self.flightmode_list))):
+                if flightmode_selections[i]:
+                    (mode, t0, t1) = self.flightmode_list[i]
+                    time_ranges.append((t0, t1))
+        try:
+            condition = None
+            if self.condition:
+                condition = mp_vecexpr.VecExpression(self.condition)
+            xaxis = None
+            if self.xaxis:
+                xaxis = mp_vecexpr.VecExpression(self.xaxis)
+        except mp_vecexpr.CannotVectorize:
+            return set(range(self.num_fields))
+        remaining = set()
+        for i in range(self.num_fields):
+            try:
+                (t, x, y) = mp_vecexpr.evaluate_field(columns, self.fields[i],
+                                                      self.field_types[i],
+                                                      condition=condition,
+                                                      xaxis=xaxis,
+                                                      time_ranges=time_ranges)
+            except mp_vecexpr.CannotVectorize:
+                remaining.add(i)
+                continue
+            if x is None:
+                x = self.timestamps_to_days(t)
+            self.x[i].extend(x.tolist())
+            self.y[i].extend(y.tolist())
+        return remaining
+
+    def setup_fields(self):
+        '''strip axis suffixes from fields and see which are simple'''
         # pre-calc right/left axes
         self.num_fields = len(self.fields)
         for i in range(0, self.num_fields):
@@ -404,14 +501,42 @@ class MavGraph(object):
             else:
                 self.simple_field.append((m.group(1),m.group(2)))
 
+    def process_mav(self, mlog, flightmode_selections):
+        '''process one file'''
+        self.vars = {}
+        idx = 0
+        all_false = True
+        for s in flightmode_selections:
+            if s:
+                all_false = False
+
+        self.setup_fields()
+
         if len(self.flightmode_list) > 0:
             # prime the timestamp conversion
             self.timestamp_to_days(self.flightmode_list[0][1])
 
+        self.vector_fields = set()
+        if mp_vecexpr is not None and hasattr(mlog, 'columns'):
+            remaining = self.process_columns(mlog.columns, flightmode_selections)
+            self.vector_fields = set(range(self.num_fields)) - remaining
+            if len(remaining) == 0:
+                return
+
+        # also read the types the condition uses, so it is evaluated
+        # against current messages
+        recv_types = self.msg_types.union(set(re.findall('[A-Z_][A-Z0-9_]+', self.condition or '')))
+
+        count = 0
         while True:
-            msg = mlog.recv_match(type=self.msg_types)
+            msg = mlog.recv_match(type=recv_types)
             if msg is None:
                 break
+            count += 1
+            if self.progress is not None and count % 1000 == 0:
+                (pos, size) = mp_logcache.log_position(mlog) if mp_logcache is not None else (0, 0)
+                if size > 0:
+                    self.progress((100 * pos) // size)
             if msg.get_type() not in self.msg_types:
                 continue
             if self.condition:
@@ -475,9 +600,49 @@ class MavGraph(object):
 
         timeshift = self.timeshift
 
-        for fi in range(0, len(self.mav_list)):
+        if (self.workers != 1 and len(self.mav_list) > 1 and
+            all([ isinstance(mlog, LogSource) for mlog in self.mav_list ])):
+            self.process_parallel(flightmode_selections)
+            return
+
+        progress = self.progress
+        nlogs = len(self.mav_list)
+        for fi in range(0, nlogs):
             mlog = self.mav_list[fi]
+            if progress is not None and nlogs > 1:
+                self.progress = lambda pct: progress((100*fi + pct) // nlogs)
+            if isinstance(mlog, LogSource):
+                mlog = mlog.open()
             self.process_mav(mlog, flightmode_selections)
+        self.progress = progress
+        if progress is not None:
+            # progress is only reported every 1000 messages, so finish it
+            progress(100)
+
+    def process_parallel(self, flightmode_selections):
+        '''process a list of LogSources in a pool of worker processes,
+        merging the results in log order'''
+        self.setup_fields()
+        mav_list = self.mav_list
+        progress = self.progress
+        # the graph is sent to the workers without its logs or callback
+        self.mav_list = []
+        self.progress = None
+        args = [ (self, source, flightmode_selections) for source in mav_list ]
+        try:
+            results = mp_parallel.map_logs(process_logsource, args,
+                                           workers=self.workers,
+                                           progress=progress)
+        finally:
+            self.mav_list = mav_list
+            self.progress = progress
+        for (xlist, ylist) in results:
+            for i in range(len(self.fields)):
+                x = xlist[i]
+                if self.xaxis is None:
+                    x = self.timestamps_to_days(x)
+                self.x[i].extend(x.tolist())
+                self.y[i].extend(ylist[i].tolist())
 
 
     def show(self, lenmavlist, block=True, xlim_pipe=None, output=None):
@@ -535,6 +700,11 @@ class MavGraph(object):
         else:
             pylab.savefig(output, bbox_inches='tight', dpi=200)
 
+def progress_bar(pct):
+    '''text progress display'''
+    sys.stdout.write("\rProcessing %3u%%" % pct)
+    sys.stdout.flush()
+
 if __name__ == "__main__":
     from argparse import ArgumentParser
     parser = ArgumentParser(description=__doc__)
@@ -556,6 +726,7 @@ if __name__ == "__main__":
     parser.add_argument("--dialect", default="ardupilotmega", help="MAVLink dialect")
     parser.add_argument("--output", default=None, help="provide an output format")
     parser.add_argument("--timeshift", type=float, default=0, help="shift time on first graph in seconds")
+    parser.add_argument("--workers", type=int, default=0, help="number of processes for multiple logs (0 for one per CPU)")
     parser.add_argument("logs_fields", metavar="<LOG or FIELD>", nargs="+")
     args = parser.parse_args()
 
@@ -564,10 +735,9 @@ if __name__ == "__main__":
     filenames = []
     for f in args.logs_fields:
         if os.path.exists(f):
-            mlog = mavutil.mavlink_connection(f, notimestamps=args.notimestamps,
-                                              zero_time_base=args.zero_time_base,
-                                              dialect=args.dialect)
-            mg.add_mav(mlog)
+            mg.add_mav(LogSource(f, notimestamps=args.notimestamps,
+                                 zero_time_base=args.zero_time_base,
+                                 dialect=args.dialect))
         else:
             mg.add_field(f)
     mg.set_condition(args.condition)
@@ -578,5 +748,8 @@ if __name__ == "__main__":
     mg.set_multi(args.multi)
     mg.set_title(args.title)
     mg.set_show_flightmode(args.show_flightmode)
+    mg.set_workers(args.workers)
+    mg.set_progress(progress_bar)
     mg.process([],[],0)
+    print("")
     mg.show(len(mg.mav_list), output=args.output)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+'''
+forwarding of MAVLink packets from the master links to outputs
+
+A packet's buffer is fetched once and shared (as a memoryview) between
+all the outputs it goes to. While a batch is open (for example while
+process_master() is parsing one read from a link) packets are queued
+per output and written when the batch ends. Stream outputs (serial,
+TCP) get a single coalesced write per batch, datagram outputs (UDP)
+keep one packet per datagram.
+
+Per-output packet, byte and write error counts are kept in the
+fwd_packets, fwd_bytes and fwd_errors attributes of each connection. An output can also have an
+OutputFilter in its fwd_filter attribute to restrict which message
+types it gets and how often.
+'''
+
+import fnmatch
+import time
+
+from pymavlink import mavutil
+
+datagram_classes = tuple([getattr(mavutil, c) for c in ['mavudp', 'mavmcast'] if hasattr(mavutil, c)])
+
+def packet_buffer(m):
+    '''return a shareable buffer for a MAVLink message'''
+    return memoryview(m.get_msgbuf())
+
+class OutputFilter(object):
+    '''per-output message type filter and rate limiter. allow and deny
+    are lists of message type patterns, rates is a dictionary of
+    message type pattern to maximum rate in Hz. Rate limited types are
+    decimated, keeping the newest message'''
+    def __init__(self, allow=None, deny=None, rates=None):
+        self.allow = [ a.upper() for a in allow ] if allow else None
+        self.deny = [ d.upper() for d in deny ] if deny else None
+        self.rates = {}
+        if rates:
+            for (pattern, rate) in rates.items():
+                self.rates[pattern.upper()] = float(rate)
+        # map of mtype -> (allowed, min_interval)
+        self.type_cache = {}
+        self.last_sent = {}
+        # map of mtype -> newest buffer waiting for its rate slot
+        self.pending = {}
+        self.filtered = 0
+        self.decimated = 0
+
+    def __str__(self):
+        ret = []
+        if self.allow:
+            ret.append("allow=%s" % ','.join(self.allow))
+        if self.deny:
+            ret.append("deny=%s" % ','.join(self.deny))
+        if self.rates:
+            ret.append("rate=%s" % ','.join([ "%s:%g" % (k, v) for (k, v) in sorted(self.rates.items()) ]))
+        return ' '.join(ret)
+
+    def type_rule(self, mtype):
+        '''return (allowed, min_interval) for a message type'''
+        rule = self.type_cache.get(mtype, None)
+        if rule is not None:
+            return rule
+        utype = mtype.upper()
+        allowed = True
+        if self.allow is not None:
+            allowed = any([ fnmatch.fnmatch(utype, a) for a in self.allow ])
+        if allowed and self.deny is not None:
+            allowed = not any([ fnmatch.fnmatch(utype, d) for d in self.deny ])
+        interval = 0
+        for (pattern, rate) in self.rates.items():
+            if fnmatch.fnmatch(utype, pattern):
+                if rate <= 0:
+                    allowed = False
+                else:
+                    interval = max(interval, 1.0 / rate)
+        rule = (allowed, interval)
+        self.type_cache[mtype] = rule
+        return rule
+
+    def accept(self, mtype, buf, now):
+        '''return True if buf should be sent now. Rate limited packets
+        that arrive early are held until their slot comes up'''
+        (allowed, interval) = self.type_rule(mtype)
+        if not allowed:
+            self.filtered += 1
+            return False
+        if interval == 0:
+            return True
+        if now - self.last_sent.get(mtype, 0) >= interval:
+            self.last_sent[mtype] = now
+            if mtype in self.pending:
+                self.pending.pop(mtype)
+                self.decimated += 1
+            return True
+        if mtype in self.pending:
+            self.decimated += 1
+        self.pending[mtype] = buf
+        return False
+
+    def due(self, now):
+        '''return list of held buffers whose rate slot has come up'''
+        ret = []
+        for mtype in list(self.pending.keys()):
+            (allowed, interval) = self.type_rule(mtype)
+            if now - self.last_sent.get(mtype, 0) >= interval:
+                self.last_sent[mtype] = now
+                ret.append(self.pending.pop(mtype))
+        return ret
+
+class PacketForwarder(object):
+    '''batch and fan out packets to output connections'''
+    def __init__(self):
+        self.batch_depth = 0
+        # list of connections with pending data, in first-use order
+        self.pending_conns = []
+        # map of id(conn) -> list of pending buffers
+        self.pending = {}
+        # called with a connection whose socket changed during a write,
+        # such as a TCP reconnect or a tcpin output losing its client
+        self.on_reconnect = None
+
+    def begin(self):
+        '''start a batch, writes are deferred until end()'''
+        self.batch_depth += 1
+
+    def end(self):
+        '''end a batch, writing any pending data'''
+        if self.batch_depth > 0:
+            self.batch_depth -= 1
+        if self.batch_depth == 0:
+            self.flush()
+
+    def send(self, conn, buf):
+        '''send a packet buffer to one connection'''
+        if self.batch_depth == 0:
+            self.write(conn, [buf])
+            return
+        bufs = self.pending.get(id(conn), None)
+        if bufs is None:
+            self.pending[id(conn)] = [buf]
+            self.pending_conns.append(conn)
+        else:
+            bufs.append(buf)
+
+    def send_all(self, conns, buf):
+        '''send a packet buffer to a list of connections'''
+        for conn in conns:
+            self.send(conn, buf)
+
+    def send_outputs(self, conns, mtype, buf):
+        '''send a packet buffer to a list of connections, applying any
+        per-output filters'''
+        now = None
+        for conn in conns:
+            filt = getattr(conn, 'fwd_filter', None)
+            if filt is not None:
+                if now is None:
+                    now = time.time()
+                if not filt.accept(mtype, buf, now):
+                    continue
+            self.send(conn, buf)
+
+    def send_due(self, conns):
+        '''send rate limited packets that are now due'''
+        now = None
+        for conn in conns:
+            filt = getattr(conn, 'fwd_filter', None)
+            if filt is None or not filt.pending:
+                continue
+            if now is None:
+                now = time.time()
+            for buf in filt.due(now):
+                self.send(conn, buf)
+
+    def flush(self):
+        '''write all pending data'''
+        if not self.pending_conns:
+            return
+        conns = self.pending_conns
+        pending = self.pending
+        self.pending_conns = []
+        self.pending = {}
+        for conn in conns:
+            self.write(conn, pending[id(conn)])
+
+    def write(self, conn, bufs):
+        '''write a list of packet buffers to a connection'''
+        datagram = getattr(conn, 'fwd_datagram', None)
+        if datagram is None:
+            datagram = isinstance(conn, datagram_classes)
+            conn.fwd_datagram = datagram
+        port = getattr(conn, 'port', None)
+        npackets = 0
+        nbytes = 0
+        try:
+            if datagram or len(bufs) == 1:
+                for buf in bufs:
+                    conn.write(buf)
+                    npackets += 1
+                    nbytes += len(buf)
+            else:
+                data = b''.join(bufs)
+                conn.write(data)
+                npackets = len(bufs)
+                nbytes = len(data)
+        except Exception as e:
+            errors = getattr(conn, 'fwd_errors', 0)
+            if errors == 0:
+                # report the first error, the rest are counted
+                print("Error writing to output %s: %s" % (getattr(conn, 'address', conn), e))
+            conn.fwd_errors = errors + 1
+        conn.fwd_packets = getattr(conn, 'fwd_packets', 0) + npackets
+        conn.fwd_bytes = getattr(conn, 'fwd_bytes', 0) + nbytes
+        if self.on_reconnect is not None and (getattr(conn, 'port', None) is not port or
+                                              getattr(conn, 'portdead', False)):
+            self.on_reconnect(conn)
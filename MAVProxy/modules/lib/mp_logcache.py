@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+'''
+columnar cache of decoded logs for MAVExplorer
+
+A log is decoded once into a NumPy array per message field, plus a
+timestamp column for each message type. The columns are saved next to
+the log (flight.BIN.npz for flight.BIN) along with the parameters,
+flight mode list and vehicle type, keyed by a hash of the log, so
+reopening a log only needs to read the columns that are used.
+
+LogReplay wraps a set of columns in an object that behaves like a
+pymavlink log connection (recv_match, messages, params, flightmode
+etc), so code written for a log connection works unchanged while only
+touching the message types it asks for.
+'''
+
+import bisect
+import hashlib
+import json
+import os
+import re
+import sys
+
+import numpy
+
+CACHE_VERSION = 2
+TIMESTAMP = '_timestamp'
+# position of each message in the log, to keep file order between
+# messages with the same timestamp
+SEQUENCE = '_seq'
+# size of the pieces at each end of the log used for the hash
+HASH_CHUNK = 1024*1024
+
+re_caps = re.compile('[A-Z_][A-Z0-9_]+')
+
+def cache_filename(logfile):
+    '''return the cache filename for a log'''
+    return logfile + '.npz'
+
+def file_key(filename):
+    '''return a key identifying the contents of a log. This hashes the
+    size and the first and last megabyte rather than the whole file so
+    that checking the cache of a large log stays fast'''
+    size = os.path.getsize(filename)
+    h = hashlib.sha1(str(size).encode('ascii'))
+    f = open(filename, 'rb')
+    h.update(f.read(HASH_CHUNK))
+    if size > HASH_CHUNK:
+        f.seek(max(HASH_CHUNK, size - HASH_CHUNK))
+        h.update(f.read(HASH_CHUNK))
+    f.close()
+    return h.hexdigest()
+
+def expression_types(expression):
+    '''return the set of message types used in an expression'''
+    if expression is None:
+        return set()
+    return set(re.findall(re_caps, expression))
+
+def make_column(values):
+    '''convert a list of field values to an array that can be saved
+    without pickling'''
+    try:
+        col = numpy.array(values)
+    except Exception:
+        col = None
+    if col is not None and col.dtype != object:
+        return col
+    # mixed or missing values
+    try:
+        return numpy.array([numpy.nan if v is None else float(v) for v in values])
+    except Exception:
+        pass
+    return numpy.array([str(v) for v in values])
+
+def log_position(mlog):
+    '''return (position, size) of a log connection for progress'''
+    if hasattr(mlog, 'data_len'):
+        return (getattr(mlog, 'offset', 0), mlog.data_len)
+    if hasattr(mlog, 'filesize') and hasattr(mlog, 'f'):
+        return (mlog.f.tell(), mlog.filesize)
+    return (0, 0)
+
+
+class LogColumns(object):
+    '''per message type columns of a decoded log'''
+    def __init__(self):
+        # map of mtype -> list of field names
+        self.fieldnames = {}
+        # map of mtype -> instance field name for multi-instance messages
+        self.instance_fields = {}
+        self.params = {}
+        self.flightmodes = []
+        self.mav_type = None
+        self.key = None
+        self.count = 0
+        # map of 'TYPE.field' -> array, loaded on demand from npz
+        self.arrays = {}
+        self.npz = None
+
+    def types(self):
+        '''return the sorted list of message types'''
+        return sorted(self.fieldnames.keys())
+
+    def column(self, mtype, field):
+        '''return the array for a field of a message type'''
+        k = mtype + '.' + field
+        ret = self.arrays.get(k, None)
+        if ret is None:
+            if self.npz is None or not k in self.npz.files:
+                raise KeyError(k)
+            ret = self.npz[k]
+            self.arrays[k] = ret
+        return ret
+
+    def timestamps(self, mtype):
+        '''return the timestamp array for a message type'''
+        return self.column(mtype, TIMESTAMP)
+
+    def sequence(self, mtype):
+        '''return the log position of each message of a type'''
+        return self.column(mtype, SEQUENCE)
+
+    def length(self, mtype):
+        '''return number of messages of a type'''
+        if not mtype in self.fieldnames:
+            return 0
+        return len(self.timestamps(mtype))
+
+    def save(self, filename):
+        '''save columns to a npz file, written atomically'''
+        meta = {
+            'version' : CACHE_VERSION,
+            'key' : self.key,
+            'count' : self.count,
+            'fieldnames' : self.fieldnames,
+            'instance_fields' : self.instance_fields,
+            'params' : self.params,
+            'flightmodes' : self.flightmodes,
+            'mav_type' : self.mav_type,
+            }
+        data = { '_meta' : numpy.array(json.dumps(meta)) }
+        for mtype in self.fieldnames.keys():
+            for field in self.fieldnames[mtype] + [TIMESTAMP, SEQUENCE]:
+                data[mtype + '.' + field] = self.column(mtype, field)
+        tmpname = filename + '.tmp'
+        f = open(tmpname, 'wb')
+        numpy.savez(f, **data)
+        f.close()
+        if os.path.exists(filename):
+            # rename over an existing file fails on windows
+            os.unlink(filename)
+        os.rename(tmpname, filename)
+
+    def load(self, filename):
+        '''load column metadata from a npz file. Arrays are read as
+        they are used'''
+        npz = numpy.load(filename, allow_pickle=False)
+        meta = json.loads(str(npz['_meta']))
+        if meta.get('version', None) != CACHE_VERSION:
+            raise ValueError("%s: unsupported cache version" % filename)
+        self.npz = npz
+        self.key = meta['key']
+        self.count = meta['count']
+        self.fieldnames = meta['fieldnames']
+        self.instance_fields = meta['instance_fields']
+        self.params = meta['params']
+        self.flightmodes = [ tuple(fm) for fm in meta['flightmodes'] ]
+        self.mav_type = meta['mav_type']
+
+def build_columns(mlog, progress=None):
+    '''decode a whole log connection into LogColumns'''
+    ret = LogColumns()
+    ret.flightmodes = [ tuple(fm) for fm in mlog.flightmode_list() ]
+    mlog.rewind()
+    values = {}
+    timestamps = {}
+    sequence = {}
+    last_pct = -1
+    while True:
+        m = mlog.recv_msg()
+        if m is None:
+            break
+        mtype = m.get_type()
+        if mtype == 'BAD_DATA':
+            continue
+        fields = ret.fieldnames.get(mtype, None)
+        if fields is None:
+            fields = list(m.get_fieldnames())
+            ret.fieldnames[mtype] = fields
+            values[mtype] = [ [] for f in fields ]
+            timestamps[mtype] = []
+            sequence[mtype] = []
+            fmt = getattr(m, 'fmt', None)
+            if getattr(fmt, 'instance_field', None) is not None:
+                ret.instance_fields[mtype] = fmt.instance_field
+        cols = values[mtype]
+        for i in range(len(fields)):
+            v = getattr(m, fields[i], None)
+            if sys.version_info.major >= 3 and isinstance(v, bytes):
+                v = v.decode('utf-8', 'replace')
+            cols[i].append(v)
+        timestamps[mtype].append(m._timestamp)
+        sequence[mtype].append(ret.count)
+        ret.count += 1
+        if progress is not None and ret.count % 1000 == 0:
+            (pos, size) = log_position(mlog)
+            if size > 0:
+                pct = (100 * pos) // size
+                if pct != last_pct:
+                    progress(pct)
+                    last_pct = pct
+    for mtype in ret.fieldnames.keys():
+        fields = ret.fieldnames[mtype]
+        for i in range(len(fields)):
+            ret.arrays[mtype + '.' + fields[i]] = make_column(values[mtype][i])
+        ret.arrays[mtype + '.' + TIMESTAMP] = numpy.array(timestamps[mtype], dtype=numpy.float64)
+        ret.arrays[mtype + '.' + SEQUENCE] = numpy.array(sequence[mtype], dtype=numpy.int64)
+    ret.params = dict([ (str(k), float(v)) for (k, v) in mlog.params.items() ])
+    ret.mav_type = getattr(mlog, 'mav_type', None)
+    mlog.rewind()
+    return ret
+
+def load_cache(logfile):
+    '''load the cached columns for a log, returning None if there is
+    no valid cache'''
+    filename = cache_filename(logfile)
+    if not os.path.exists(filename):
+        return None
+    try:
+        ret = LogColumns()
+        ret.load(filename)
+    except Exception:
+        return None
+    if ret.key != file_key(logfile):
+        return None
+    return ret
+
+def save_cache(logfile, columns):
+    '''save the columns for a log next to it, returning True on success'''
+    if columns.key is None:
+        columns.key = file_key(logfile)
+    try:
+        columns.save(cache_filename(logfile))
+    except Exception as ex:
+        print("Unable to save log cache: %s" % ex)
+        return False
+    return True
+
+
+class LogRow(object):
+    '''one message rebuilt from columns'''
+    def __init__(self, mtype, fieldnames, values, timestamp):
+        self._type = mtype
+        self._fieldnames = fieldnames
+        self._timestamp = timestamp
+        self.__dict__.update(zip(fieldnames, values))
+
+    def get_type(self):
+        return self._type
+
+    def get_fieldnames(self):
+        return self._fieldnames
+
+    def to_dict(self):
+        d = { 'mavpackettype' : self._type }
+        for f in self._fieldnames:
+            d[f] = getattr(self, f)
+        return d
+
+    def __str__(self):
+        return "%s {%s}" % (self._type, ", ".join([ "%s : %s" % (f, getattr(self, f)) for f in self._fieldnames ]))
+
+
+class LogReplay(object):
+    '''replay of cached columns with the interface of a pymavlink log
+    connection'''
+    def __init__(self, columns, filename=None):
+        self.columns = columns
+        self.filename = filename
+        self.params = columns.params
+        self.mav_type = columns.mav_type
+        self._flightmodes = columns.flightmodes
+        self._count = columns.count
+        self.flightmode_starts = [ fm[1] for fm in self._flightmodes ]
+        # map of mtype -> list of row value tuples, built on first use
+        self.rows = {}
+        self.messages = None
+        self.rewind()
+        # mavextra functions such as delta() and altitude() use the
+        # global log connection
+        from pymavlink import mavutil
+        mavutil.mavfile_global = self
+
+    def rewind(self):
+        '''go back to the start of the log'''
+        self.messages = { 'MAV' : self }
+        self.flightmode = 'UNKNOWN'
+        self._timestamp = None
+        self._seq = None
+        self.timestamp = 0
+        self.order = None
+        self.order_types = None
+        self.order_tstamps = None
+        self.order_seq = None
+        self.pos = 0
+
+    def param(self, name, default=None):
+        '''return a parameter value from the log'''
+        return self.params.get(name, default)
+
+    def flightmode_list(self):
+        '''return list of (mode, t0, t1) for all flight modes in the log'''
+        return self._flightmodes
+
+    def last_messages(self):
+        '''return a dictionary of the last message of each type, as a
+        log connection has after a full parse'''
+        ret = { 'MAV' : self }
+        for mtype in self.columns.types():
+            n = self.columns.length(mtype)
+            if n > 0:
+                self.add_message(ret, self.make_row(mtype, n-1))
+        return ret
+
+    def type_rows(self, mtype):
+        '''return list of value tuples for a type'''
+        rows = self.rows.get(mtype, None)
+        if rows is None:
+            cols = [ self.columns.column(mtype, f).tolist() for f in self.columns.fieldnames[mtype] ]
+            rows = list(zip(*cols))
+            self.rows[mtype] = rows
+        return rows
+
+    def make_row(self, mtype, i):
+        '''build a LogRow for row i of a type'''
+        return LogRow(mtype, self.columns.fieldnames[mtype],
+                      self.type_rows(mtype)[i],
+                      float(self.columns.timestamps(mtype)[i]))
+
+    def add_message(self, messages, m):
+        '''add a message to a messages dictionary'''
+        mtype = m._type
+        messages[mtype] = m
+        ifield = self.columns.instance_fields.get(mtype, None)
+        if ifield is not None:
+            messages["%s[%s]" % (mtype, str(getattr(m, ifield)))] = m
+
+    def setup_order(self, types):
+        '''work out the time order of the messages of a set of types.
+        Messages with the same timestamp stay in log order'''
+        types = sorted([ t for t in types if t in self.columns.fieldnames ])
+        self.order_types = types
+        if len(types) == 0:
+            self.order = []
+            self.order_tstamps = numpy.zeros(0)
+            self.order_seq = numpy.zeros(0, dtype=numpy.int64)
+            return
+        tstamps = []
+        seq = []
+        idx = []
+        for i in range(len(types)):
+            ts = self.columns.timestamps(types[i])
+            tstamps.append(ts)
+            seq.append(self.columns.sequence(types[i]))
+            idx.append(numpy.column_stack((numpy.full(len(ts), i, dtype=numpy.int64),
+                                           numpy.arange(len(ts), dtype=numpy.int64))))
+        tstamps = numpy.concatenate(tstamps)
+        seq = numpy.concatenate(seq)
+        idx = numpy.concatenate(idx)
+        order = numpy.lexsort((seq, tstamps))
+        self.order = idx[order].tolist()
+        self.order_tstamps = tstamps[order]
+        self.order_seq = seq[order]
+
+    def order_position(self, timestamp, seq):
+        '''return the position in the order just after a message'''
+        lo = int(numpy.searchsorted(self.order_tstamps, timestamp, side='left'))
+        hi = int(numpy.searchsorted(self.order_tstamps, timestamp, side='right'))
+        return lo + int(numpy.searchsorted(self.order_seq[lo:hi], seq, side='right'))
+
+    def recv_match(self, condition=None, type=None, blocking=False, strict=False):
+        '''return the next message matching the given type and
+        condition. The types used in the condition are replayed too, so
+        the condition sees the same messages it would in a full log'''
+        if type is None:
+            wanted = set(self.columns.types())
+        elif isinstance(type, str):
+            wanted = set([type])
+        else:
+            wanted = set(type)
+        replay = wanted.union(expression_types(condition))
+        if self.order is None or set(self.order_types) != replay.intersection(self.columns.fieldnames.keys()):
+            # a different set of types, carry on from the current time
+            self.setup_order(replay)
+            self.pos = 0
+            if self._timestamp is not None:
+                self.pos = self.order_position(self._timestamp, self._seq)
+        while self.pos < len(self.order):
+            (ti, ri) = self.order[self.pos]
+            self._seq = int(self.order_seq[self.pos])
+            self.pos += 1
+            m = self.make_row(self.order_types[ti], ri)
+            self.add_message(self.messages, m)
+            self._timestamp = m._timestamp
+            self.timestamp = m._timestamp
+            self.update_flightmode(m._timestamp)
+            if not m._type in wanted:
+                continue
+            if not self.check_condition(condition):
+                continue
+            return m
+        return None
+
+    def update_flightmode(self, timestamp):
+        '''set the flight mode for a timestamp'''
+        i = bisect.bisect_right(self.flightmode_starts, timestamp) - 1
+        if i >= 0:
+            self.flightmode = self._flightmodes[i][0]
+
+    def check_condition(self, condition):
+        '''check if a condition is true'''
+        if condition is None:
+            return True
+        from pymavlink import mavutil
+        return mavutil.evaluate_condition(condition, self.messages)
+
+if __name__ == '__main__':
+    import time
+    from argparse import ArgumentParser
+    from pymavlink import mavutil
+    parser = ArgumentParser(description='build columnar caches for logs')
+    parser.add_argument("logs", metavar="LOG", nargs="+")
+    args = parser.parse_args()
+    for logfile in args.logs:
+        t0 = time.time()
+        mlog = mavutil.mavlink_connection(logfile)
+        columns = build_columns(mlog)
+        t1 = time.time()
+        save_cache(logfile, columns)
+        t2 = time.time()
+        load_cache(logfile)
+        t3 = time.time()
+        print("%s: %u messages, %u types, decode %.2fs save %.2fs load %.3fs" % (
+            logfile, columns.count, len(columns.types()), t1-t0, t2-t1, t3-t2))
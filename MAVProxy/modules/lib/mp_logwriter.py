@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+'''
+telemetry log writing for MAVProxy
+
+Packets are copied by the main thread into a preallocated ring buffer
+with a fixed size, so a stalled disk can't make memory use grow
+without limit; when the buffer is full packets are dropped and
+counted. A writer thread drains the buffers in large writes and
+flushes and (optionally) fsyncs the files at configurable intervals.
+
+The telemetry buffer can also feed a TlogIndexer, with the index
+blocks written to a sidecar file by the same thread.
+'''
+
+import os
+import struct
+import threading
+import time
+
+class LogBuffer(object):
+    '''fixed size ring buffer of log data'''
+    def __init__(self, size):
+        self.lock = threading.Lock()
+        self.buf = bytearray(size)
+        self.size = size
+        self.head = 0
+        self.count = 0
+        # total bytes ever stored, for file offsets
+        self.total = 0
+        self.overflow = 0
+        # optional TlogIndexer and the buffer its blocks go to
+        self.indexer = None
+        self.index_buffer = None
+        self.base_offset = 0
+        self.high_water = size // 4
+        # set when the buffer passes the high water mark
+        self.wakeup = None
+
+    def empty(self):
+        return self.count == 0
+
+    def resize(self, size):
+        '''change the buffer size. Only safe before the writer thread
+        has started'''
+        with self.lock:
+            if size == self.size or self.count > size:
+                return
+            data = bytearray(size)
+            tail = (self.head - self.count) % self.size
+            n = min(self.count, self.size - tail)
+            data[0:n] = self.buf[tail:tail+n]
+            data[n:self.count] = self.buf[0:self.count-n]
+            self.buf = data
+            self.size = size
+            self.head = self.count % size
+            self.high_water = size // 4
+
+    def _copy_in(self, data):
+        '''copy data in at head, wrapping as needed. Caller holds lock'''
+        n = len(data)
+        first = min(n, self.size - self.head)
+        self.buf[self.head:self.head+first] = data[0:first]
+        if first < n:
+            self.buf[0:n-first] = data[first:]
+        self.head = (self.head + n) % self.size
+        self.count += n
+        self.total += n
+
+    def _reserve(self, n):
+        '''check there is room for n bytes, counting an overflow if not.
+        Caller holds lock'''
+        if self.count + n > self.size:
+            self.overflow += 1
+            return False
+        return True
+
+    def _check_wakeup(self):
+        if self.wakeup is not None and self.count >= self.high_water and not self.wakeup.is_set():
+            self.wakeup.set()
+
+    def put(self, data):
+        '''add raw data to the buffer'''
+        with self.lock:
+            if not self._reserve(len(data)):
+                return False
+            self._copy_in(data)
+            self._check_wakeup()
+        return True
+
+    def put_packet(self, usec, buf):
+        '''add a timestamped packet in tlog format (64 bit big endian
+        microsecond timestamp followed by the MAVLink packet)'''
+        n = len(buf)
+        with self.lock:
+            if not self._reserve(n+8):
+                return False
+            offset = self.total
+            if self.head + 8 <= self.size:
+                struct.pack_into('>Q', self.buf, self.head, usec)
+                self.head = (self.head + 8) % self.size
+                self.count += 8
+                self.total += 8
+            else:
+                self._copy_in(struct.pack('>Q', usec))
+            self._copy_in(buf)
+            self._check_wakeup()
+        if self.indexer is not None:
+            block = self.indexer.add(usec, self.base_offset + offset, buf)
+            if block is not None:
+                self.index_buffer.put(block)
+        return True
+
+    def peek(self):
+        '''return a view of the oldest contiguous data in the buffer.
+        The data stays in the buffer until consume() is called'''
+        with self.lock:
+            count = self.count
+            tail = (self.head - count) % self.size
+        n = min(count, self.size - tail)
+        return memoryview(self.buf)[tail:tail+n]
+
+    def consume(self, n):
+        '''remove n bytes from the tail of the buffer'''
+        with self.lock:
+            self.count -= n
+
+
+class LogWriter(object):
+    '''thread writing LogBuffers to files'''
+    def __init__(self, settings, buffer_size):
+        self.settings = settings
+        self.wakeup = threading.Event()
+        self.logqueue = LogBuffer(buffer_size)
+        self.logqueue_raw = LogBuffer(buffer_size)
+        self.logqueue_index = LogBuffer(max(buffer_size//4, 65536))
+        self.logqueue.wakeup = self.wakeup
+        self.logqueue_raw.wakeup = self.wakeup
+        self.logqueue_index.wakeup = self.wakeup
+        self.files = []
+        self.thread = None
+        self.running = False
+        self.last_flush = time.time()
+        self.last_fsync = time.time()
+        self.bytes_written = 0
+        self.write_count = 0
+        self.write_latency_avg = 0
+        self.write_latency_max = 0
+
+    def resize(self, buffer_size):
+        '''change buffer sizes, before start()'''
+        if self.thread is None:
+            self.logqueue.resize(buffer_size)
+            self.logqueue_raw.resize(buffer_size)
+
+    def start(self, logfile, logfile_raw, indexfile=None, indexer=None):
+        '''start writing to the given files, with an optional sidecar
+        index'''
+        self.files = [(self.logqueue_raw, logfile_raw), (self.logqueue, logfile)]
+        if indexfile is not None:
+            logfile.seek(0, os.SEEK_END)
+            self.logqueue.base_offset = logfile.tell() - self.logqueue.total
+            self.logqueue.index_buffer = self.logqueue_index
+            self.logqueue.indexer = indexer
+            self.files.append((self.logqueue_index, indexfile))
+        self.running = True
+        self.thread = threading.Thread(target=self.writer_thread, name='log_writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        '''write out any pending data and stop the writer thread'''
+        if self.thread is None:
+            return
+        self.running = False
+        self.wakeup.set()
+        self.thread.join(timeout=5)
+
+    def write_pending(self):
+        '''write out everything currently buffered'''
+        for (buf, f) in self.files:
+            while not buf.empty():
+                data = buf.peek()
+                n = len(data)
+                t0 = time.time()
+                f.write(data)
+                self.record_latency(time.time() - t0)
+                buf.consume(n)
+                self.bytes_written += n
+                self.write_count += 1
+
+    def record_latency(self, dt):
+        '''update write latency statistics'''
+        self.write_latency_avg = 0.9 * self.write_latency_avg + 0.1 * dt
+        self.write_latency_max = max(self.write_latency_max, dt)
+
+    def sync(self, fsync=False):
+        '''flush, and optionally fsync, the log files'''
+        t0 = time.time()
+        for (buf, f) in self.files:
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+        self.record_latency(time.time() - t0)
+
+    def writer_thread(self):
+        '''log writing thread'''
+        while True:
+            if self.settings.flushlogs:
+                timeout = 0.01
+            else:
+                timeout = 0.1
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+            try:
+                self.write_pending()
+                tnow = time.time()
+                fsync_interval = self.settings.log_fsync_interval
+                if fsync_interval > 0 and tnow - self.last_fsync >= fsync_interval:
+                    self.sync(fsync=True)
+                    self.last_fsync = tnow
+                    self.last_flush = tnow
+                elif self.settings.flushlogs or tnow - self.last_flush >= self.settings.log_flush_interval:
+                    self.sync()
+                    self.last_flush = tnow
+            except Exception as e:
+                print("Log write error: %s" % e)
+                time.sleep(1)
+            if not self.running:
+                self.close_index()
+                self.write_pending()
+                self.sync()
+                return
+
+    def close_index(self):
+        '''write out the final partial index block'''
+        indexer = self.logqueue.indexer
+        if indexer is None:
+            return
+        self.logqueue.indexer = None
+        block = indexer.flush()
+        if block is not None:
+            self.logqueue_index.put(block)
+
+    def status_string(self):
+        '''return a one line status summary'''
+        return "Log: queue %u/%uKB raw %u/%uKB, %u overflows, %u writes, latency avg %.1fms max %.1fms" % (
+            self.logqueue.count//1024, self.logqueue.size//1024,
+            self.logqueue_raw.count//1024, self.logqueue_raw.size//1024,
+            self.logqueue.overflow + self.logqueue_raw.overflow,
+            self.write_count,
+            self.write_latency_avg*1000, self.write_latency_max*1000)
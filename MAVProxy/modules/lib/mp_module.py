@@ -16,6 +16,9 @@ class MPModule(object):
         self.needs_unloading = False
         self.multi_instance = multi_instance
         self.multi_vehicle = multi_vehicle
+        # map of message type to list of handlers. None means this
+        # module gets every packet via mavlink_packet()
+        self.packet_handlers = None
 
         if description is None:
             self.description = name + " handling"
@@ -153,6 +156,33 @@ class MPModule(object):
     def add_completion_function(self, name, callback):
         self.mpstate.completion_functions[name] = callback
 
+    def subscribe(self, mtypes, handler=None):
+        '''only deliver the given message type (or list of types) to
+        this module, calling handler (default mavlink_packet). Modules
+        that never subscribe get all packets'''
+        if handler is None:
+            handler = self.mavlink_packet
+        if not isinstance(mtypes, (list, tuple, set, frozenset)):
+            mtypes = [mtypes]
+        if self.packet_handlers is None:
+            self.packet_handlers = {}
+        for mtype in mtypes:
+            if not mtype in self.packet_handlers:
+                self.packet_handlers[mtype] = []
+            if not handler in self.packet_handlers[mtype]:
+                self.packet_handlers[mtype].append(handler)
+        self.mpstate.dispatch_generation += 1
+
+    def unsubscribe(self, mtypes):
+        '''stop delivering the given message type (or list of types)'''
+        if self.packet_handlers is None:
+            return
+        if not isinstance(mtypes, (list, tuple, set, frozenset)):
+            mtypes = [mtypes]
+        for mtype in mtypes:
+            self.packet_handlers.pop(mtype, None)
+        self.mpstate.dispatch_generation += 1
+
     def dist_string(self, val_meters):
         '''return a distance as a string'''
         if self.settings.dist_unit == 'nm':
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+'''
+process several logs in parallel
+
+map_logs() runs a function over a list of logs, using a multiproc
+process pool when there is more than one log and more than one worker.
+Workers report their progress with report_progress(), which is
+combined into a single percentage for the caller.
+
+The function must be defined at module level so it can be sent to the
+workers, and should return compact results (arrays rather than
+message objects) as they are pickled back to the parent.
+'''
+
+import time
+
+from MAVProxy.modules.lib import multiproc
+
+# queue of (index, pct) from workers to the parent
+progress_queue = None
+# progress function used when running without a pool
+progress_local = None
+
+def init_worker(queue):
+    '''pool worker initialisation'''
+    global progress_queue
+    progress_queue = queue
+
+def report_progress(index, pct):
+    '''report progress (0 to 100) on the log with the given index'''
+    if progress_queue is not None:
+        progress_queue.put((index, pct))
+    elif progress_local is not None:
+        progress_local(index, pct)
+
+def call_worker(args):
+    '''run one job in a worker'''
+    (func, index, arg) = args
+    report_progress(index, 0)
+    ret = func(index, arg)
+    report_progress(index, 100)
+    return ret
+
+def default_workers(njobs):
+    '''default number of workers for a number of jobs'''
+    try:
+        ncpu = multiproc.cpu_count()
+    except NotImplementedError:
+        ncpu = 1
+    return max(1, min(njobs, ncpu))
+
+class Progress(object):
+    '''combine per log progress into one percentage'''
+    def __init__(self, njobs, callback):
+        self.pct = [0] * njobs
+        self.callback = callback
+        self.last = -1
+
+    def update(self, index, pct):
+        self.pct[index] = pct
+        total = sum(self.pct) // len(self.pct)
+        if total != self.last:
+            self.last = total
+            if self.callback is not None:
+                self.callback(total)
+
+def map_logs(func, args, workers=0, progress=None):
+    '''call func(index, arg) for each arg, returning a list of results
+    in the same order. workers is the maximum number of processes, 0
+    for one per CPU. progress is called with the combined percentage'''
+    global progress_local
+    njobs = len(args)
+    if njobs == 0:
+        return []
+    if workers <= 0:
+        workers = default_workers(njobs)
+    workers = min(workers, njobs)
+    combined = Progress(njobs, progress)
+    jobs = [ (func, i, args[i]) for i in range(njobs) ]
+
+    if workers > 1:
+        queue = multiproc.Queue()
+        try:
+            pool = multiproc.Pool(workers, initializer=init_worker, initargs=(queue,))
+        except Exception as ex:
+            print("Unable to start worker pool: %s" % ex)
+            pool = None
+        if pool is not None:
+            try:
+                result = pool.map_async(call_worker, jobs, chunksize=1)
+                while not result.ready():
+                    while not queue.empty():
+                        (index, pct) = queue.get()
+                        combined.update(index, pct)
+                    time.sleep(0.1)
+                ret = result.get()
+            finally:
+                pool.close()
+                pool.join()
+            while not queue.empty():
+                (index, pct) = queue.get()
+                combined.update(index, pct)
+            return ret
+
+    progress_local = combined.update
+    try:
+        return [ call_worker(job) for job in jobs ]
+    finally:
+        progress_local = None
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+'''
+on-disk parameter cache
+
+Parameters are cached per vehicle under ~/.mavproxy/paramcache, in one
+JSON file per vehicle named from its system ID, component ID and the
+unique ID it reports in AUTOPILOT_VERSION. Each file holds the
+parameter count, the name, value and type of each parameter by index,
+and the parameter hash the vehicle reported, if it supports
+_HASH_CHECK.
+'''
+
+import json
+import os
+import struct
+
+from MAVProxy.modules.lib import mp_util
+
+def vehicle_uid(m):
+    '''return a unique ID string from an AUTOPILOT_VERSION message, or
+    None if the vehicle does not report one'''
+    uid2 = getattr(m, 'uid2', None)
+    if uid2 is not None:
+        uid2 = bytearray(uid2)
+        if any(uid2):
+            return ''.join([ '%02x' % b for b in uid2 ])
+    if getattr(m, 'uid', 0):
+        return '%016x' % m.uid
+    return None
+
+def hash_value(value):
+    '''the parameter hash is sent as the bits of a float'''
+    return '%08x' % struct.unpack('<I', struct.pack('<f', value))[0]
+
+class ParamCache(object):
+    '''parameter cache files, keyed by (sysid, compid, uid)'''
+    def __init__(self, path=None):
+        if path is None:
+            path = mp_util.dot_mavproxy('paramcache')
+        self.path = path
+
+    def filename(self, key):
+        (sysid, compid, uid) = key
+        return os.path.join(self.path, '%u_%u_%s.json' % (sysid, compid, uid))
+
+    def load(self, key):
+        '''return a cache entry with count, hash and params, where
+        params maps index to (name, value, type), or None'''
+        try:
+            f = open(self.filename(key), 'r')
+            entry = json.load(f)
+            f.close()
+            params = {}
+            for (idx, p) in entry['params'].items():
+                params[int(idx)] = (str(p[0]), p[1], p[2])
+            return { 'count' : int(entry['count']),
+                     'hash' : entry.get('hash', None),
+                     'params' : params }
+        except Exception:
+            return None
+
+    def save(self, key, count, params, hash=None):
+        '''save the parameters of a vehicle'''
+        entry = { 'count' : count,
+                  'hash' : hash,
+                  'params' : dict([ (str(idx), list(p)) for (idx, p) in params.items() ]) }
+        path = self.filename(key)
+        try:
+            mp_util.mkdir_p(self.path)
+            f = open(path + '.tmp', 'w')
+            json.dump(entry, f)
+            f.close()
+            if os.path.exists(path):
+                os.unlink(path)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError) as e:
+            print("Failed to save parameter cache %s: %s" % (path, e))
+
+    def remove(self, key):
+        try:
+            os.unlink(self.filename(key))
+        except OSError:
+            pass
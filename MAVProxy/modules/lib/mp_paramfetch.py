@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+'''
+pipelined parameter download
+
+ParamFetcher tracks which parameter indices have arrived in a bitmap
+and re-requests missing indices with a sliding window of requests in
+flight. Gaps are re-requested as soon as the parameter stream from the
+vehicle has moved past them, rather than after the stream has stopped.
+
+The round trip time of re-requests is measured to set the timeout for
+a request. The window is the number of parameters the link can carry
+in one round trip, from the measured spacing of the parameter stream,
+scaled up for the measured loss so the link stays busy. If nothing at
+all comes back the timeout backs off, so a dead link is not flooded
+with requests.
+
+Run this module to compare it with the old fixed rate re-requests on a
+simulated lossy link.
+'''
+
+import time
+
+from MAVProxy.modules.lib import mp_rtt
+
+class ParamFetcher(object):
+    '''re-request missing parameters by index. The caller passes each
+    PARAM_VALUE to received() and calls update() regularly. The master
+    only needs a param_fetch_one(index) method'''
+    def __init__(self, min_window=2, max_window=32, min_timeout=0.2, max_timeout=5.0):
+        self.min_window = min_window
+        self.max_window = max_window
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.reset()
+
+    def reset(self, now=None):
+        '''forget all received parameters, for a new download'''
+        if now is None:
+            now = time.time()
+        self.count = 0
+        self.bitmap = bytearray()
+        self.nreceived = 0
+        self.rtt = mp_rtt.RTTEstimator(self.min_timeout, self.max_timeout)
+        # index -> (send time, number of sends)
+        self.inflight = mp_rtt.InFlight(self.rtt)
+        self.backoff = 1
+        self.loss = 0.0
+        self.last_reply = None
+        self.highest = -1
+        self.last_advance = None
+        self.interval = None
+        self.start_time = now
+        self.finish_time = None
+        self.requests = 0
+        self.timeouts = 0
+
+    def set_count(self, count):
+        '''set the number of parameters, keeping any already received'''
+        if count == self.count:
+            return
+        if count > self.count:
+            self.bitmap.extend(bytearray(count - self.count))
+        else:
+            del self.bitmap[count:]
+            self.nreceived = self.bitmap.count(1)
+            for idx in list(self.inflight.keys()):
+                if idx >= count:
+                    self.inflight.pop(idx)
+        self.count = count
+        self.finish_time = None
+
+    def preload(self, indices, count, now=None):
+        '''mark indices as received without fetching them, for
+        parameters that came from a cache'''
+        if now is None:
+            now = time.time()
+        self.set_count(count)
+        for idx in indices:
+            if idx >= 0 and idx < self.count and not self.bitmap[idx]:
+                self.bitmap[idx] = 1
+                self.nreceived += 1
+        # no stream will follow, so any gaps can be requested at once
+        self.highest = self.count - 1
+        self.last_advance = now
+        if self.complete():
+            self.finish_time = now
+
+    def received(self, index, count, now=None):
+        '''handle a PARAM_VALUE with the given index and count'''
+        if now is None:
+            now = time.time()
+        if count > 0 and count != 65535:
+            self.set_count(count)
+        if index < 0 or index >= self.count:
+            return
+        if index > self.highest:
+            # the unsolicited stream has moved on
+            if self.last_advance is not None:
+                dt = (now - self.last_advance) / (index - self.highest)
+                if self.interval is None:
+                    self.interval = dt
+                else:
+                    self.interval = 0.9 * self.interval + 0.1 * dt
+            self.highest = index
+            self.last_advance = now
+        if self.inflight.replied(index, now):
+            self.loss *= 0.95
+            self.backoff = 1
+            self.last_reply = now
+        if not self.bitmap[index]:
+            self.bitmap[index] = 1
+            self.nreceived += 1
+            if self.complete():
+                self.finish_time = now
+                self.inflight.clear()
+
+    def timeout(self):
+        '''time to wait for the reply to a request'''
+        return self.rtt.timeout(self.backoff)
+
+    def window(self):
+        '''number of requests to keep in flight'''
+        if self.rtt.srtt is None or self.interval is None or self.backoff > 1:
+            return self.min_window
+        window = self.rtt.srtt / max(self.interval, 0.001) / max(1.0 - self.loss, 0.25)
+        return int(max(self.min_window, min(self.max_window, window)))
+
+    def stream_stalled(self, now):
+        '''true once the unsolicited stream of parameters has stopped'''
+        if self.last_advance is None:
+            return False
+        if self.highest >= self.count - 1:
+            return True
+        wait = self.timeout()
+        if self.interval is not None:
+            wait = max(wait, 4 * self.interval)
+        return now - self.last_advance > wait
+
+    def complete(self):
+        return self.count > 0 and self.nreceived == self.count
+
+    def missing(self, limit, now):
+        '''return up to limit missing indices that are not in flight.
+        While the stream is running only gaps behind it are returned'''
+        ret = []
+        if self.stream_stalled(now):
+            end = self.count
+        else:
+            end = self.highest
+        idx = self.bitmap.find(b'\x00', 0, end)
+        while idx != -1 and len(ret) < limit:
+            if idx not in self.inflight:
+                ret.append(idx)
+            idx = self.bitmap.find(b'\x00', idx+1, end)
+        return ret
+
+    def update(self, master, now=None):
+        '''expire timed out requests and send new ones to fill the window'''
+        if now is None:
+            now = time.time()
+        if self.count == 0 or self.complete():
+            return
+        rto = self.timeout()
+        expired = self.inflight.expired(now, rto)
+        if expired:
+            self.timeouts += len(expired)
+            for idx in expired:
+                self.loss = 0.95 * self.loss + 0.05
+            if self.last_reply is None or now - self.last_reply > rto:
+                # nothing is getting through, back off
+                self.backoff = min(self.backoff * 2, 8)
+            for idx in expired:
+                # leave in flight with its send count until resent
+                self.inflight.resend(idx)
+        resend = self.inflight.due()
+        active = len(self.inflight) - len(resend)
+        space = self.window() - active
+        if space <= 0:
+            return
+        for idx in sorted(resend)[:space]:
+            master.param_fetch_one(idx)
+            self.inflight.sent(idx, now)
+            self.requests += 1
+            space -= 1
+        for idx in self.missing(space, now):
+            master.param_fetch_one(idx)
+            self.inflight.sent(idx, now)
+            self.requests += 1
+
+    def rate(self, now=None):
+        '''parameters received per second'''
+        if now is None:
+            now = time.time()
+        if self.finish_time is not None:
+            now = self.finish_time
+        dt = now - self.start_time
+        if dt <= 0:
+            return 0.0
+        return self.nreceived / dt
+
+    def status(self, now=None):
+        '''progress report'''
+        ret = "Have %u/%u params, %.1f params/s" % (self.nreceived, self.count, self.rate(now))
+        if self.requests:
+            ret += ", %u re-requests, %u timeouts" % (self.requests, self.timeouts)
+        if not self.complete():
+            ret += ", %u in flight, window %u" % (len(self.inflight), self.window())
+        if self.rtt.srtt is not None:
+            ret += ", rtt %.0fms" % (self.rtt.srtt * 1000)
+        if self.requests:
+            ret += ", loss %.0f%%" % (self.loss * 100)
+        return ret
+
+class SimLink(object):
+    '''a vehicle with count parameters on a link that can send rate
+    PARAM_VALUE messages per second each way, with a one way latency
+    and random loss of messages in each direction'''
+    def __init__(self, count, rate, latency, loss, seed=1):
+        import collections, heapq, random
+        self.heapq = heapq
+        self.random = random.Random(seed)
+        self.count = count
+        self.rate = rate
+        self.latency = latency
+        self.loss = loss
+        self.now = 0.0
+        self.tx = collections.deque()
+        self.link_free = 0.0
+        self.arrivals = []
+        self.requests = []
+        self.messages = 0
+
+    def param_fetch_all(self):
+        self.tx.extend(range(self.count))
+
+    def param_fetch_one(self, idx):
+        if self.random.random() >= self.loss:
+            self.heapq.heappush(self.requests, (self.now + self.latency, idx))
+
+    def step(self, dt):
+        '''advance time, returning the parameter indices received'''
+        self.now += dt
+        while self.requests and self.requests[0][0] <= self.now:
+            # requested parameters are sent ahead of the stream
+            self.tx.appendleft(self.heapq.heappop(self.requests)[1])
+        while self.tx and self.link_free <= self.now:
+            idx = self.tx.popleft()
+            self.link_free = max(self.link_free, self.now - dt) + 1.0 / self.rate
+            self.messages += 1
+            if self.random.random() >= self.loss:
+                self.heapq.heappush(self.arrivals, (self.link_free + self.latency, idx))
+        ret = []
+        while self.arrivals and self.arrivals[0][0] <= self.now:
+            ret.append(self.heapq.heappop(self.arrivals)[1])
+        return ret
+
+def simulate(count, rate, latency, loss, legacy=False, seed=1, limit=3600):
+    '''download count parameters over a SimLink, returning (seconds, messages)'''
+    link = SimLink(count, rate, latency, loss, seed)
+    fetcher = ParamFetcher()
+    fetcher.reset(0.0)
+    link.param_fetch_all()
+    dt = 0.01
+    last_rx = 0.0
+    last_check = 0.0
+    while link.now < limit and not fetcher.complete():
+        for idx in link.step(dt):
+            fetcher.received(idx, count, link.now)
+            last_rx = link.now
+        if not legacy:
+            fetcher.update(link, link.now)
+        elif link.now - last_check >= 1.0 and link.now - last_rx >= 1.0:
+            # the old method: 10 requests a second once the stream has stopped
+            last_check = link.now
+            for idx in fetcher.missing(10, link.now+1000):
+                link.param_fetch_one(idx)
+                fetcher.requests += 1
+    return (link.now, link.messages)
+
+if __name__ == "__main__":
+
+    from optparse import OptionParser
+    parser = OptionParser("mp_paramfetch.py [options]")
+    parser.add_option("--count", type='int', default=1200, help="number of parameters")
+    parser.add_option("--rate", type='float', default=100, help="PARAM_VALUE messages per second the link carries")
+    parser.add_option("--latency", type='float', default=0.1, help="one way latency in seconds")
+    parser.add_option("--loss", type='float', default=0.1, help="message loss fraction")
+    parser.add_option("--seed", type='int', default=1, help="random seed")
+    (opts, args) = parser.parse_args()
+
+    for legacy in [True, False]:
+        (t, messages) = simulate(opts.count, opts.rate, opts.latency, opts.loss,
+                                 legacy=legacy, seed=opts.seed)
+        print("%-10s %u params in %.1fs, %u messages sent" % (
+            "legacy" if legacy else "pipelined", opts.count, t, messages))
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+'''
+parameter metadata index
+
+The apm.pdef.xml parameter documentation is parsed once into a
+ParamMetaIndex of names, descriptions, fields (range, units, bitmask
+and so on) and values, with a word index for keyword searches. The
+index is pickled under ~/.mavproxy/parammeta and rebuilt when the
+modification time or size of the XML file changes, and each index is
+also kept in memory once loaded.
+'''
+
+import hashlib
+import os
+import pickle
+import re
+import xml.etree.ElementTree as ET
+
+from MAVProxy.modules.lib import mp_util
+
+# bump when the pickled layout changes
+INDEX_VERSION = 1
+
+class ParamInfo(object):
+    '''documentation for one parameter'''
+    def __init__(self, name, human_name, documentation, fields, values):
+        self.name = name
+        self.human_name = human_name
+        self.documentation = documentation
+        # list of (name, text), in file order
+        self.fields = fields
+        # list of (code, description), in file order
+        self.values = values
+
+    def field(self, name):
+        '''return the text of a field, or None'''
+        for (fname, text) in self.fields:
+            if fname == name:
+                return text
+        return None
+
+    def range(self):
+        '''return (min, max), or None if there is no valid range'''
+        r = self.field('Range')
+        if r is None:
+            return None
+        try:
+            (rmin, rmax) = [ float(v) for v in r.split()[:2] ]
+        except ValueError:
+            return None
+        return (rmin, rmax)
+
+    def units(self):
+        return self.field('Units')
+
+    def value_name(self, value):
+        '''return the description of a value, or None'''
+        for (code, desc) in self.values:
+            try:
+                if float(code) == float(value):
+                    return desc
+            except ValueError:
+                pass
+        return None
+
+    def text(self):
+        '''all the searchable text of the parameter'''
+        ret = [ self.name, self.human_name, self.documentation ]
+        ret.extend([ text for (fname, text) in self.fields ])
+        ret.extend([ desc for (code, desc) in self.values ])
+        return ' '.join(ret)
+
+word_re = re.compile(r'[A-Za-z0-9_]+')
+
+def words(text):
+    '''return the set of lower case words in some text'''
+    return set([ w.lower() for w in word_re.findall(text) ])
+
+class ParamMetaIndex(object):
+    '''parameter documentation by name, with a word index'''
+    def __init__(self):
+        self.params = {}
+        # word -> set of parameter names
+        self.words = {}
+
+    def add(self, info):
+        self.params[info.name] = info
+        for w in words(info.text()):
+            self.words.setdefault(w, set()).add(info.name)
+
+    def __contains__(self, name):
+        return name in self.params
+
+    def __len__(self):
+        return len(self.params)
+
+    def get(self, name, default=None):
+        return self.params.get(name, default)
+
+    def search(self, keywords):
+        '''return the sorted names of parameters whose documentation
+        contains any of the keywords. A keyword matches any word it
+        is part of, ignoring case'''
+        ret = set()
+        for keyword in keywords:
+            kw = keyword.lower()
+            if kw in self.words:
+                ret.update(self.words[kw])
+            for (w, names) in self.words.items():
+                if w != kw and w.find(kw) != -1:
+                    ret.update(names)
+            m = word_re.match(kw)
+            if m is None or m.group(0) != kw:
+                # not a single word: fall back to a text search
+                for (name, info) in self.params.items():
+                    if info.text().lower().find(kw) != -1:
+                        ret.add(name)
+        return sorted(ret)
+
+    def check_range(self, name, value):
+        '''return a warning if a value is outside the documented range
+        of a parameter, otherwise None'''
+        info = self.params.get(name, None)
+        if info is None:
+            return None
+        r = info.range()
+        if r is None:
+            return None
+        if float(value) < r[0] or float(value) > r[1]:
+            return "%s value %s is outside the range %s to %s" % (name, value, r[0], r[1])
+        return None
+
+def parse_param(p, name):
+    '''create a ParamInfo from a param element'''
+    fields = []
+    values = []
+    for child in p:
+        if child.tag == 'field':
+            fields.append((child.get('name'), (child.text or '').strip()))
+        elif child.tag == 'values':
+            for v in child:
+                values.append((v.get('code'), (v.text or '').strip()))
+    return ParamInfo(name, p.get('humanName', ''), p.get('documentation', ''), fields, values)
+
+def parse_xml(path):
+    '''build an index from a parameter XML file'''
+    tree = ET.parse(path)
+    root = tree.getroot()
+    index = ParamMetaIndex()
+    for p in root.findall('vehicles/parameters/param'):
+        index.add(parse_param(p, p.get('name').split(':')[-1]))
+    for p in root.findall('libraries/parameters/param'):
+        index.add(parse_param(p, p.get('name')))
+    return index
+
+def cache_filename(path):
+    '''the pickle file for an XML file'''
+    h = hashlib.md5(os.path.abspath(path).encode('utf-8')).hexdigest()
+    return mp_util.dot_mavproxy(os.path.join('parammeta', '%s.pickle' % h))
+
+# path -> ((mtime, size), index) of the indexes loaded so far
+_loaded = {}
+
+def load_index(path):
+    '''return the index for a parameter XML file, using the cached index
+    if it is up to date. Returns None if the file can't be read'''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (st.st_mtime, st.st_size)
+    if path in _loaded and _loaded[path][0] == key:
+        return _loaded[path][1]
+    cache = cache_filename(path)
+    index = None
+    try:
+        f = open(cache, 'rb')
+        (version, cache_key, cached) = pickle.load(f)
+        f.close()
+        if version == INDEX_VERSION and cache_key == key:
+            index = cached
+    except Exception:
+        pass
+    if index is None:
+        try:
+            index = parse_xml(path)
+        except Exception as e:
+            print("Failed to parse %s: %s" % (path, e))
+            return None
+        try:
+            mp_util.mkdir_p(os.path.dirname(cache))
+            f = open(cache + '.tmp', 'wb')
+            pickle.dump((INDEX_VERSION, key, index), f, pickle.HIGHEST_PROTOCOL)
+            f.close()
+            if os.path.exists(cache):
+                os.unlink(cache)
+            os.rename(cache + '.tmp', cache)
+        except (IOError, OSError):
+            pass
+    _loaded[path] = (key, index)
+    return index
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+'''
+bulk parameter setting
+
+plan() compares the values to set with the current parameters, giving
+the changes to make and the values that are already set. ParamSetter
+then sends the changes with PARAM_SET, keeping a bounded window of
+sets in flight, and confirms each one when a PARAM_VALUE echoes the
+new value. Sets that time out or are echoed with a different value are
+retried, and reported as failed once the retries run out.
+
+The timeout for an echo is set from the measured round trip time, as
+for parameter fetches. Nothing here blocks: the caller passes each
+PARAM_VALUE to received() and calls update() regularly, for example
+from idle_task.
+'''
+
+import math
+import struct
+import time
+
+from pymavlink import mavutil
+
+from MAVProxy.modules.lib import mp_rtt
+
+def encode_value(value, ptype):
+    '''return the float to send in PARAM_SET for a value. Integer
+    parameters of PX4 style vehicles are sent as the bits of a float'''
+    if ptype is None or ptype == mavutil.mavlink.MAV_PARAM_TYPE_REAL32:
+        return float(value)
+    formats = {
+        mavutil.mavlink.MAV_PARAM_TYPE_UINT8 : ">xxxB",
+        mavutil.mavlink.MAV_PARAM_TYPE_INT8 : ">xxxb",
+        mavutil.mavlink.MAV_PARAM_TYPE_UINT16 : ">xxH",
+        mavutil.mavlink.MAV_PARAM_TYPE_INT16 : ">xxh",
+        mavutil.mavlink.MAV_PARAM_TYPE_UINT32 : ">I",
+        mavutil.mavlink.MAV_PARAM_TYPE_INT32 : ">i",
+        }
+    if ptype not in formats:
+        raise ValueError("can't send parameter of type %u" % ptype)
+    return struct.unpack(">f", struct.pack(formats[ptype], int(value)))[0]
+
+def same_value(v1, v2, mindelta=0.000001):
+    '''true if two parameter values are equal to float precision'''
+    return math.fabs(v1 - v2) <= max(mindelta, math.fabs(v2) * 1.0e-6)
+
+def plan(mav_param, values, check=True, unconfirmed=None):
+    '''compare a list of (name, value) with the current parameters.
+    Returns (changes, unchanged, unknown), where changes is a list of
+    (name, old_value, new_value), old_value being None for unknown
+    parameters. Without check every value is a change. Names in
+    unconfirmed have values the vehicle has not reported yet, such as
+    cached values, so they are always changes'''
+    changes = []
+    unchanged = []
+    unknown = []
+    for (name, value) in values:
+        name = name.upper()
+        old = mav_param.get(name, None)
+        if not check:
+            changes.append((name, old, value))
+        elif old is None:
+            unknown.append(name)
+        elif same_value(old, value) and (unconfirmed is None or name not in unconfirmed):
+            unchanged.append(name)
+        else:
+            changes.append((name, old, value))
+    return (changes, unchanged, unknown)
+
+class ParamSetter(object):
+    '''set a list of (name, old_value, new_value) changes, as given
+    by plan(). ptypes maps names to parameter types for PX4 style
+    encoding'''
+    def __init__(self, changes, unchanged=[], ptypes=None, window=8, timeout=1.0, retries=3, verbose=True,
+                 min_timeout=0.3):
+        self.changes = {}
+        self.pending = []
+        self.unchanged = []
+        if ptypes is None:
+            ptypes = {}
+        self.ptypes = ptypes
+        self.window = window
+        self.rtt = mp_rtt.RTTEstimator(min_timeout, timeout, initial=timeout)
+        self.retries = retries
+        self.verbose = verbose
+        # name -> (send time, number of sends)
+        self.inflight = mp_rtt.InFlight(self.rtt)
+        self.confirmed = []
+        # name -> reason
+        self.failed = {}
+        # called with (name, value) when a set is confirmed
+        self.on_confirm = None
+        self.start_time = time.time()
+        self.add(changes, unchanged)
+
+    def add(self, changes, unchanged=[]):
+        '''add more changes, replacing any pending change to the same parameter'''
+        for (name, old, new) in changes:
+            if name in self.changes and name not in self.pending and name not in self.inflight:
+                # already finished, set it again
+                if name in self.confirmed:
+                    self.confirmed.remove(name)
+                self.failed.pop(name, None)
+            if name in self.inflight:
+                self.inflight.pop(name)
+            if name in self.pending:
+                self.pending.remove(name)
+            self.changes[name] = (old, new)
+            self.pending.insert(0, name)
+        self.unchanged.extend(unchanged)
+
+    def total(self):
+        return len(self.changes)
+
+    def done(self):
+        return not self.pending and not self.inflight
+
+    def send(self, master, name, now):
+        '''send one PARAM_SET'''
+        (old, new) = self.changes[name]
+        ptype = self.ptypes.get(name, None)
+        try:
+            value = encode_value(new, ptype)
+        except ValueError as e:
+            self.failed[name] = str(e)
+            return
+        master.param_set_send(name, value, parm_type=ptype)
+        self.inflight.sent(name, now)
+
+    def retry(self, name, reason):
+        '''resend a set, or fail it if out of retries'''
+        if self.inflight.sends(name) >= self.retries:
+            self.inflight.pop(name)
+            self.failed[name] = reason
+            if self.verbose:
+                print("Failed to set %s: %s" % (name, reason))
+            return
+        # resend on the next update
+        self.inflight.resend(name)
+
+    def received(self, name, value):
+        '''handle a PARAM_VALUE echo'''
+        name = name.upper()
+        if name not in self.inflight:
+            return
+        (old, new) = self.changes[name]
+        if same_value(value, float(new)):
+            self.inflight.replied(name, time.time())
+            self.confirmed.append(name)
+            if self.verbose:
+                if old is None:
+                    print("set %s to %f" % (name, float(new)))
+                else:
+                    print("changed %s from %f to %f" % (name, old, float(new)))
+            if self.on_confirm is not None:
+                self.on_confirm(name, value)
+        elif self.inflight[name][0] is not None:
+            self.retry(name, "vehicle reports %f" % value)
+
+    def update(self, master, now=None):
+        '''expire timed out sets and send more to fill the window'''
+        if now is None:
+            now = time.time()
+        for name in self.inflight.expired(now, self.rtt.timeout()):
+            self.retry(name, "timeout")
+        for name in self.inflight.due():
+            self.send(master, name, now)
+        while self.pending and len(self.inflight) < self.window:
+            self.send(master, self.pending.pop(), now)
+
+    def summary(self):
+        '''final report'''
+        ret = "Set %u parameters in %.1fs: %u confirmed, %u failed, %u unchanged" % (
+            self.total(), time.time() - self.start_time,
+            len(self.confirmed), len(self.failed), len(self.unchanged))
+        for name in sorted(self.failed.keys()):
+            ret += "\n  %s: %s" % (name, self.failed[name])
+        return ret
+
+    def status(self):
+        '''progress report'''
+        return "Setting %u parameters: %u confirmed, %u failed, %u in flight, %u to send" % (
+            self.total(), len(self.confirmed), len(self.failed), len(self.inflight), len(self.pending))
+
+def show_diff(changes, unchanged, unknown):
+    '''print the changes a set would make'''
+    for (name, old, new) in changes:
+        if old is None:
+            print("%-16.16s %12s %12.4f" % (name, '', float(new)))
+        else:
+            print("%-16.16s %12.4f %12.4f" % (name, old, float(new)))
+    for name in unknown:
+        print("Unknown parameter %s" % name)
+    print("%u to change, %u unchanged, %u unknown" % (len(changes), len(unchanged), len(unknown)))
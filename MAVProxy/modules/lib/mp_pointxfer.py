@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+'''
+non-blocking fence and rally point transfers
+
+PointTransfer fetches a set of point indices, keeping a window of
+requests in flight and retrying any that time out. For an upload each
+point is sent and then fetched back, and the point that comes back is
+checked against the one sent, so a batch of points is verified as it
+goes rather than one point at a time. The timeout for a point is set
+from the measured round trip time, as for parameters.
+
+A Transfer runs a list of stages one after another: ParamSetters for
+parameters such as FENCE_TOTAL, and PointTransfers. Final stages, such
+as restoring FENCE_ACTION, run even if an earlier stage failed. The
+caller passes PARAM_VALUE and point messages to the transfer and calls
+update() from idle_task, so nothing blocks the main loop.
+
+A TransferRunner does this for a fence or rally module, running one
+transfer at a time.
+'''
+
+import time
+
+from MAVProxy.modules.lib import mp_paramset
+from MAVProxy.modules.lib import mp_rtt
+
+class PointTransfer(object):
+    '''fetch points by index, sending each point first for an upload.
+    fetch(idx) and send(idx) send the messages. verify(idx, p) checks
+    a point that came back against the one sent'''
+    def __init__(self, indices, fetch, send=None, verify=None, window=4, timeout=1.0, retries=3,
+                 min_timeout=0.3):
+        self.indices = list(indices)
+        self.fetch = fetch
+        self.send = send
+        self.verify = verify
+        self.window = window
+        self.rtt = mp_rtt.RTTEstimator(min_timeout, timeout, initial=timeout)
+        self.retries = retries
+        # pop() from the end gives the points in order
+        self.pending = list(reversed(self.indices))
+        # idx -> (send time, number of sends)
+        self.inflight = mp_rtt.InFlight(self.rtt)
+        # idx -> point received
+        self.points = {}
+        self.error = None
+
+    def total(self):
+        return len(self.indices)
+
+    def done(self):
+        return self.error is not None or len(self.points) == len(self.indices)
+
+    def request(self, idx, now):
+        '''send (if uploading) and fetch one point'''
+        if self.send is not None:
+            self.send(idx)
+        self.fetch(idx)
+        self.inflight.sent(idx, now)
+
+    def retry(self, idx, reason, now):
+        '''request a point again, or fail if out of retries'''
+        if self.inflight.sends(idx) >= self.retries:
+            self.error = reason
+            self.inflight.clear()
+            return
+        self.request(idx, now)
+
+    def received(self, idx, p, now=None):
+        '''handle a point from the vehicle'''
+        if now is None:
+            now = time.time()
+        if idx not in self.inflight or self.error is not None:
+            return
+        if self.verify is not None and not self.verify(idx, p):
+            self.retry(idx, "point %u does not match" % idx, now)
+            return
+        self.inflight.replied(idx, now)
+        self.points[idx] = p
+
+    def update(self, master, now=None):
+        '''retry timed out requests and send more to fill the window'''
+        if now is None:
+            now = time.time()
+        for idx in self.inflight.expired(now, self.rtt.timeout()):
+            if self.error is None:
+                self.retry(idx, "point %u timed out" % idx, now)
+        while self.error is None and self.pending and len(self.inflight) < self.window:
+            self.request(self.pending.pop(), now)
+
+    def status(self):
+        return "%u/%u points" % (len(self.points), self.total())
+
+class Transfer(object):
+    '''run stages one after another. Each stage is a ParamSetter or a
+    PointTransfer. The final stages run whether or not the others
+    succeed'''
+    def __init__(self, name, stages, final=[], report_interval=2.0):
+        self.name = name
+        self.stages = list(stages)
+        self.final = list(final)
+        self.stage = None
+        self.error = None
+        self.start_time = time.time()
+        self.report_interval = report_interval
+        self.last_report = self.start_time
+        # called with the transfer once it is done
+        self.on_done = None
+
+    def param_received(self, name, value):
+        '''handle a PARAM_VALUE'''
+        if isinstance(self.stage, mp_paramset.ParamSetter):
+            self.stage.received(name, value)
+
+    def point_received(self, idx, p, now=None):
+        '''handle a point message'''
+        if isinstance(self.stage, PointTransfer):
+            self.stage.received(idx, p, now)
+
+    def stage_error(self, stage):
+        if isinstance(stage, mp_paramset.ParamSetter):
+            if stage.failed:
+                return "failed to set %s" % ', '.join(sorted(stage.failed.keys()))
+            return None
+        return stage.error
+
+    def next_stage(self):
+        if self.error is None and self.stages:
+            return self.stages.pop(0)
+        if self.final:
+            return self.final.pop(0)
+        return None
+
+    def update(self, master, now=None):
+        '''move the current stage on, starting the next once it is done'''
+        if now is None:
+            now = time.time()
+        while True:
+            if self.stage is None:
+                self.stage = self.next_stage()
+                if self.stage is None:
+                    return
+            self.stage.update(master, now)
+            if not self.stage.done():
+                return
+            error = self.stage_error(self.stage)
+            if self.error is None:
+                self.error = error
+            self.stage = None
+
+    def done(self):
+        return self.stage is None and not self.final and (self.error is not None or not self.stages)
+
+    def status(self):
+        if isinstance(self.stage, PointTransfer):
+            return "%s: %s" % (self.name, self.stage.status())
+        if self.stage is not None:
+            return "%s: setting parameters" % self.name
+        return "%s: starting" % self.name
+
+    def progress(self, now=None):
+        '''return a progress report every report_interval seconds, otherwise None'''
+        if now is None:
+            now = time.time()
+        if now - self.last_report < self.report_interval:
+            return None
+        self.last_report = now
+        return self.status()
+
+    def elapsed(self, now=None):
+        if now is None:
+            now = time.time()
+        return now - self.start_time
+
+class TransferRunner(object):
+    '''run one Transfer at a time for a module. label names the
+    transfers in messages and point_type is the message type of the
+    points. update() is called from the module's idle_task and
+    mavlink_packet() from its mavlink_packet'''
+    def __init__(self, module, label, point_type):
+        self.module = module
+        self.label = label
+        self.point_type = point_type
+        self.transfer = None
+
+    def update(self):
+        '''move any transfer in progress on'''
+        if self.transfer is None:
+            return
+        now = time.time()
+        self.transfer.update(self.module.master, now)
+        if self.transfer.done():
+            transfer = self.transfer
+            self.transfer = None
+            if transfer.error is not None:
+                self.module.console.error("%s failed: %s" % (transfer.name, transfer.error))
+            elif transfer.on_done is not None:
+                transfer.on_done(transfer)
+        else:
+            msg = self.transfer.progress(now)
+            if msg is not None:
+                print(msg)
+
+    def busy(self):
+        '''true if a transfer is running, with a message'''
+        if self.transfer is not None:
+            print("%s transfer in progress: %s" % (self.label, self.transfer.status()))
+            return True
+        return False
+
+    def start(self, transfer, on_done=None):
+        '''start a transfer, unless one is already running'''
+        if self.busy():
+            return False
+        transfer.on_done = on_done
+        self.transfer = transfer
+        self.update()
+        return True
+
+    def mavlink_packet(self, m):
+        '''pass points and PARAM_VALUE messages from the vehicle to the transfer'''
+        if self.transfer is None or m.get_srcSystem() != self.module.target_system:
+            return
+        mtype = m.get_type()
+        if mtype == self.point_type:
+            self.transfer.point_received(m.idx, m)
+        elif mtype == 'PARAM_VALUE':
+            self.transfer.param_received(m.param_id, m.param_value)
+
+    def status(self):
+        if self.transfer is None:
+            return "No %s transfer in progress" % self.label.lower()
+        return self.transfer.status()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+'''
+hot path profiling for the MAVProxy main loop
+
+HotPathProfiler keeps timing statistics for each module's idle_task
+and mavlink_packet, for each message type, and for the main loop
+iteration rate and select latency. The main loop only checks the
+enabled flag when profiling is off, so the cost when disabled is a
+single attribute lookup per loop and per packet.
+
+It can also run cProfile on the main loop thread, or sample the main
+loop thread's stack to produce collapsed stacks (one "a;b;c count"
+line per stack) for flame graph tools.
+'''
+
+import array
+import os
+import sys
+import threading
+import time
+
+# highest resolution clock available
+clock = getattr(time, 'perf_counter', time.time)
+
+class TimingStats(object):
+    '''timing samples for one key. The most recent samples are kept
+    in a fixed size ring for percentiles'''
+    def __init__(self, size=1024):
+        self.samples = array.array('d', [0.0] * size)
+        self.size = size
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, dt):
+        self.samples[self.count % self.size] = dt
+        self.count += 1
+        self.total += dt
+        if dt > self.max:
+            self.max = dt
+
+    def percentile(self, pct):
+        '''return a percentile (0 to 100) of the recent samples'''
+        n = min(self.count, self.size)
+        if n == 0:
+            return 0.0
+        s = sorted(self.samples[:n])
+        i = min(n-1, int(n * pct / 100.0))
+        return s[i]
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+class StackSampler(object):
+    '''periodically sample the stack of one thread, counting collapsed
+    stacks'''
+    def __init__(self, thread_id, rate=200):
+        self.thread_id = thread_id
+        self.interval = 1.0 / rate
+        self.stacks = {}
+        self.samples = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='stack_sampler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+            self.thread = None
+
+    def run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id, None)
+            if frame is not None:
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+                self.samples += 1
+            time.sleep(self.interval)
+
+    def write(self, f):
+        '''write collapsed stacks'''
+        for key in sorted(self.stacks.keys()):
+            f.write("%s %u\n" % (key, self.stacks[key]))
+
+class HotPathProfiler(object):
+    '''per module and per message type timing of the main loop'''
+    def __init__(self):
+        self.enabled = False
+        self.cprofile = None
+        self.sampler = None
+        self.reset()
+
+    def reset(self):
+        '''clear all statistics'''
+        self.idle = {}
+        self.packet = {}
+        self.mtype = {}
+        self.select = TimingStats()
+        self.loop_count = 0
+        self.loop_start = clock()
+        self.loop_end = None
+
+    def start(self, mode=None):
+        '''start collecting. mode can be None for timing only,
+        'cprofile' or 'sample'. This must be called from the main loop
+        thread, as that is the thread that is profiled'''
+        if not self.enabled:
+            self.reset()
+        self.enabled = True
+        self.loop_end = None
+        if mode == 'cprofile':
+            if self.cprofile is None:
+                import cProfile
+                self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        elif mode == 'sample':
+            if self.sampler is None:
+                self.sampler = StackSampler(threading.current_thread().ident)
+            if not self.sampler.running:
+                self.sampler.start()
+
+    def stop(self):
+        '''stop collecting, keeping the statistics for dump'''
+        self.enabled = False
+        self.loop_end = clock()
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        if self.sampler is not None:
+            self.sampler.stop()
+
+    def add(self, table, key, dt):
+        stats = table.get(key, None)
+        if stats is None:
+            stats = TimingStats()
+            table[key] = stats
+        stats.add(dt)
+
+    def idle_time(self, modname, dt):
+        '''record time spent in a module's idle_task'''
+        self.add(self.idle, modname, dt)
+
+    def packet_time(self, modname, dt):
+        '''record time spent in a module's packet handler'''
+        self.add(self.packet, modname, dt)
+
+    def mtype_time(self, mtype, dt):
+        '''record time spent in all module handlers of a message'''
+        self.add(self.mtype, mtype, dt)
+
+    def select_time(self, dt):
+        '''record time spent waiting in select'''
+        self.select.add(dt)
+
+    def loop(self):
+        '''count a main loop iteration'''
+        self.loop_count += 1
+
+    def elapsed(self):
+        '''return time covered by the statistics'''
+        if self.loop_end is not None:
+            return self.loop_end - self.loop_start
+        return clock() - self.loop_start
+
+    def loop_rate(self):
+        dt = self.elapsed()
+        if dt <= 0:
+            return 0
+        return self.loop_count / dt
+
+    def table(self, title, stats, limit=None):
+        '''return report lines for a table of TimingStats, slowest
+        total first'''
+        keys = sorted(stats.keys(), key=lambda k: stats[k].total, reverse=True)
+        if limit is not None:
+            keys = keys[:limit]
+        ret = ["%-24s %8s %9s %9s %9s %9s" % (title, "count", "p50 ms", "p99 ms", "max ms", "total s")]
+        for k in keys:
+            s = stats[k]
+            ret.append("%-24s %8u %9.3f %9.3f %9.3f %9.2f" % (
+                k, s.count, s.percentile(50)*1000, s.percentile(99)*1000, s.max*1000, s.total))
+        return ret
+
+    def report(self, limit=20):
+        '''return a text report of the timing statistics'''
+        ret = []
+        ret.append("Profiled %.1fs, main loop %.1f Hz, select p50 %.3fms p99 %.3fms" % (
+            self.elapsed(), self.loop_rate(),
+            self.select.percentile(50)*1000, self.select.percentile(99)*1000))
+        if self.idle:
+            ret.extend(self.table("idle_task", self.idle, limit))
+        if self.packet:
+            ret.extend(self.table("mavlink_packet", self.packet, limit))
+        if self.mtype:
+            ret.extend(self.table("message type", self.mtype, limit))
+        return '\n'.join(ret)
+
+    def dump(self, filename):
+        '''write profile output. cProfile output goes to filename
+        (for pstats or snakeviz), sampled stacks to filename in
+        collapsed stack format, otherwise the text report'''
+        if self.cprofile is not None:
+            self.cprofile.dump_stats(filename)
+            return "cProfile"
+        f = open(filename, 'w')
+        if self.sampler is not None:
+            self.sampler.write(f)
+            ret = "collapsed stacks"
+        else:
+            f.write(self.report(limit=None) + '\n')
+            ret = "timing report"
+        f.close()
+        return ret
+
+    def clear_profilers(self):
+        '''discard cProfile and stack sample data'''
+        self.cprofile = None
+        self.sampler = None
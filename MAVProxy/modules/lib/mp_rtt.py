@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+'''
+round trip times for request/reply transfers
+
+RTTEstimator keeps a smoothed round trip time and its variation, as
+TCP does, and gives the time to wait for a reply. InFlight tracks the
+send time and number of sends of each request awaiting a reply. Only
+replies to requests sent once are timed, as a reply to a resent
+request could be to either send.
+'''
+
+class RTTEstimator(object):
+    '''smoothed round trip time. The timeout is initial until the
+    first sample, and is kept between min_timeout and max_timeout'''
+    def __init__(self, min_timeout, max_timeout, initial=1.0):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.initial = initial
+        self.srtt = None
+        self.rttvar = 0.0
+
+    def sample(self, rtt):
+        '''update the smoothed round trip time'''
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def timeout(self, backoff=1):
+        '''time to wait for a reply, multiplied by backoff'''
+        if self.srtt is None:
+            rto = self.initial
+        else:
+            rto = self.srtt + 4 * self.rttvar
+        rto = max(self.min_timeout, min(self.max_timeout, rto))
+        return min(self.max_timeout, rto * backoff)
+
+class InFlight(dict):
+    '''requests awaiting a reply: key -> (send time, number of sends).
+    A send time of None marks a request to be sent again'''
+    def __init__(self, rtt):
+        dict.__init__(self)
+        self.rtt = rtt
+
+    def sends(self, key):
+        '''number of times a request has been sent'''
+        if key in self:
+            return self[key][1]
+        return 0
+
+    def sent(self, key, now):
+        '''record sending a request'''
+        self[key] = (now, self.sends(key) + 1)
+
+    def resend(self, key):
+        '''mark a request to be sent again'''
+        self[key] = (None, self[key][1])
+
+    def replied(self, key, now):
+        '''remove a request that has had its reply. Returns False if
+        the request was not in flight'''
+        sent = self.pop(key, None)
+        if sent is None:
+            return False
+        (send_time, sends) = sent
+        if sends == 1 and send_time is not None:
+            self.rtt.sample(now - send_time)
+        return True
+
+    def expired(self, now, timeout):
+        '''requests that have waited more than timeout for a reply'''
+        return [ key for (key, (t, sends)) in self.items() if t is not None and now - t > timeout ]
+
+    def due(self):
+        '''requests marked to be sent again'''
+        return [ key for (key, (t, sends)) in self.items() if t is None ]
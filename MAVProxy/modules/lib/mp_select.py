@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+'''
+file descriptor registry for the MAVProxy main loop
+
+links, outputs and module supplied file descriptors are registered
+once when they are created and removed when they are closed. The main
+loop then waits on the registry and gets back the (kind, object) pair
+for each ready file descriptor, so dispatch cost does not grow with
+the number of endpoints.
+
+A connection can get a new socket when a TCP link reconnects or a
+tcpin output accepts a client, often with the same fd number, and a
+dead port has no fd to select on. The registry keeps each connection's
+socket as well as its fd, and checks a connection after the events that
+can change it: after dispatch() has had it read, and when the caller
+calls update_connection(), for example after a write or a reset.
+
+On python3 this uses the selectors module (epoll/kqueue where
+available), with a plain select() fallback for older pythons.
+'''
+
+import select
+import socket
+import time
+
+from pymavlink import mavutil
+
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
+class SelectRegistry(object):
+    '''registry of file descriptors for the main select loop'''
+    def __init__(self):
+        if selectors is not None:
+            self.selector = selectors.DefaultSelector()
+        else:
+            self.selector = None
+        # map of fd -> (kind, obj)
+        self.fds = {}
+        # map of id(connection) -> (fd, port) for connections whose fd can change
+        self.conn_fds = {}
+        # fds that could not be registered, so the failure is reported once
+        self.failed = set()
+
+    def __len__(self):
+        return len(self.fds)
+
+    def register(self, fd, kind, obj):
+        '''register a file descriptor, replacing any existing
+        registration. Returns False if the fd can't be selected on'''
+        if fd is None:
+            return False
+        if fd in self.fds:
+            self.unregister(fd)
+        if self.selector is not None:
+            try:
+                self.selector.register(fd, selectors.EVENT_READ, (kind, obj))
+            except (ValueError, OSError, KeyError) as e:
+                if not fd in self.failed:
+                    self.failed.add(fd)
+                    print("Unable to select on %s fd %s: %s" % (kind, fd, e))
+                return False
+        self.failed.discard(fd)
+        self.fds[fd] = (kind, obj)
+        return True
+
+    def unregister(self, fd):
+        '''remove a file descriptor from the registry'''
+        if fd is None or not fd in self.fds:
+            return
+        self.fds.pop(fd)
+        if self.selector is not None:
+            try:
+                self.selector.unregister(fd)
+            except (ValueError, OSError, KeyError):
+                pass
+
+    def connection_fd(self, conn):
+        '''return (fd, port) for a mavutil connection, with fd None if
+        there is nothing to select on'''
+        port = getattr(conn, 'port', None)
+        if getattr(conn, 'portdead', False):
+            return (None, port)
+        if isinstance(conn, mavutil.mavtcp):
+            # mavtcp keeps its first fd when it reconnects
+            if port is None or port.fileno() < 0:
+                return (None, port)
+            return (port.fileno(), port)
+        return (getattr(conn, 'fd', None), port)
+
+    def add_connection(self, conn, kind):
+        '''register a mavutil connection'''
+        (fd, port) = self.connection_fd(conn)
+        if fd is None or self.register(fd, kind, conn):
+            self.conn_fds[id(conn)] = (fd, port)
+
+    def remove_connection(self, conn):
+        '''remove a mavutil connection'''
+        (fd, port) = self.conn_fds.pop(id(conn), (None, None))
+        if fd is not None and self.fds.get(fd, (None,None))[1] is conn:
+            self.unregister(fd)
+
+    def update_connection(self, conn, kind):
+        '''re-register a connection if its fd or socket has changed,
+        for example after a reconnect or when the port has gone dead'''
+        (fd, port) = self.connection_fd(conn)
+        old = self.conn_fds.get(id(conn), None)
+        if old is not None and old[0] == fd and old[1] is port:
+            return
+        self.remove_connection(conn)
+        self.add_connection(conn, kind)
+
+    def prune(self):
+        '''remove any file descriptors that have been closed without
+        being unregistered'''
+        for fd in list(self.fds.keys()):
+            try:
+                select.select([fd], [], [], 0)
+            except Exception:
+                (kind, obj) = self.fds[fd]
+                self.unregister(fd)
+                if self.conn_fds.get(id(obj), (None, None))[0] == fd:
+                    self.conn_fds.pop(id(obj))
+
+    def select(self, timeout):
+        '''wait for up to timeout seconds, returning a list of
+        (fd, kind, obj) for the ready file descriptors'''
+        if self.selector is not None:
+            try:
+                events = self.selector.select(timeout)
+            except (select.error, OSError, ValueError):
+                self.prune()
+                return []
+            return [ (key.fd, key.data[0], key.data[1]) for (key, mask) in events ]
+        try:
+            (rin, win, xin) = select.select(list(self.fds.keys()), [], [], timeout)
+        except (select.error, ValueError):
+            self.prune()
+            return []
+        ret = []
+        for fd in rin:
+            if fd in self.fds:
+                (kind, obj) = self.fds[fd]
+                ret.append((fd, kind, obj))
+        return ret
+
+    def dispatch(self, ready, handlers):
+        '''call handlers[kind](fd, obj) for each (fd, kind, obj) returned
+        by select(). Reading a connection can change its socket, so each
+        connection is checked after its handler'''
+        for (fd, kind, obj) in ready:
+            handler = handlers.get(kind, None)
+            if handler is not None:
+                handler(fd, obj)
+            if id(obj) in self.conn_fds:
+                self.update_connection(obj, kind)
+
+
+class SelectExtra(dict):
+    '''dictionary of fd -> (fn, args) for modules that want their own
+    file descriptors in the main loop. Entries are registered with the
+    SelectRegistry as they are added or removed'''
+    def __init__(self, registry):
+        dict.__init__(self)
+        self.registry = registry
+
+    def __setitem__(self, fd, value):
+        dict.__setitem__(self, fd, value)
+        self.registry.register(fd, 'extra', fd)
+
+    def __delitem__(self, fd):
+        dict.__delitem__(self, fd)
+        self.registry.unregister(fd)
+
+    def pop(self, fd, *args):
+        self.registry.unregister(fd)
+        return dict.pop(self, fd, *args)
+
+    def clear(self):
+        for fd in list(self.keys()):
+            self.registry.unregister(fd)
+        dict.clear(self)
+
+
+if __name__ == '__main__':
+    def recv_handler(fd, conn):
+        conn.recv()
+
+    handlers = { 'master' : recv_handler, 'output' : recv_handler }
+
+    def wait_ready(reg, conn, timeout=2.0):
+        '''dispatch until conn is ready, returning False on timeout'''
+        t0 = time.time()
+        while time.time() - t0 < timeout:
+            ready = reg.select(0.1)
+            reg.dispatch(ready, handlers)
+            if conn in [ obj for (fd, kind, obj) in ready ]:
+                return True
+        return False
+
+    # a TCP link that reconnects normally gets the same fd number for
+    # its new socket, and must still be selected on
+    listen = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen.bind(('127.0.0.1', 0))
+    listen.listen(1)
+    conn = mavutil.mavlink_connection('tcp:127.0.0.1:%u' % listen.getsockname()[1], autoreconnect=True)
+    reg = SelectRegistry()
+    reg.add_connection(conn, 'master')
+    (peer, addr) = listen.accept()
+    old_fd = conn.port.fileno()
+    peer.close()
+    # the EOF makes the link reconnect while it is read
+    ok1 = wait_ready(reg, conn)
+    (peer, addr) = listen.accept()
+    peer.send(b'x')
+    ok2 = wait_ready(reg, conn)
+    print("reconnect: old fd %d new fd %d: %s" % (old_fd, conn.port.fileno(),
+                                                  "OK" if ok1 and ok2 else "FAILED"))
+    peer.close()
+    conn.close()
+
+    # a tcpin output changes from the listening fd to the client's fd
+    conn = mavutil.mavlink_connection('tcpin:127.0.0.1:0', input=False)
+    reg = SelectRegistry()
+    reg.add_connection(conn, 'output')
+    client = socket.create_connection(conn.listen.getsockname())
+    ok1 = wait_ready(reg, conn)
+    client.send(b'x')
+    ok2 = wait_ready(reg, conn)
+    print("tcpin accept: %s" % ("OK" if ok1 and ok2 else "FAILED"))
+    client.close()
+    conn.close()
+
+    # benchmark per-iteration cost of an idle main loop against the
+    # number of UDP outputs: rebuilding a select() list each loop,
+    # checking every connection for a new fd each loop, and dispatch()
+    # which only checks the connections it has read
+    iterations = 2000
+    print("%10s %16s %16s %16s" % ("endpoints", "select us/iter", "check us/iter", "dispatch us/iter"))
+    for count in [1, 10, 30, 60, 100]:
+        conns = [ mavutil.mavlink_connection('udpin:127.0.0.1:0') for i in range(count) ]
+
+        t0 = time.time()
+        for i in range(iterations):
+            rin = [ c.fd for c in conns ]
+            (rin, win, xin) = select.select(rin, [], [], 0)
+            for fd in rin:
+                for c in conns:
+                    if c.fd == fd:
+                        break
+        t_select = (time.time() - t0) / iterations
+
+        reg = SelectRegistry()
+        for c in conns:
+            reg.add_connection(c, 'output')
+        t0 = time.time()
+        for i in range(iterations):
+            for c in conns:
+                reg.update_connection(c, 'output')
+            reg.dispatch(reg.select(0), handlers)
+        t_check = (time.time() - t0) / iterations
+
+        t0 = time.time()
+        for i in range(iterations):
+            reg.dispatch(reg.select(0), handlers)
+        t_dispatch = (time.time() - t0) / iterations
+
+        print("%10u %16.1f %16.1f %16.1f" % (count, t_select*1.0e6, t_check*1.0e6, t_dispatch*1.0e6))
+        for c in conns:
+            c.close()
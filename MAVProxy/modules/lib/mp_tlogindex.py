@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+'''
+sidecar index files for telemetry logs
+
+A tlog is a flat stream of 8 byte big endian microsecond timestamps,
+each followed by a MAVLink packet, so finding anything means scanning
+the whole file. An index (flight.tlog.idx next to flight.tlog) lets
+readers seek straight to a time range or to the packets of selected
+message types.
+
+The index is a header followed by a sequence of blocks, one for each
+period (one second by default) of log:
+
+  header: magic 'MAVTIDX1'
+  block:  uint64 first timestamp (usec), uint64 file offset of the
+          first packet, uint32 number of message types, then for each
+          type uint32 msgid, uint32 count and count uint32 offsets
+          relative to the block offset
+
+All block fields are little endian. Blocks are only ever appended, so
+an index can be written while logging and read while it is growing.
+
+IndexedReader wraps a pymavlink tlog connection so recv_match() only
+reads the packets of the message types a tool needs.
+'''
+
+import array
+import bisect
+import os
+import struct
+import sys
+
+INDEX_MAGIC = b'MAVTIDX1'
+BLOCK_HEADER = struct.Struct('<QQI')
+TYPE_HEADER = struct.Struct('<II')
+
+PROTOCOL_MARKER_V1 = 0xFE
+PROTOCOL_MARKER_V2 = 0xFD
+
+# bytes of tlog read at a time when building an index
+READ_CHUNK = 1024*1024
+
+def index_filename(tlog):
+    '''return the index filename for a tlog'''
+    return tlog + '.idx'
+
+def packet_header(buf, ofs=0):
+    '''return (msgid, packet length) for the MAVLink packet at ofs in
+    buf, or None if there is not a valid packet start there'''
+    if len(buf) - ofs < 3:
+        return None
+    marker = buf[ofs]
+    if marker == PROTOCOL_MARKER_V1:
+        if len(buf) - ofs < 6:
+            return None
+        return (buf[ofs+5], buf[ofs+1] + 8)
+    if marker == PROTOCOL_MARKER_V2:
+        if len(buf) - ofs < 10:
+            return None
+        length = buf[ofs+1] + 12
+        if buf[ofs+2] & 0x01:
+            # signed packet
+            length += 13
+        msgid = buf[ofs+7] | (buf[ofs+8]<<8) | (buf[ofs+9]<<16)
+        return (msgid, length)
+    return None
+
+class TlogIndexer(object):
+    '''accumulate index entries as packets are logged, producing a
+    block of index data for each period'''
+    def __init__(self, period=1.0):
+        self.period_usec = int(period * 1.0e6)
+        self.block_usec = None
+        self.block_offset = 0
+        self.offsets = {}
+
+    def add(self, usec, offset, buf):
+        '''add a packet logged at offset, returning a completed block
+        (as bytes) or None'''
+        hdr = packet_header(bytearray(buf[:10]))
+        if hdr is None:
+            return None
+        ret = None
+        if self.block_usec is not None and (usec - self.block_usec >= self.period_usec or
+                                            usec < self.block_usec or
+                                            offset - self.block_offset >= 0xFFFFFFFF):
+            ret = self.flush()
+        if self.block_usec is None:
+            self.block_usec = usec
+            self.block_offset = offset
+        msgid = hdr[0]
+        if not msgid in self.offsets:
+            self.offsets[msgid] = array.array('I')
+        self.offsets[msgid].append(offset - self.block_offset)
+        return ret
+
+    def flush(self):
+        '''return the current block as bytes and start a new one'''
+        if self.block_usec is None:
+            return None
+        data = [BLOCK_HEADER.pack(self.block_usec, self.block_offset, len(self.offsets))]
+        for msgid in sorted(self.offsets.keys()):
+            ofs = self.offsets[msgid]
+            data.append(TYPE_HEADER.pack(msgid, len(ofs)))
+            if sys.byteorder != 'little':
+                ofs.byteswap()
+            data.append(ofs.tostring() if sys.version_info.major < 3 else ofs.tobytes())
+        self.block_usec = None
+        self.offsets = {}
+        return b''.join(data)
+
+def build_index(tlog, period=1.0, progress=None):
+    '''build an index file for an existing tlog, returning the number
+    of packets indexed. The log is read a chunk at a time'''
+    f = open(tlog, 'rb')
+    total = os.fstat(f.fileno()).st_size
+    idx = open(index_filename(tlog), 'wb')
+    idx.write(INDEX_MAGIC)
+    indexer = TlogIndexer(period)
+    # data holds the log from file offset base onwards
+    data = bytearray()
+    base = 0
+    ofs = 0
+    count = 0
+    last_pct = -1
+    eof = False
+    while True:
+        if not eof and len(data) - ofs < 8 + 280:
+            # keep at least one whole record ahead of ofs
+            del data[:ofs]
+            base += ofs
+            ofs = 0
+            chunk = f.read(READ_CHUNK)
+            if not chunk:
+                eof = True
+            data.extend(chunk)
+            continue
+        if ofs + 8 >= len(data):
+            break
+        hdr = packet_header(data, ofs+8)
+        if hdr is None or ofs + 8 + hdr[1] > len(data):
+            # corrupt or truncated record, look for the next one
+            ofs += 1
+            continue
+        usec = struct.unpack_from('>Q', data, ofs)[0]
+        block = indexer.add(usec, base+ofs, data[ofs+8:ofs+18])
+        if block is not None:
+            idx.write(block)
+        ofs += 8 + hdr[1]
+        count += 1
+        if progress is not None and total > 0:
+            pct = (100 * (base+ofs)) // total
+            if pct != last_pct:
+                progress(pct)
+                last_pct = pct
+    f.close()
+    block = indexer.flush()
+    if block is not None:
+        idx.write(block)
+    idx.close()
+    return count
+
+class TlogIndex(object):
+    '''a loaded tlog index'''
+    def __init__(self, filename):
+        self.block_usec = []
+        self.block_offset = []
+        # map of msgid -> array of absolute file offsets
+        self.type_offsets = {}
+        self.load(filename)
+
+    def load(self, filename):
+        f = open(filename, 'rb')
+        data = f.read()
+        f.close()
+        if data[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError("%s is not a tlog index" % filename)
+        ofs = len(INDEX_MAGIC)
+        while ofs + BLOCK_HEADER.size <= len(data):
+            (usec, block_offset, ntypes) = BLOCK_HEADER.unpack_from(data, ofs)
+            pos = ofs + BLOCK_HEADER.size
+            types = []
+            complete = True
+            for i in range(ntypes):
+                if pos + TYPE_HEADER.size > len(data):
+                    complete = False
+                    break
+                (msgid, count) = TYPE_HEADER.unpack_from(data, pos)
+                pos += TYPE_HEADER.size
+                if pos + 4*count > len(data):
+                    complete = False
+                    break
+                ofs_array = array.array('I')
+                if sys.version_info.major < 3:
+                    ofs_array.fromstring(data[pos:pos+4*count])
+                else:
+                    ofs_array.frombytes(data[pos:pos+4*count])
+                if sys.byteorder != 'little':
+                    ofs_array.byteswap()
+                types.append((msgid, ofs_array))
+                pos += 4*count
+            if not complete:
+                # partially written block at the end of a live index
+                break
+            self.block_usec.append(usec)
+            self.block_offset.append(block_offset)
+            for (msgid, ofs_array) in types:
+                if not msgid in self.type_offsets:
+                    self.type_offsets[msgid] = array.array('d')
+                self.type_offsets[msgid].extend([block_offset + o for o in ofs_array])
+            ofs = pos
+
+    def msgids(self):
+        '''return the list of message IDs in the log'''
+        return sorted(self.type_offsets.keys())
+
+    def count(self, msgid):
+        '''return number of packets of a message type'''
+        return len(self.type_offsets.get(msgid, []))
+
+    def offset_for_time(self, usec):
+        '''return file offset of the start of the block containing usec'''
+        if not self.block_usec:
+            return 0
+        i = bisect.bisect_right(self.block_usec, usec) - 1
+        if i < 0:
+            i = 0
+        return self.block_offset[i]
+
+    def offsets(self, msgids, start_usec=None, end_usec=None):
+        '''return sorted file offsets of packets of the given message
+        IDs, optionally limited to a time range'''
+        start_ofs = 0
+        end_ofs = None
+        if start_usec is not None:
+            start_ofs = self.offset_for_time(start_usec)
+        if end_usec is not None and self.block_usec:
+            i = bisect.bisect_right(self.block_usec, end_usec)
+            if i < len(self.block_offset):
+                end_ofs = self.block_offset[i]
+        ret = []
+        for msgid in msgids:
+            offsets = self.type_offsets.get(msgid, [])
+            lo = bisect.bisect_left(offsets, start_ofs)
+            hi = len(offsets) if end_ofs is None else bisect.bisect_left(offsets, end_ofs)
+            ret.extend([int(o) for o in offsets[lo:hi]])
+        return sorted(ret)
+
+def load_index(tlog):
+    '''load the index for a tlog, returning None if there is no usable
+    index'''
+    filename = index_filename(tlog)
+    try:
+        if os.path.getmtime(filename) < os.path.getmtime(tlog) - 10:
+            # index is stale
+            return None
+        return TlogIndex(filename)
+    except Exception:
+        return None
+
+def read_messages(tlog, index, msgids, start_usec=None, end_usec=None):
+    '''generator returning (usec, raw packet) for packets of the given
+    message IDs using an index'''
+    f = open(tlog, 'rb')
+    for ofs in index.offsets(msgids, start_usec, end_usec):
+        f.seek(ofs)
+        data = bytearray(f.read(8+10))
+        hdr = packet_header(data, 8)
+        if hdr is None:
+            continue
+        usec = struct.unpack_from('>Q', data, 0)[0]
+        f.seek(ofs+8)
+        yield (usec, f.read(hdr[1]))
+    f.close()
+
+def message_ids(types):
+    '''return the MAVLink message IDs for a list of message type names.
+    Names that are not MAVLink messages are ignored'''
+    from pymavlink import mavutil
+    ids = {}
+    for (msgid, cls) in mavutil.mavlink.mavlink_map.items():
+        if hasattr(cls, 'msgname'):
+            ids[cls.msgname] = msgid
+        else:
+            ids[cls.name] = msgid
+    return sorted(set([ ids[t] for t in types if t in ids ]))
+
+class IndexedReader(object):
+    '''a pymavlink tlog connection that only reads packets of the given
+    message types, seeking to each one with an index. HEARTBEAT is always
+    read so that the flight mode and vehicle type are tracked. Anything
+    other than recv_match() and rewind() goes to the connection'''
+    def __init__(self, mlog, index, types):
+        self.mlog = mlog
+        self.types = set(types)
+        self.offsets = index.offsets(message_ids(list(self.types) + ['HEARTBEAT']))
+        self.pos = 0
+
+    def __getattr__(self, name):
+        return getattr(self.mlog, name)
+
+    def rewind(self):
+        self.mlog.rewind()
+        self.pos = 0
+
+    def recv_match(self, condition=None, type=None, blocking=False, timeout=None):
+        '''return the next packet of the requested types that matches
+        the condition, or None at the end of the log'''
+        if type is not None and not isinstance(type, list) and not isinstance(type, set):
+            type = [type]
+        while self.pos < len(self.offsets):
+            self.mlog.f.seek(self.offsets[self.pos])
+            self.pos += 1
+            m = self.mlog.recv_msg()
+            if m is None:
+                continue
+            if type is not None and not m.get_type() in type:
+                continue
+            if not self.mlog.check_condition(condition):
+                continue
+            return m
+        return None
+
+def indexed_reader(mlog, filename, types):
+    '''return a reader for a log that only reads the given message types,
+    using the log's index if it has one. Otherwise return mlog'''
+    from pymavlink import mavutil
+    if (not isinstance(mlog, mavutil.mavlogfile) or mlog.notimestamps or
+        getattr(mlog, 'planner_format', False)):
+        return mlog
+    if hasattr(mavutil, 'mavmmaplog') and isinstance(mlog, mavutil.mavmmaplog):
+        # newer pymavlink builds its own offset index when it opens a log
+        return mlog
+    index = load_index(filename)
+    if index is None:
+        return mlog
+    if not message_ids(types):
+        # none of the types are MAVLink messages, eg. dataflash names
+        return mlog
+    return IndexedReader(mlog, index, types)
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='build sidecar index files for tlogs')
+    parser.add_argument("--period", type=float, default=1.0, help="index period in seconds")
+    parser.add_argument("logs", metavar="LOG", nargs="+")
+    args = parser.parse_args()
+    for tlog in args.logs:
+        count = build_index(tlog, period=args.period)
+        print("Indexed %u packets in %s" % (count, tlog))
@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+'''
+vectorized evaluation of graph expressions over log columns
+
+Graph expressions such as "ATTITUDE.roll*2" or
+"degrees(ATTITUDE.pitch){HEARTBEAT.custom_mode==3}" are normally
+evaluated with eval() against the latest message of each type, once
+for every message that arrives. Here they are compiled into NumPy
+operations over the columns of an mp_logcache.LogColumns.
+
+An expression is evaluated at every message of its driving types
+(the message types it uses) in time order. Each field reference takes
+the value from the latest message of that type at or before the
+driving message, the same value it would see in mlog.messages, and
+rows where a referenced type has not been seen yet are dropped.
+
+Expressions using anything that can't be vectorized raise
+CannotVectorize so the caller can fall back to per message
+evaluation.
+'''
+
+import ast
+import math
+import operator
+
+import numpy
+
+class CannotVectorize(Exception):
+    '''the expression needs per message evaluation'''
+    pass
+
+class MissingType(Exception):
+    '''the expression uses a message type that is not in the log'''
+    pass
+
+class MsgRef(object):
+    '''a reference to the current message of a type'''
+    def __init__(self, mtype):
+        self.mtype = mtype
+
+def split_condition(expression):
+    '''split EXPRESSION{CONDITION} into (expression, condition)'''
+    if expression.endswith('}'):
+        i = expression.rfind('{')
+        if i == -1:
+            raise CannotVectorize(expression)
+        return (expression[:i], expression[i+1:-1])
+    return (expression, None)
+
+def parse(expression):
+    '''parse an expression into an ast'''
+    try:
+        return ast.parse(expression.strip(), mode='eval').body
+    except SyntaxError:
+        raise CannotVectorize(expression)
+
+class Sampler(object):
+    '''merged time order of the messages of a set of driving types,
+    with sample and hold lookup of other message types'''
+    def __init__(self, columns, types):
+        self.columns = columns
+        self.types = sorted([ t for t in types if t in columns.fieldnames ])
+        tstamps = []
+        seq = []
+        tindex = []
+        rows = []
+        for i in range(len(self.types)):
+            ts = columns.timestamps(self.types[i])
+            tstamps.append(ts)
+            seq.append(columns.sequence(self.types[i]))
+            tindex.append(numpy.full(len(ts), i, dtype=numpy.int64))
+            rows.append(numpy.arange(len(ts), dtype=numpy.int64))
+        if len(self.types) == 0:
+            self.t = numpy.zeros(0)
+            self.seq = numpy.zeros(0, dtype=numpy.int64)
+            self.tindex = numpy.zeros(0, dtype=numpy.int64)
+            self.rows = numpy.zeros(0, dtype=numpy.int64)
+        else:
+            t = numpy.concatenate(tstamps)
+            seq = numpy.concatenate(seq)
+            order = numpy.lexsort((seq, t))
+            self.t = t[order]
+            self.seq = seq[order]
+            self.tindex = numpy.concatenate(tindex)[order]
+            self.rows = numpy.concatenate(rows)[order]
+        # map of mtype -> row index array
+        self.index_cache = {}
+
+    def __len__(self):
+        return len(self.t)
+
+    def index(self, mtype):
+        '''return the row of mtype current at each sample, -1 if there
+        has not been one yet. Messages are ordered by timestamp and then
+        by log position, as they are in a LogReplay'''
+        ret = self.index_cache.get(mtype, None)
+        if ret is not None:
+            return ret
+        if not mtype in self.columns.fieldnames:
+            raise MissingType(mtype)
+        ts = self.columns.timestamps(mtype)
+        seq = self.columns.sequence(mtype)
+        n = len(self.t)
+        # merge the samples with the messages of mtype, a message
+        # sorting before a sample that is the same message
+        all_t = numpy.concatenate((self.t, ts))
+        all_seq = numpy.concatenate((self.seq, seq))
+        is_sample = numpy.concatenate((numpy.ones(n, dtype=numpy.int64),
+                                       numpy.zeros(len(ts), dtype=numpy.int64)))
+        order = numpy.lexsort((is_sample, all_seq, all_t))
+        # the position in the merged order of the latest message of mtype
+        pos = numpy.where(order >= n, numpy.arange(len(order)), -1)
+        last = numpy.maximum.accumulate(pos)
+        row = numpy.where(last >= 0, order[numpy.maximum(last, 0)] - n, -1)
+        ret = numpy.empty(n, dtype=numpy.int64)
+        ret[order[order < n]] = row[order < n]
+        self.index_cache[mtype] = ret
+        return ret
+
+class Evaluation(object):
+    '''one evaluation of a compiled expression over a Sampler'''
+    def __init__(self, sampler, valid):
+        self.sampler = sampler
+        self.valid = valid
+
+    def field(self, ref, field):
+        if not field in self.sampler.columns.fieldnames[ref.mtype]:
+            raise CannotVectorize("%s.%s" % (ref.mtype, field))
+        idx = self.sampler.index(ref.mtype)
+        self.valid = self.valid & (idx >= 0)
+        return self.sampler.columns.column(ref.mtype, field)[numpy.maximum(idx, 0)]
+
+    def nonzero(self, v):
+        '''mark rows with zero divisors invalid, as eval() would give
+        ZeroDivisionError'''
+        if isinstance(v, numpy.ndarray):
+            self.valid = self.valid & (v != 0)
+        elif v == 0:
+            self.valid = self.valid & False
+
+def as_float(v):
+    if isinstance(v, numpy.ndarray):
+        return v.astype(numpy.float64)
+    return float(v)
+
+def vec_delta(ev, var, key, tusec=None):
+    '''vectorized mavextra.delta()'''
+    v = as_float(var) * numpy.ones(len(ev.sampler))
+    if tusec is None:
+        t = ev.sampler.t
+    else:
+        t = as_float(tusec) * 1.0e-6 * numpy.ones(len(ev.sampler))
+    ok = ev.valid & ~numpy.isnan(v)
+    idx = numpy.nonzero(ok)[0]
+    ret = numpy.zeros(len(v))
+    if len(idx) > 1:
+        vv = v[idx]
+        tt = t[idx]
+        # repeated timestamps return the slope from the first message
+        # at that time
+        new = numpy.concatenate(([True], tt[1:] != tt[:-1]))
+        firsts = numpy.nonzero(new)[0]
+        gv = vv[firsts]
+        gt = tt[firsts]
+        slope = numpy.zeros(len(firsts))
+        slope[1:] = (gv[1:] - gv[:-1]) / (gt[1:] - gt[:-1])
+        ret[idx] = slope[numpy.cumsum(new) - 1]
+    ev.valid = ok
+    return ret
+
+def vec_diff(ev, var, key):
+    '''vectorized mavextra.diff()'''
+    v = as_float(var) * numpy.ones(len(ev.sampler))
+    idx = numpy.nonzero(ev.valid)[0]
+    ret = numpy.zeros(len(v))
+    if len(idx) > 1:
+        vv = v[idx]
+        ret[idx[1:]] = vv[1:] - vv[:-1]
+    return ret
+
+def vec_mag_field(ev, RAW_IMU, SENSOR_OFFSETS=None, ofs=None):
+    '''vectorized mavextra.mag_field()'''
+    if not isinstance(RAW_IMU, MsgRef):
+        raise CannotVectorize('mag_field')
+    mag_x = as_float(ev.field(RAW_IMU, 'xmag'))
+    mag_y = as_float(ev.field(RAW_IMU, 'ymag'))
+    mag_z = as_float(ev.field(RAW_IMU, 'zmag'))
+    if SENSOR_OFFSETS is not None and ofs is not None:
+        if not isinstance(SENSOR_OFFSETS, MsgRef):
+            raise CannotVectorize('mag_field')
+        mag_x = mag_x + ofs[0] - ev.field(SENSOR_OFFSETS, 'mag_ofs_x')
+        mag_y = mag_y + ofs[1] - ev.field(SENSOR_OFFSETS, 'mag_ofs_y')
+        mag_z = mag_z + ofs[2] - ev.field(SENSOR_OFFSETS, 'mag_ofs_z')
+    return numpy.sqrt(mag_x**2 + mag_y**2 + mag_z**2)
+
+def vec_mag_field_df(ev, MAG, ofs=None):
+    '''vectorized mavextra.mag_field_df()'''
+    if not isinstance(MAG, MsgRef):
+        raise CannotVectorize('mag_field_df')
+    mag = [ as_float(ev.field(MAG, f)) for f in ['MagX', 'MagY', 'MagZ'] ]
+    if ofs is not None:
+        offsets = [ ev.field(MAG, f) for f in ['OfsX', 'OfsY', 'OfsZ'] ]
+        mag = [ mag[i] - offsets[i] + ofs[i] for i in range(3) ]
+    return numpy.sqrt(mag[0]**2 + mag[1]**2 + mag[2]**2)
+
+# element-wise functions, called with evaluated arguments
+functions = {
+    'degrees' : numpy.degrees,
+    'radians' : numpy.radians,
+    'sqrt'    : lambda v: numpy.sqrt(as_float(v)),
+    'sin'     : numpy.sin,
+    'cos'     : numpy.cos,
+    'tan'     : numpy.tan,
+    'asin'    : numpy.arcsin,
+    'acos'    : numpy.arccos,
+    'atan'    : numpy.arctan,
+    'atan2'   : numpy.arctan2,
+    'exp'     : numpy.exp,
+    'log'     : numpy.log,
+    'log10'   : numpy.log10,
+    'fabs'    : numpy.fabs,
+    'abs'     : numpy.abs,
+    'floor'   : numpy.floor,
+    'ceil'    : numpy.ceil,
+    'hypot'   : numpy.hypot,
+    'pow'     : lambda a, b: numpy.power(as_float(a), b),
+    'min'     : numpy.minimum,
+    'max'     : numpy.maximum,
+    'kmh'     : lambda v: v * 3.6,
+    'float'   : as_float,
+    }
+
+# functions that need the evaluation state (time, validity, messages)
+state_functions = {
+    'delta'        : vec_delta,
+    'diff'         : vec_diff,
+    'mag_field'    : vec_mag_field,
+    'mag_field_df' : vec_mag_field_df,
+    }
+
+constants = {
+    'pi' : math.pi,
+    'e'  : math.e,
+    'True' : True,
+    'False' : False,
+    }
+
+binary_ops = {
+    ast.Add : numpy.add,
+    ast.Sub : numpy.subtract,
+    ast.Mult : numpy.multiply,
+    ast.Pow : lambda a, b: numpy.power(as_float(a), b),
+    ast.BitAnd : numpy.bitwise_and,
+    ast.BitOr : numpy.bitwise_or,
+    ast.BitXor : numpy.bitwise_xor,
+    ast.LShift : numpy.left_shift,
+    ast.RShift : numpy.right_shift,
+    }
+
+# operator rather than numpy ufuncs so string fields can be compared
+compare_ops = {
+    ast.Eq : operator.eq,
+    ast.NotEq : operator.ne,
+    ast.Lt : operator.lt,
+    ast.LtE : operator.le,
+    ast.Gt : operator.gt,
+    ast.GtE : operator.ge,
+    }
+
+class VecExpression(object):
+    '''a compiled expression'''
+    def __init__(self, expression):
+        self.expression = expression
+        (expr, cond) = split_condition(expression)
+        self.tree = parse(expr)
+        self.condition = parse(cond) if cond is not None else None
+
+    def evaluate(self, sampler, valid=None):
+        '''evaluate over a sampler, returning (values, valid mask).
+        Rows whose condition is false are marked invalid'''
+        if valid is None:
+            valid = numpy.ones(len(sampler), dtype=bool)
+        ev = Evaluation(sampler, valid)
+        try:
+            if self.condition is not None:
+                c = self.node(ev, self.condition)
+                if isinstance(c, MsgRef):
+                    raise CannotVectorize(self.expression)
+                ev.valid = ev.valid & (numpy.ones(len(sampler), dtype=bool) & numpy.asarray(c, dtype=bool))
+            v = self.node(ev, self.tree)
+        except MissingType:
+            # eval() would give a NameError on every message
+            return (numpy.zeros(len(sampler)), numpy.zeros(len(sampler), dtype=bool))
+        except (TypeError, ValueError):
+            raise CannotVectorize(self.expression)
+        if isinstance(v, MsgRef) or isinstance(v, str):
+            raise CannotVectorize(self.expression)
+        v = numpy.asarray(v)
+        if v.dtype.kind not in 'biuf':
+            raise CannotVectorize(self.expression)
+        v = v.astype(numpy.float64) * numpy.ones(len(sampler))
+        return (v, ev.valid)
+
+    def node(self, ev, n):
+        '''evaluate one ast node'''
+        if isinstance(n, ast.BinOp):
+            a = self.node(ev, n.left)
+            b = self.node(ev, n.right)
+            op = type(n.op)
+            with numpy.errstate(all='ignore'):
+                if op == ast.Div:
+                    ev.nonzero(b)
+                    return numpy.true_divide(as_float(a), b)
+                if op in (ast.FloorDiv, ast.Mod):
+                    ev.nonzero(b)
+                    if op == ast.FloorDiv:
+                        return numpy.floor_divide(a, b)
+                    return numpy.mod(a, b)
+                if not op in binary_ops:
+                    raise CannotVectorize(self.expression)
+                return binary_ops[op](a, b)
+        if isinstance(n, ast.UnaryOp):
+            v = self.node(ev, n.operand)
+            if isinstance(n.op, ast.USub):
+                return numpy.negative(v)
+            if isinstance(n.op, ast.UAdd):
+                return v
+            if isinstance(n.op, ast.Not):
+                return numpy.logical_not(v)
+            if isinstance(n.op, ast.Invert):
+                return numpy.invert(v)
+        if isinstance(n, ast.Compare):
+            if len(n.ops) != 1 or not type(n.ops[0]) in compare_ops:
+                raise CannotVectorize(self.expression)
+            a = self.node(ev, n.left)
+            b = self.node(ev, n.comparators[0])
+            return compare_ops[type(n.ops[0])](a, b)
+        if isinstance(n, ast.BoolOp):
+            values = [ self.node(ev, v) for v in n.values ]
+            if isinstance(n.op, ast.And):
+                return numpy.logical_and.reduce(values)
+            return numpy.logical_or.reduce(values)
+        if isinstance(n, ast.IfExp):
+            c = self.node(ev, n.test)
+            return numpy.where(c, self.node(ev, n.body), self.node(ev, n.orelse))
+        if isinstance(n, ast.Attribute):
+            ref = self.node(ev, n.value)
+            if not isinstance(ref, MsgRef):
+                raise CannotVectorize(self.expression)
+            return ev.field(ref, n.attr)
+        if isinstance(n, ast.Name):
+            if n.id in ev.sampler.columns.fieldnames:
+                return MsgRef(n.id)
+            if n.id in constants:
+                return constants[n.id]
+            if n.id.isupper():
+                raise MissingType(n.id)
+            raise CannotVectorize(self.expression)
+        if isinstance(n, ast.Tuple):
+            return tuple([ self.node(ev, e) for e in n.elts ])
+        if isinstance(n, ast.Call):
+            if not isinstance(n.func, ast.Name) or n.keywords:
+                raise CannotVectorize(self.expression)
+            args = [ self.node(ev, a) for a in n.args ]
+            name = n.func.id
+            if name in state_functions:
+                return state_functions[name](ev, *args)
+            if name in functions:
+                for a in args:
+                    if isinstance(a, MsgRef):
+                        raise CannotVectorize(self.expression)
+                with numpy.errstate(all='ignore'):
+                    return functions[name](*args)
+            raise CannotVectorize(self.expression)
+        v = constant_value(n)
+        if v is not None:
+            return v
+        raise CannotVectorize(self.expression)
+
+def constant_value(n):
+    '''return the value of a constant node, or None'''
+    if hasattr(ast, 'Constant'):
+        if isinstance(n, ast.Constant) and isinstance(n.value, (int, float, str)):
+            return n.value
+        return None
+    if isinstance(n, ast.Num):
+        return n.n
+    if isinstance(n, ast.Str):
+        return n.s
+    return None
+
+def time_mask(t, time_ranges):
+    '''return mask of times within any of a list of (t0, t1) ranges'''
+    mask = numpy.zeros(len(t), dtype=bool)
+    for (t0, t1) in time_ranges:
+        mask |= (t >= t0) & (t < t1)
+    return mask
+
+def evaluate_field(columns, expression, types, condition=None, xaxis=None, time_ranges=None):
+    '''evaluate a graph field at each message of the given driving
+    types, returning (timestamps, xvalues, yvalues) for the rows where
+    it is valid. xvalues is None if there is no xaxis expression.
+    expression, condition and xaxis can be strings or VecExpressions'''
+    if not isinstance(expression, VecExpression):
+        expression = VecExpression(expression)
+    if condition is not None and not isinstance(condition, VecExpression):
+        condition = VecExpression(condition)
+    if xaxis is not None and not isinstance(xaxis, VecExpression):
+        xaxis = VecExpression(xaxis)
+    sampler = Sampler(columns, types)
+    valid = numpy.ones(len(sampler), dtype=bool)
+    if time_ranges is not None:
+        valid &= time_mask(sampler.t, time_ranges)
+    if condition is not None:
+        (c, cvalid) = condition.evaluate(sampler, valid)
+        valid &= cvalid & (c != 0)
+    (y, valid) = expression.evaluate(sampler, valid)
+    x = None
+    if xaxis is not None:
+        (x, valid) = xaxis.evaluate(sampler, valid)
+        x = x[valid]
+    return (sampler.t[valid], x, y[valid])
@@ -63,8 +63,8 @@ import platform, os
 # is set. Using USE_BILLIARD allows for debugging of the crazy forking disable approach on
 # a saner platform
 if platform.system() == 'Darwin' or os.environ.get('USE_BILLIARD',None) is not None:
-    from billiard import Process, forking_enable, freeze_support, Pipe, Semaphore, Event, Lock
+    from billiard import Process, forking_enable, freeze_support, Pipe, Semaphore, Event, Lock, Pool, cpu_count
     forking_enable(False)
     Queue = PipeQueue
 else:
-    from multiprocessing import Process, freeze_support, Pipe, Semaphore, Event, Lock, Queue
+    from multiprocessing import Process, freeze_support, Pipe, Semaphore, Event, Lock, Queue, Pool, cpu_count
@@ -35,6 +35,7 @@ class ArmModule(mp_module.MPModule):
                                       'safetyoff'])
         self.add_command('disarm', self.cmd_disarm,   'disarm motors')
         self.was_armed = False
+        self.subscribe('HEARTBEAT')
 
     def checkables(self):
         return "<" + "|".join(arming_masks.keys()) + ">"
@@ -23,6 +23,7 @@ class CalibrationModule(mp_module.MPModule):
         self.compassmot_running = False
         self.empty_input_count = 0
         self.magcal_progess = []
+        self.subscribe(['STATUSTEXT', 'MAG_CAL_PROGRESS', 'MAG_CAL_REPORT'])
 
     def cmd_ground(self, args):
         '''do a ground start mode'''
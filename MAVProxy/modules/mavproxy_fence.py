@@ -1,10 +1,12 @@
 """
     MAVProxy geofence module
 """
-import os, time, platform
+import os, platform
 from pymavlink import mavwp, mavutil
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import mp_paramset
+from MAVProxy.modules.lib import mp_pointxfer
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import *
 
@@ -19,10 +21,12 @@ class FenceModule(mp_module.MPModule):
         self.healthy = True
         self.add_command('fence', self.cmd_fence,
                          "geo-fence management",
-                         ["<draw|list|clear|enable|disable|move|remove>",
+                         ["<draw|list|clear|enable|disable|move|remove|status>",
                           "<load|save> (FILENAME)"])
 
         self.have_list = False
+        # runs uploads and downloads
+        self.transfers = mp_pointxfer.TransferRunner(self, "Fence", "FENCE_POINT")
 
         if self.continue_mode and self.logdir is not None:
             fencetxt = os.path.join(self.logdir, 'fence.txt')
@@ -70,8 +74,11 @@ class FenceModule(mp_module.MPModule):
         else:
             self.menu_added_map = False
 
+        self.transfers.update()
+
     def mavlink_packet(self, m):
         '''handle and incoming mavlink packet'''
+        self.transfers.mavlink_packet(m)
         if m.get_type() == "FENCE_STATUS":
             self.last_fence_breach = m.breach_time
             self.last_fence_status = m.breach_status
@@ -125,6 +132,8 @@ class FenceModule(mp_module.MPModule):
         if not self.have_list:
             print("Please list fence points first")
             return
+        if self.transfers.busy():
+            return
 
         idx = int(args[0])
         if idx <= 0 or idx > self.fenceloader.count():
@@ -138,8 +147,7 @@ class FenceModule(mp_module.MPModule):
 
         # note we don't subtract 1, as first fence point is the return point
         self.fenceloader.move(idx, latlon[0], latlon[1])
-        if self.send_fence():
-            print("Moved fence point %u" % idx)
+        self.send_fence("Moved fence point %u" % idx)
 
     def cmd_fence_remove(self, args):
         '''handle fencepoint remove'''
@@ -149,6 +157,8 @@ class FenceModule(mp_module.MPModule):
         if not self.have_list:
             print("Please list fence points first")
             return
+        if self.transfers.busy():
+            return
 
         idx = int(args[0])
         if idx <= 0 or idx > self.fenceloader.count():
@@ -157,10 +167,7 @@ class FenceModule(mp_module.MPModule):
 
         # note we don't subtract 1, as first fence point is the return point
         self.fenceloader.remove(idx)
-        if self.send_fence():
-            print("Removed fence point %u" % idx)
-        else:
-            print("Failed to remove fence point %u" % idx)
+        self.send_fence("Removed fence point %u" % idx)
 
     def cmd_fence(self, args):
         '''fence commands'''
@@ -201,12 +208,27 @@ class FenceModule(mp_module.MPModule):
             self.mpstate.map_functions['draw_lines'](self.fence_draw_callback)
             print("Drawing fence on map")
         elif args[0] == "clear":
-            self.param_set('FENCE_TOTAL', 0, 3)
+            self.clear_fence()
+        elif args[0] == "status":
+            print(self.transfers.status())
         else:
             self.print_usage()
 
+    def param_setter(self, values):
+        '''a ParamSetter for a list of (name, value)'''
+        return mp_paramset.ParamSetter([ (name, self.get_mav_param(name, None), value) for (name, value) in values ],
+                                       verbose=False)
+
+    def clear_fence(self):
+        '''start setting FENCE_TOTAL to zero'''
+        def done(transfer):
+            print("Cleared fence")
+        self.transfers.start(mp_pointxfer.Transfer("Fence clear", [self.param_setter([('FENCE_TOTAL', 0)])]), done)
+
     def load_fence(self, filename):
         '''load fence points from a file'''
+        if self.transfers.busy():
+            return
         try:
             self.fenceloader.target_system = self.target_system
             self.fenceloader.target_component = self.target_component
@@ -217,50 +239,47 @@ class FenceModule(mp_module.MPModule):
         print("Loaded %u geo-fence points from %s" % (self.fenceloader.count(), filename))
         self.send_fence()
 
-    def send_fence(self):
-        '''send fence points from fenceloader'''
-        # must disable geo-fencing when loading
+    def send_fence(self, message=None):
+        '''start sending the fence points from fenceloader. Points are
+        sent and fetched back to check them a few at a time. Geo-fencing
+        is disabled while loading and FENCE_ACTION is restored after'''
         self.fenceloader.target_system = self.target_system
         self.fenceloader.target_component = self.target_component
         self.fenceloader.reindex()
+        count = self.fenceloader.count()
         action = self.get_mav_param('FENCE_ACTION', mavutil.mavlink.FENCE_ACTION_NONE)
-        self.param_set('FENCE_ACTION', mavutil.mavlink.FENCE_ACTION_NONE, 3)
-        self.param_set('FENCE_TOTAL', self.fenceloader.count(), 3)
-        for i in range(self.fenceloader.count()):
-            p = self.fenceloader.point(i)
-            self.master.mav.send(p)
-            p2 = self.fetch_fence_point(i)
-            if p2 is None:
-                self.param_set('FENCE_ACTION', action, 3)
-                return False
-            if (p.idx != p2.idx or
-                abs(p.lat - p2.lat) >= 0.00003 or
-                abs(p.lng - p2.lng) >= 0.00003):
-                print("Failed to send fence point %u" % i)
-                self.param_set('FENCE_ACTION', action, 3)
-                return False
-        self.param_set('FENCE_ACTION', action, 3)
-        return True
-
-    def fetch_fence_point(self ,i):
-        '''fetch one fence point'''
+        points = [ self.fenceloader.point(i) for i in range(count) ]
+
+        def send(i):
+            self.master.mav.send(points[i])
+
+        def verify(i, p2):
+            p = points[i]
+            return (p.idx == p2.idx and
+                    abs(p.lat - p2.lat) < 0.00003 and
+                    abs(p.lng - p2.lng) < 0.00003)
+
+        def done(transfer):
+            if message is not None:
+                print(message)
+            else:
+                print("Sent %u fence points in %.1fs" % (count, transfer.elapsed()))
+
+        setup = self.param_setter([('FENCE_ACTION', mavutil.mavlink.FENCE_ACTION_NONE),
+                                   ('FENCE_TOTAL', count)])
+        points_xfer = mp_pointxfer.PointTransfer(range(count), self.fetch_fence_point, send=send, verify=verify)
+        restore = self.param_setter([('FENCE_ACTION', action)])
+        return self.transfers.start(mp_pointxfer.Transfer("Fence upload", [setup, points_xfer], [restore]), done)
+
+    def fetch_fence_point(self, i):
+        '''request one fence point'''
         self.master.mav.fence_fetch_point_send(self.target_system,
                                                     self.target_component, i)
-        tstart = time.time()
-        p = None
-        while time.time() - tstart < 3:
-            p = self.master.recv_match(type='FENCE_POINT', blocking=False)
-            if p is not None:
-                break
-            time.sleep(0.1)
-            continue
-        if p is None:
-            self.console.error("Failed to fetch point %u" % i)
-            return None
-        return p
 
     def fence_draw_callback(self, points):
         '''callback from drawing a fence'''
+        if self.transfers.busy():
+            return
         self.fenceloader.clear()
         if len(points) < 3:
             return
@@ -278,17 +297,23 @@ class FenceModule(mp_module.MPModule):
         self.have_list = True
 
     def list_fence(self, filename):
-        '''list fence points, optionally saving to a file'''
-        self.fenceloader.clear()
+        '''start fetching the fence points, optionally saving them to a file'''
+        if self.transfers.busy():
+            return
         count = self.get_mav_param('FENCE_TOTAL', 0)
         if count == 0:
+            self.fenceloader.clear()
             print("No geo-fence points")
             return
-        for i in range(int(count)):
-            p = self.fetch_fence_point(i)
-            if p is None:
-                return
-            self.fenceloader.add(p)
+        xfer = mp_pointxfer.PointTransfer(range(int(count)), self.fetch_fence_point)
+        self.transfers.start(mp_pointxfer.Transfer("Fence download", [xfer]),
+                            lambda transfer: self.list_fence_done(xfer, filename))
+
+    def list_fence_done(self, xfer, filename):
+        '''all fence points have arrived'''
+        self.fenceloader.clear()
+        for i in sorted(xfer.points.keys()):
+            self.fenceloader.add(xfer.points[i])
 
         if filename is not None:
             try:
@@ -311,7 +336,7 @@ class FenceModule(mp_module.MPModule):
         self.have_list = True
 
     def print_usage(self):
-        print("usage: fence <enable|disable|list|load|save|clear|draw|move|remove>")
+        print("usage: fence <enable|disable|list|load|save|clear|draw|move|remove|status>")
 
     def unload(self):
         self.remove_command("fence")
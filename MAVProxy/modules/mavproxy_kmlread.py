@@ -6,8 +6,7 @@ Released under the GNU GPL version 3 or later
 
 '''
 
-import time, math, random
-from pymavlink import mavutil, mavwp
+import math, random
 from xml.dom.minidom import parseString
 from zipfile import ZipFile
 
@@ -34,9 +33,6 @@ class KmlReadModule(mp_module.MPModule):
         self.curtextlayers = []
         self.menu_added_map = False
         self.menu_needs_refreshing = True
-        
-        #the fence manager
-        self.fenceloader = mavwp.MAVFenceLoader()
         self.snap_points = []
         
         #make the initial map menu
@@ -113,6 +109,8 @@ class KmlReadModule(mp_module.MPModule):
         if len(args) > 0:
             threshold = float(args[0])
         fencemod = self.module('fence')
+        if fencemod.transfers.busy():
+            return
         loader = fencemod.fenceloader
         changed = False
         for i in range(0,loader.count()):
@@ -144,68 +142,33 @@ class KmlReadModule(mp_module.MPModule):
         if layername.startswith('"') and layername.endswith('"'):
             layername = layername[1:-1]
         
+        fencemod = self.module('fence')
+        if fencemod is None:
+            print("fence module not loaded")
+            return
+        if fencemod.transfers.busy():
+            return
+        loader = fencemod.fenceloader
+
         #for each point in the layer, add it in
         for layer in self.allayers:
             if layer.key == layername:
                 #clear the current fence
-                self.fenceloader.clear()
+                loader.clear()
                 if len(layer.points) < 3:
                     return
-                self.fenceloader.target_system = self.target_system
-                self.fenceloader.target_component = self.target_component
                 #send centrepoint  to fence[0] as the return point
                 bounds = mp_util.polygon_bounds(layer.points)
                 (lat, lon, width, height) = bounds
                 center = (lat+width/2, lon+height/2)
-                self.fenceloader.add_latlon(center[0], center[1])
+                loader.add_latlon(center[0], center[1])
                 for lat, lon in layer.points:
                     #add point
-                    self.fenceloader.add_latlon(lat, lon)
-                #and send
-                self.send_fence()
-
-    def send_fence(self):
-        '''send fence points from fenceloader. Taken from fence module'''
-        # must disable geo-fencing when loading
-        self.fenceloader.target_system = self.target_system
-        self.fenceloader.target_component = self.target_component
-        self.fenceloader.reindex()
-        action = self.get_mav_param('FENCE_ACTION', mavutil.mavlink.FENCE_ACTION_NONE)
-        self.param_set('FENCE_ACTION', mavutil.mavlink.FENCE_ACTION_NONE, 3)
-        self.param_set('FENCE_TOTAL', self.fenceloader.count(), 3)
-        for i in range(self.fenceloader.count()):
-            p = self.fenceloader.point(i)
-            self.master.mav.send(p)
-            p2 = self.fetch_fence_point(i)
-            if p2 is None:
-                self.param_set('FENCE_ACTION', action, 3)
-                return False
-            if (p.idx != p2.idx or
-                abs(p.lat - p2.lat) >= 0.00003 or
-                abs(p.lng - p2.lng) >= 0.00003):
-                print("Failed to send fence point %u" % i)
-                self.param_set('FENCE_ACTION', action, 3)
-                return False
-        self.param_set('FENCE_ACTION', action, 3)
-        return True
+                    loader.add_latlon(lat, lon)
+                #and send, without blocking
+                fencemod.send_fence()
+                fencemod.have_list = True
 
-    def fetch_fence_point(self ,i):
-        '''fetch one fence point. Taken from fence module'''
-        self.master.mav.fence_fetch_point_send(self.target_system,
-                                                    self.target_component, i)
-        tstart = time.time()
-        p = None
-        while time.time() - tstart < 3:
-            p = self.master.recv_match(type='FENCE_POINT', blocking=False)
-            if p is not None:
-                break
-            time.sleep(0.1)
-            continue
-        if p is None:
-            self.console.error("Failed to fetch point %u" % i)
-            return None
-        return p
-                                    
     def togglekml(self, layername):
         '''toggle the display of a kml'''
         #Strip quotation marks if neccessary
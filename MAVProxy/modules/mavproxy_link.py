@@ -7,10 +7,12 @@
 '''
 
 from pymavlink import mavutil
-import time, struct, math, sys, fnmatch, traceback, json
+import time, math, sys, fnmatch, traceback, json
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_forward
+from MAVProxy.modules.lib import mp_profile
 
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import *
@@ -49,6 +51,9 @@ class LinkModule(mp_module.MPModule):
         self.add_completion_function('(LINKS)', self.complete_links)
         self.add_completion_function('(LINK)', self.complete_links)
         self.last_altitude_announce = 0.0
+        # per message type list of (module, handler) for packet delivery
+        self.dispatch_table = {}
+        self.dispatch_generation = -1
 
         self.menu_added_console = False
         if mp_util.has_wxpython:
@@ -218,6 +223,7 @@ class LinkModule(mp_module.MPModule):
         conn.target_system = self.settings.target_system
         self.apply_link_attributes(conn, optional_attributes)
         self.mpstate.mav_master.append(conn)
+        self.mpstate.select_registry.add_connection(conn, 'master')
         self.status.counters['MasterIn'].append(0)
         try:
             mp_util.child_fd_list_add(conn.port.fileno())
@@ -274,6 +280,7 @@ class LinkModule(mp_module.MPModule):
             return
         conn = self.mpstate.mav_master[i]
         print("Removing link %s" % conn.address)
+        self.mpstate.select_registry.remove_connection(conn)
         try:
             try:
                 mp_util.child_fd_list_remove(conn.port.fileno())
@@ -296,6 +303,8 @@ class LinkModule(mp_module.MPModule):
 
     def master_send_callback(self, m, master):
         '''called on sending a message'''
+        # a failed write can reconnect the link or mark it dead
+        self.mpstate.select_registry.update_connection(master, 'master')
         if self.status.watch is not None:
             for msg_type in self.status.watch:
                 if fnmatch.fnmatch(m.get_type().upper(), msg_type.upper()):
@@ -306,7 +315,7 @@ class LinkModule(mp_module.MPModule):
         if mtype != 'BAD_DATA' and self.mpstate.logqueue:
             usec = self.get_usec()
             usec = (usec & ~3) | 3 # linknum 3
-            self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+            self.mpstate.logqueue.put_packet(usec, m.get_msgbuf())
 
     def handle_msec_timestamp(self, m, master):
         '''special handling for MAVLink packets with a time_boot_ms field'''
@@ -540,14 +549,39 @@ class LinkModule(mp_module.MPModule):
 
 
 
+    def packet_dispatch(self, mtype):
+        '''return list of (module, handler) that want a message type,
+        in module load order. Modules that have not subscribed to
+        specific types get everything'''
+        if self.dispatch_generation != self.mpstate.dispatch_generation:
+            self.dispatch_table = {}
+            self.dispatch_generation = self.mpstate.dispatch_generation
+        handlers = self.dispatch_table.get(mtype, None)
+        if handlers is not None:
+            return handlers
+        handlers = []
+        for (mod,pm) in self.mpstate.modules:
+            packet_handlers = getattr(mod, 'packet_handlers', None)
+            if packet_handlers is None:
+                if hasattr(mod, 'mavlink_packet'):
+                    handlers.append((mod, mod.mavlink_packet))
+            else:
+                for handler in packet_handlers.get(mtype, []):
+                    handlers.append((mod, handler))
+        self.dispatch_table[mtype] = handlers
+        return handlers
+
     def master_callback(self, m, master):
         '''process mavlink message m on master, sending any messages to recipients'''
 
         # see if it is handled by a specialised sysid connection
         sysid = m.get_srcSystem()
         mtype = m.get_type()
+        # fetch the packet buffer once and share it between all outputs
+        buf = mp_forward.packet_buffer(m)
+        forwarder = self.mpstate.forwarder
         if sysid in self.mpstate.sysid_outputs:
-            self.mpstate.sysid_outputs[sysid].write(m.get_msgbuf())
+            forwarder.send(self.mpstate.sysid_outputs[sysid], buf)
             if mtype == "GLOBAL_POSITION_INT":
                 for modname in 'map', 'asterix', 'NMEA', 'NMEA2':
                     mod = self.module(modname)
@@ -561,13 +595,12 @@ class LinkModule(mp_module.MPModule):
 
         if mtype == 'GLOBAL_POSITION_INT':
             # send GLOBAL_POSITION_INT to 2nd GCS for 2nd vehicle display
-            for sysid in self.mpstate.sysid_outputs:
-                self.mpstate.sysid_outputs[sysid].write(m.get_msgbuf())
+            forwarder.send_all(self.mpstate.sysid_outputs.values(), buf)
 
             if self.mpstate.settings.fwdpos:
                 for link in self.mpstate.mav_master:
                     if link != master:
-                        link.write(m.get_msgbuf())
+                        forwarder.send(link, buf)
 
         # and log them
         if mtype not in dataPackets and self.mpstate.logqueue:
@@ -575,7 +608,7 @@ class LinkModule(mp_module.MPModule):
             # delay in saved logs
             usec = self.get_usec()
             usec = (usec & ~3) | master.linknum
-            self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+            self.mpstate.logqueue.put_packet(usec, buf)
 
         # keep the last message of each type around
         self.status.msgs[mtype] = m
@@ -612,22 +645,28 @@ class LinkModule(mp_module.MPModule):
             # GCS
             if self.mpstate.settings.mavfwd_rate or mtype != 'REQUEST_DATA_STREAM':
                 if mtype not in self.no_fwd_types:
-                    for r in self.mpstate.mav_outputs:
-                        r.write(m.get_msgbuf())
+                    forwarder.send_outputs(self.mpstate.mav_outputs, mtype, buf)
 
             sysid = m.get_srcSystem()
             target_sysid = self.target_system
 
             # pass to modules
-            for (mod,pm) in self.mpstate.modules:
-                if not hasattr(mod, 'mavlink_packet'):
-                    continue
+            profiler = self.mpstate.profiler
+            timing = profiler.enabled
+            if timing:
+                t_start = mp_profile.clock()
+            for (mod,handler) in self.packet_dispatch(mtype):
                 if not mod.multi_vehicle and sysid != target_sysid:
                     # only pass packets not from our target to modules that
                     # have marked themselves as being multi-vehicle capable
                     continue
                 try:
-                    mod.mavlink_packet(m)
+                    if timing:
+                        t0 = mp_profile.clock()
+                        handler(m)
+                        profiler.packet_time(mod.name, mp_profile.clock() - t0)
+                    else:
+                        handler(m)
                 except Exception as msg:
                     if self.mpstate.settings.moddebug == 1:
                         print(msg)
@@ -635,6 +674,8 @@ class LinkModule(mp_module.MPModule):
                         exc_type, exc_value, exc_traceback = sys.exc_info()
                         traceback.print_exception(exc_type, exc_value, exc_traceback,
                                                   limit=2, file=sys.stdout)
+            if timing:
+                profiler.mtype_time(mtype, mp_profile.clock() - t_start)
 
     def cmd_vehicle(self, args):
         '''handle vehicle commands'''
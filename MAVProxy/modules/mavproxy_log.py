@@ -1,14 +1,19 @@
 #!/usr/bin/env python
 '''log command handling'''
 
-import time, os
+import time, os, threading
+
+from pymavlink import mavutil
 
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import mp_tlogindex
 
 class LogModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(LogModule, self).__init__(mpstate, "log", "log transfer")
         self.add_command('log', self.cmd_log, "log file handling", ['<download|status|erase|resume|cancel|list>'])
+        self.add_command('tlog', self.cmd_tlog, "telemetry log handling", ['index (FILENAME)',
+                                                                          'info (FILENAME)'])
         self.reset()
 
     def reset(self):
@@ -156,6 +161,53 @@ class LogModule(mp_module.MPModule):
     def default_log_filename(self, log_num):
         return "log%u.bin" % log_num
 
+    def cmd_tlog(self, args):
+        '''telemetry log commands'''
+        usage = "usage: tlog <index|info> FILENAME..."
+        if len(args) < 2:
+            print(usage)
+            return
+        if args[0] == "index":
+            # index in the background so the main loop keeps running
+            t = threading.Thread(target=self.tlog_index, args=(args[1:],), name='tlog_index')
+            t.daemon = True
+            t.start()
+        elif args[0] == "info":
+            for filename in args[1:]:
+                self.tlog_info(filename)
+        else:
+            print(usage)
+
+    def tlog_index(self, filenames):
+        '''build sidecar indexes for existing tlogs'''
+        for filename in filenames:
+            if not os.path.exists(filename):
+                print("No such file %s" % filename)
+                continue
+            t0 = time.time()
+            try:
+                count = mp_tlogindex.build_index(filename)
+            except Exception as ex:
+                print("Failed to index %s: %s" % (filename, ex))
+                continue
+            print("Indexed %u packets in %s in %.1fs" % (count, filename, time.time() - t0))
+
+    def tlog_info(self, filename):
+        '''show the contents of a tlog index'''
+        index = mp_tlogindex.load_index(filename)
+        if index is None:
+            print("No usable index for %s, use tlog index" % filename)
+            return
+        print("%s: %u index blocks" % (filename, len(index.block_usec)))
+        mavlink_map = getattr(mavutil.mavlink, 'mavlink_map', {})
+        for msgid in index.msgids():
+            if msgid in mavlink_map:
+                mclass = mavlink_map[msgid]
+                name = getattr(mclass, 'msgname', None) or mclass.name
+            else:
+                name = str(msgid)
+            print("  %-30s %u" % (name, index.count(msgid)))
+
     def cmd_log(self, args):
         '''log commands'''
         usage = "usage: log <list|download|erase|resume|status|cancel>"
@@ -7,6 +7,7 @@ June 2012
 
 import sys, os, math
 import functools
+import threading
 import time
 from MAVProxy.modules.mavproxy_map import mp_elevation
 from MAVProxy.modules.lib import mp_util
@@ -43,6 +44,8 @@ class MapModule(mp_module.MPModule):
         self.last_unload_check_time = time.time()
         self.unload_check_interval = 0.1 # seconds
         self.trajectory_layers = set()
+        self.seeder = None
+        self.seed_thread = None
         self.map_settings = mp_settings.MPSettings(
             [ ('showgpspos', int, 1),
               ('showgps2pos', int, 1),
@@ -73,7 +76,9 @@ class MapModule(mp_module.MPModule):
                                                                 'set (MAPSETTING)',
                                                                 'zoom',
                                                                 'center',
-                                                                'follow'])
+                                                                'follow',
+                                                                'seed',
+                                                                'status'])
         self.add_completion_function('(MAPSETTING)', self.map_settings.completion)
 
         self.default_popup = MPMenuSubMenu('Popup', items=[])
@@ -174,6 +179,10 @@ class MapModule(mp_module.MPModule):
             self.cmd_center(args)
         elif args[0] == "follow":
             self.cmd_follow(args)
+        elif args[0] == "seed":
+            self.cmd_seed(args[1:])
+        elif args[0] == "status":
+            print(self.map.ipc_status())
         else:
             print("usage: map <icon|set>")
 
@@ -608,6 +617,77 @@ class MapModule(mp_module.MPModule):
         lon = float(args[2])
         self.map.set_center(lat, lon)
 
+    def cmd_seed(self, args):
+        '''pre-seed the tile cache for offline use'''
+        from MAVProxy.modules.mavproxy_map import mp_tileseed
+        usage = "usage: map seed <bbox LAT1 LON1 LAT2 LON2|polygon FILE|mission|fence> [MINZOOM MAXZOOM [BUFFER]]|status|stop"
+        if len(args) < 1:
+            print(usage)
+            return
+        if args[0] == "status":
+            if self.seeder is None:
+                print("No tile seeding")
+                return
+            (done, total) = self.seeder.progress()
+            print("%s: %u/%u tiles, %u/%u SRTM tiles" % (
+                "Seeding" if self.seed_thread.is_alive() else "Seeded",
+                done, total, self.seeder.srtm_done, self.seeder.srtm_total))
+            return
+        if args[0] == "stop":
+            if self.seeder is not None:
+                self.seeder.stop()
+            return
+        if self.seed_thread is not None and self.seed_thread.is_alive():
+            print("Tile seeding already running")
+            return
+        try:
+            if args[0] == "bbox" and len(args) >= 5:
+                region = mp_tileseed.bbox_region(float(args[1]), float(args[2]),
+                                                 float(args[3]), float(args[4]))
+                args = args[5:]
+            elif args[0] == "polygon" and len(args) >= 2:
+                region = mp_tileseed.SeedRegion(mp_util.polygon_load(args[1]))
+                args = args[2:]
+            elif args[0] == "mission":
+                region = mp_tileseed.SeedRegion(self.module('wp').wploader.polygon(), closed=False)
+                args = args[1:]
+            elif args[0] == "fence":
+                region = mp_tileseed.SeedRegion(self.module('fence').fenceloader.polygon())
+                args = args[1:]
+            else:
+                print(usage)
+                return
+        except Exception as ex:
+            print("Unable to load seed area: %s" % ex)
+            return
+        min_zoom = 10
+        max_zoom = 17
+        region.buffer = 500
+        if len(args) >= 2:
+            min_zoom = int(args[0])
+            max_zoom = int(args[1])
+        if len(args) >= 3:
+            region.buffer = float(args[2])
+        from MAVProxy.modules.mavproxy_map import mp_tile
+        mt = mp_tile.MPTile(service=self.map.service)
+        self.seeder = mp_tileseed.TileSeeder(mt, region, min_zoom, max_zoom)
+        self.seed_thread = threading.Thread(target=self.seed_run, name='map_seed')
+        self.seed_thread.daemon = True
+        self.seed_thread.start()
+
+    def seed_run(self):
+        '''tile seeding thread'''
+        seeder = self.seeder
+        seeder.scan()
+        print("Seeding %s" % seeder.summary())
+        seeder.run()
+        if seeder.stopped:
+            print("Tile seeding stopped")
+            return
+        failed = seeder.seed_srtm(self.ElevationMap)
+        print("Tile seeding done: %u tiles fetched, %u failed, %u SRTM tiles unavailable" % (
+            seeder.mt.download_stats() + (len(failed),)))
+
     def cmd_follow(self, args):
         '''control following of vehicle'''
         if len(args) < 2:
@@ -23,7 +23,8 @@ class ElevationModel():
         if self.database == 'srtm':
             self.downloader = srtm.SRTMDownloader(offline=offline, debug=debug)
             self.downloader.loadFileList()
-            self.tileDict = dict()
+            # open tiles are shared between all ElevationModels
+            self.tileCache = srtm.tile_cache
 
         '''Use the Geoscience Australia database instead - watch for the correct database path'''
         if self.database == 'geoscience':
@@ -31,31 +32,61 @@ class ElevationModel():
             self.mappy = GAreader.ERMap()
             self.mappy.read_ermapper(os.path.join(os.environ['HOME'], './Documents/Elevation/Canberra/GSNSW_P756demg'))
 
+    def GetTile(self, latitude, longitude, timeout=0):
+        '''return the SRTM tile containing a lat/long pair, or None if not available'''
+        lat = int(numpy.floor(latitude))
+        lon = int(numpy.floor(longitude))
+        key = (self.downloader.cachedir, lat, lon)
+        tile = self.tileCache.get(key)
+        if tile is not None:
+            return tile
+        tile = self.downloader.getTile(lat, lon)
+        if tile == 0 and timeout > 0:
+            t0 = time.time()
+            while time.time() < t0+timeout and tile == 0:
+                time.sleep(0.1)
+                tile = self.downloader.getTile(lat, lon)
+        if tile == 0:
+            return None
+        self.tileCache.put(key, tile)
+        return tile
+
     def GetElevation(self, latitude, longitude, timeout=0):
         '''Returns the altitude (m ASL) of a given lat/long pair, or None if unknown'''
         if latitude is None or longitude is None:
             return None
         if self.database == 'srtm':
-            TileID = (numpy.floor(latitude), numpy.floor(longitude))
-            if TileID in self.tileDict:
-                alt = self.tileDict[TileID].getAltitudeFromLatLon(latitude, longitude)
-            else:
-                tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
-                if tile == 0:
-                    if timeout > 0:
-                        t0 = time.time()
-                        while time.time() < t0+timeout and tile == 0:
-                            tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
-                            if tile == 0:
-                                time.sleep(0.1)
-                if tile == 0:
-                    return None
-                self.tileDict[TileID] = tile
-                alt = tile.getAltitudeFromLatLon(latitude, longitude)
+            tile = self.GetTile(latitude, longitude, timeout)
+            if tile is None:
+                return None
+            alt = tile.getAltitudeFromLatLon(latitude, longitude)
         if self.database == 'geoscience':
              alt = self.mappy.getAltitudeAtPoint(latitude, longitude)
         return alt
 
+    def GetElevationArray(self, latitudes, longitudes, timeout=0):
+        '''Returns a numpy array of the altitudes (m ASL) of arrays of lat/long
+        pairs, with NaN where the altitude is unknown'''
+        lats = numpy.asarray(latitudes, dtype=float)
+        lons = numpy.asarray(longitudes, dtype=float)
+        alts = numpy.full(len(lats), numpy.nan)
+        if self.database != 'srtm':
+            for i in range(len(lats)):
+                alt = self.GetElevation(lats[i], lons[i], timeout)
+                if alt is not None:
+                    alts[i] = alt
+            return alts
+        # group the points by tile
+        tile_lat = numpy.floor(lats).astype(int)
+        tile_lon = numpy.floor(lons).astype(int)
+        keys = (tile_lat + 90) * 360 + (tile_lon + 180)
+        for key in numpy.unique(keys):
+            idx = numpy.nonzero(keys == key)[0]
+            tile = self.GetTile(lats[idx[0]], lons[idx[0]], timeout)
+            if tile is not None:
+                alts[idx] = tile.getAltitudeArray(lats[idx], lons[idx])
+        return alts
+
 
 if __name__ == "__main__":
 
@@ -65,6 +96,7 @@ if __name__ == "__main__":
     parser.add_option("--lon", type='float', default=149.509165, help="start longitude")
     parser.add_option("--database", type='string', default='srtm', help="elevation database")
     parser.add_option("--debug", action='store_true', help="enabled debugging")
+    parser.add_option("--benchmark", action='store_true', help="compare scalar and array lookup speed")
 
     (opts, args) = parser.parse_args()
 
@@ -73,6 +105,22 @@ if __name__ == "__main__":
     lat = opts.lat
     lon = opts.lon
 
+    if opts.benchmark:
+        if EleModel.GetElevation(lat, lon, timeout=10) is None:
+            print("Tile not available")
+            sys.exit(1)
+        lats = lat + numpy.random.uniform(-0.05, 0.05, 100000)
+        lons = lon + numpy.random.uniform(-0.05, 0.05, 100000)
+        t0 = time.time()
+        alts1 = [EleModel.GetElevation(lats[i], lons[i]) for i in range(len(lats))]
+        t1 = time.time()
+        alts2 = EleModel.GetElevationArray(lats, lons)
+        t2 = time.time()
+        print("scalar: %.0f points/s array: %.0f points/s max difference %.3fm" % (
+            len(lats)/(t1-t0), len(lats)/(t2-t1),
+            numpy.nanmax(numpy.abs(numpy.array(alts1, dtype=float) - alts2))))
+        sys.exit(0)
+
     '''Do a few lat/long pairs to demonstrate the caching
     Note the +0.000001 to the time. On faster PCs, the two time periods
     may in fact be equal, so we add a little extra time on the end to account for this'''
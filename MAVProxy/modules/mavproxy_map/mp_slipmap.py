@@ -6,9 +6,11 @@ Andrew Tridgell
 June 2012
 '''
 
+import collections
 import functools
 import math
 import os, sys
+import threading
 import time
 import cv2
 import numpy as np
@@ -24,6 +26,10 @@ from MAVProxy.modules.mavproxy_map.mp_slipmap_util import *
 class MPSlipMap():
     '''
     a generic map viewer widget for use in mavproxy
+
+    Updates are sent to the map process in batches, at most one batch
+    every batch_interval seconds. Within a batch only the latest
+    position of each object is kept
     '''
     def __init__(self,
                  title='SlipMap',
@@ -39,7 +45,8 @@ class MPSlipMap():
                  brightness=0,
                  elevation=False,
                  download=True,
-                 show_flightmode_legend=True):
+                 show_flightmode_legend=True,
+                 batch_interval=0.05):
 
         self.lat = lat
         self.lon = lon
@@ -67,6 +74,20 @@ class MPSlipMap():
         self.child.start()
         self._callbacks = set()
 
+        # pending updates for the next batch, created after the child
+        # is started as locks can't be passed to it
+        self.batch_interval = batch_interval
+        self._batch = collections.OrderedDict()
+        self._batch_seq = 0
+        self._batch_time = None
+        self._batch_lock = threading.Lock()
+        self._flush_timer = None
+        self._last_flush = 0
+        self.updates_queued = 0
+        self.updates_coalesced = 0
+        self.batches_sent = 0
+        self.ipc_stats = None
+
 
     def child_task(self):
         '''child process - this holds all the GUI elements'''
@@ -86,6 +107,9 @@ class MPSlipMap():
         state.layers = {}
         state.info = {}
         state.need_redraw = True
+        state.dirty_rects = []
+        state.dirty_objects = []
+        state.expiring = []
 
         self.app = wx.App(False)
         self.app.SetExitOnFrameDelete(True)
@@ -95,6 +119,7 @@ class MPSlipMap():
 
     def close(self):
         '''close the window'''
+        self.flush()
         self.close_window.release()
         count=0
         while self.child.is_alive() and count < 30: # 3 seconds to die...
@@ -110,37 +135,105 @@ class MPSlipMap():
         '''check if graph is still going'''
         return self.child.is_alive()
 
+    def coalesce_key(self, obj):
+        '''return the key under which an update replaces an earlier
+        pending update, or None if it never does'''
+        if isinstance(obj, SlipPosition):
+            return ('position', obj.key, obj.layer)
+        if isinstance(obj, (SlipCenter, SlipZoom, SlipBrightness, SlipFollow)):
+            return (obj.__class__.__name__,)
+        if isinstance(obj, (SlipFollowObject, SlipHideObject)):
+            return (obj.__class__.__name__, obj.key)
+        return None
+
+    def queue_update(self, obj):
+        '''queue an update for the next batch'''
+        with self._batch_lock:
+            key = self.coalesce_key(obj)
+            if key is None:
+                self._batch_seq += 1
+                key = self._batch_seq
+            elif key in self._batch:
+                # keep the latest, applied after everything queued before it
+                self._batch.pop(key)
+                self.updates_coalesced += 1
+            self._batch[key] = obj
+            self.updates_queued += 1
+            now = time.time()
+            if self._batch_time is None:
+                self._batch_time = now
+            if self._flush_timer is not None:
+                return
+            delay = self._last_flush + self.batch_interval - now
+            if delay > 0:
+                self._flush_timer = threading.Timer(delay, self.flush)
+                self._flush_timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        '''send pending updates to the map as one batch'''
+        with self._batch_lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if not self._batch:
+                return
+            batch = SlipBatch(list(self._batch.values()), self._batch_time)
+            self._batch = collections.OrderedDict()
+            self._batch_time = None
+            self._last_flush = time.time()
+            self.batches_sent += 1
+            self.object_queue.put(batch)
+
+    def queue_depth(self):
+        '''return the number of batches sent but not yet applied by
+        the map, as last reported by it'''
+        if self.ipc_stats is None:
+            return self.batches_sent
+        return self.batches_sent - self.ipc_stats.batches
+
+    def ipc_status(self):
+        '''return a description of the update batching'''
+        ret = "Map updates: %u queued, %u coalesced, %u batches, queue depth %u" % (
+            self.updates_queued, self.updates_coalesced, self.batches_sent, self.queue_depth())
+        if self.ipc_stats is not None:
+            s = self.ipc_stats
+            ret += "\nMap latency: p50 %.1fms p99 %.1fms max %.1fms over %u batches (%u updates)" % (
+                s.p50*1000, s.p99*1000, s.max*1000, s.batches, s.updates)
+        return ret
+
     def add_object(self, obj):
         '''add or update an object on the map'''
-        self.object_queue.put(obj)
+        self.queue_update(obj)
 
     def remove_object(self, key):
         '''remove an object on the map by key'''
-        self.object_queue.put(SlipRemoveObject(key))
+        self.queue_update(SlipRemoveObject(key))
 
     def set_zoom(self, ground_width):
         '''set ground width of view'''
-        self.object_queue.put(SlipZoom(ground_width))
+        self.queue_update(SlipZoom(ground_width))
 
     def set_center(self, lat, lon):
         '''set center of view'''
-        self.object_queue.put(SlipCenter((lat,lon)))
+        self.queue_update(SlipCenter((lat,lon)))
 
     def set_follow(self, enable):
         '''set follow on/off'''
-        self.object_queue.put(SlipFollow(enable))
+        self.queue_update(SlipFollow(enable))
 
     def set_follow_object(self, key, enable):
         '''set follow on/off on an object'''
-        self.object_queue.put(SlipFollowObject(key, enable))
+        self.queue_update(SlipFollowObject(key, enable))
         
     def hide_object(self, key, hide=True):
         '''hide an object on the map by key'''
-        self.object_queue.put(SlipHideObject(key, hide))
+        self.queue_update(SlipHideObject(key, hide))
 
     def set_position(self, key, latlon, layer='', rotation=0, label=None, colour=None):
         '''move an object on the map'''
-        self.object_queue.put(SlipPosition(key, latlon, layer, rotation, label, colour))
+        self.queue_update(SlipPosition(key, latlon, layer, rotation, label, colour))
 
     def event_count(self):
         '''return number of events waiting to be processed'''
@@ -148,15 +241,18 @@ class MPSlipMap():
 
     def set_layout(self, layout):
         '''set window layout'''
-        self.object_queue.put(layout)
+        self.queue_update(layout)
     
     def get_event(self):
         '''return next event or None'''
         if self.event_queue.qsize() == 0:
             return None
         evt = self.event_queue.get()
-        while isinstance(evt, win_layout.WinLayout):
-            win_layout.set_layout(evt, self.set_layout)
+        while isinstance(evt, (win_layout.WinLayout, SlipIPCStats)):
+            if isinstance(evt, SlipIPCStats):
+                self.ipc_stats = evt
+            else:
+                win_layout.set_layout(evt, self.set_layout)
             if self.event_queue.qsize() == 0:
                 return None
             evt = self.event_queue.get()
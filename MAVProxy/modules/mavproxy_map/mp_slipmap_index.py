@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+'''
+spatial index of slipmap objects
+
+Each slipmap layer keeps a grid index of the bounding boxes of its
+objects, so finding the objects in view only looks at the grid cells
+covered by the view rather than at every object in the layer. Bounding
+boxes are in the (lat, lon, dlat, dlon) form returned by
+SlipObject.bounds().
+'''
+
+import math
+
+from MAVProxy.modules.lib import mp_util
+
+class GridIndex(object):
+    '''index of bounding boxes on a grid of cells cell_size degrees
+    square. Boxes covering more than max_cells cells, and objects with
+    no bounds, are kept in separate sets and always returned as
+    candidates'''
+    def __init__(self, cell_size=0.01, max_cells=64):
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+        self.cells = {}
+        self.large = set()
+        self.unbounded = set()
+        self.bounds = {}
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def cell_range(self, bounds):
+        '''return (i1, j1, i2, j2) range of cells covered by bounds'''
+        (lat, lon, dlat, dlon) = bounds
+        cs = self.cell_size
+        return (int(math.floor(lat / cs)), int(math.floor(lon / cs)),
+                int(math.floor((lat + dlat) / cs)), int(math.floor((lon + dlon) / cs)))
+
+    def insert(self, key, bounds):
+        '''add or update the bounds of a key'''
+        if key in self.bounds:
+            self.remove(key)
+        if bounds is not None and (bounds[0] is None or bounds[1] is None):
+            bounds = None
+        self.bounds[key] = bounds
+        if bounds is None:
+            self.unbounded.add(key)
+            return
+        (i1, j1, i2, j2) = self.cell_range(bounds)
+        if (i2 - i1 + 1) * (j2 - j1 + 1) > self.max_cells:
+            self.large.add(key)
+            return
+        for i in range(i1, i2+1):
+            for j in range(j1, j2+1):
+                cell = self.cells.get((i, j), None)
+                if cell is None:
+                    cell = set()
+                    self.cells[(i, j)] = cell
+                cell.add(key)
+
+    def remove(self, key):
+        '''remove a key from the index'''
+        if key not in self.bounds:
+            return
+        bounds = self.bounds.pop(key)
+        if bounds is None:
+            self.unbounded.discard(key)
+            return
+        if key in self.large:
+            self.large.discard(key)
+            return
+        (i1, j1, i2, j2) = self.cell_range(bounds)
+        for i in range(i1, i2+1):
+            for j in range(j1, j2+1):
+                cell = self.cells.get((i, j), None)
+                if cell is not None:
+                    cell.discard(key)
+                    if not cell:
+                        self.cells.pop((i, j))
+
+    def clear(self):
+        self.cells = {}
+        self.large = set()
+        self.unbounded = set()
+        self.bounds = {}
+
+    def query(self, bounds):
+        '''return the set of keys with bounds overlapping a box, plus
+        the keys with no bounds'''
+        ret = set(self.unbounded)
+        (i1, j1, i2, j2) = self.cell_range(bounds)
+        ncells = (i2 - i1 + 1) * (j2 - j1 + 1)
+        if ncells >= len(self.bounds) - len(self.unbounded):
+            # the view covers more cells than there are objects
+            candidates = self.bounds.keys()
+        else:
+            candidates = set(self.large)
+            for i in range(i1, i2+1):
+                for j in range(j1, j2+1):
+                    cell = self.cells.get((i, j), None)
+                    if cell is not None:
+                        candidates.update(cell)
+        for key in candidates:
+            b = self.bounds[key]
+            if b is not None and mp_util.bounds_overlap(bounds, b):
+                ret.add(key)
+        return ret
+
+class SlipLayer(dict):
+    '''the objects of one slipmap layer, keyed by object key, with a
+    spatial index of their bounds. The index is updated as objects are
+    added and removed, and refresh() must be called after an object
+    has moved or been hidden'''
+    def __init__(self, cell_size=0.01):
+        dict.__init__(self)
+        self.index = GridIndex(cell_size)
+        self._sorted = None
+
+    def __setitem__(self, key, obj):
+        if key not in self:
+            self._sorted = None
+        dict.__setitem__(self, key, obj)
+        self.index.insert(key, obj.bounds())
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.index.remove(key)
+        self._sorted = None
+
+    def pop(self, key, *default):
+        if key not in self:
+            return dict.pop(self, key, *default)
+        obj = dict.pop(self, key)
+        self.index.remove(key)
+        self._sorted = None
+        return obj
+
+    def clear(self):
+        dict.clear(self)
+        self.index.clear()
+        self._sorted = None
+
+    def update(self, objects):
+        for key in objects:
+            self[key] = objects[key]
+
+    def refresh(self, key):
+        '''re-index an object after its bounds have changed'''
+        obj = self.get(key, None)
+        if obj is not None:
+            self.index.insert(key, obj.bounds())
+
+    def sorted_keys(self):
+        '''return the keys in drawing order'''
+        if self._sorted is None:
+            self._sorted = sorted(self.keys())
+        return self._sorted
+
+    def visible(self, bounds):
+        '''return the objects that may be visible in a bounding box, in
+        drawing order'''
+        keys = self.index.query(bounds)
+        if len(keys) == len(self):
+            return [self[k] for k in self.sorted_keys()]
+        return [self[k] for k in sorted(keys)]
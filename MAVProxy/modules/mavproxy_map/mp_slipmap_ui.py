@@ -1,4 +1,4 @@
-import functools
+import inspect
 import math
 from MAVProxy.modules.mavproxy_map import mp_elevation
 import numpy as np
@@ -7,6 +7,7 @@ import time
 
 from ..lib.wx_loader import wx
 
+from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipBatch
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipBrightness
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipCenter
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipClearLayer
@@ -16,6 +17,7 @@ from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipGrid
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipHideObject
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipIcon
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipInformation
+from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipIPCStats
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipKeyEvent
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipMenuEvent
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipMouseEvent
@@ -27,7 +29,11 @@ from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipThumbnail
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipZoom
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipFollow
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipFollowObject
+from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipPixelMapper
+from MAVProxy.modules.mavproxy_map.mp_slipmap_util import rect_overlap
+from MAVProxy.modules.mavproxy_map.mp_slipmap_index import SlipLayer
 
+from MAVProxy.modules.lib import mp_profile
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import win_layout
 
@@ -56,6 +62,28 @@ class MPSlipMapFrame(wx.Frame):
         state.panel = MPSlipMapPanel(self, state)
         self.last_layout_send = time.time()
         self.Bind(wx.EVT_IDLE, self.on_idle)
+        # handlers for objects from the parent, by class. Subclasses
+        # use the handler of their nearest base class
+        self.handlers = {
+            win_layout.WinLayout : self.handle_layout,
+            SlipObject : self.add_object,
+            SlipPosition : self.handle_position,
+            SlipDefaultPopup : self.handle_default_popup,
+            SlipInformation : self.handle_information,
+            SlipCenter : self.handle_center,
+            SlipZoom : self.handle_zoom,
+            SlipFollow : self.handle_follow,
+            SlipFollowObject : self.handle_follow_object,
+            SlipBrightness : self.handle_brightness,
+            SlipClearLayer : self.handle_clear_layer,
+            SlipRemoveObject : self.handle_remove_object,
+            SlipHideObject : self.handle_hide_object,
+            }
+        self.handler_cache = {}
+        self.batch_latency = mp_profile.TimingStats()
+        self.batch_count = 0
+        self.batch_updates = 0
+        self.batch_count_sent = 0
         self.Bind(wx.EVT_SIZE, state.panel.on_size)
         self.legend_checkbox_menuitem_added = False
         
@@ -174,14 +202,33 @@ class MPSlipMapFrame(wx.Frame):
                                                          checked=self.state.legend)
         ])
 
+    def mark_dirty(self, obj, changed=False):
+        '''note the map area of an object that is about to change, so
+        only the changed areas are repainted. With changed set the area
+        is found at the next redraw, after the change has been made'''
+        state = self.state
+        if changed:
+            state.dirty_objects.append(obj)
+            return
+        rect = obj.pixel_bounds(state.panel.pixmapper)
+        if rect is None:
+            state.need_redraw = True
+        else:
+            state.dirty_rects.append(rect)
+
     def add_object(self, obj):
         '''add an object to a layer'''
         state = self.state
         if not obj.layer in state.layers:
             # its a new layer
-            state.layers[obj.layer] = {}
+            state.layers[obj.layer] = SlipLayer()
+        old = state.layers[obj.layer].get(obj.key, None)
+        if old is not None:
+            self.mark_dirty(old)
         state.layers[obj.layer][obj.key] = obj
-        state.need_redraw = True
+        self.mark_dirty(obj, changed=True)
+        if obj.expires() is not None:
+            state.expiring.append(obj)
         if (not self.legend_checkbox_menuitem_added and
             isinstance(obj, SlipFlightModeLegend)):
             self.add_legend_checkbox_menuitem()
@@ -192,9 +239,127 @@ class MPSlipMapFrame(wx.Frame):
         '''remove an object by key from all layers'''
         state = self.state
         for layer in state.layers:
-            state.layers[layer].pop(key, None)
+            obj = state.layers[layer].pop(key, None)
+            if obj is not None:
+                self.mark_dirty(obj)
+
+    def handler(self, cls):
+        '''return the handler for a class of object, or None'''
+        if cls in self.handler_cache:
+            return self.handler_cache[cls]
+        ret = None
+        for base in inspect.getmro(cls):
+            if base in self.handlers:
+                ret = self.handlers[base]
+                break
+        self.handler_cache[cls] = ret
+        return ret
+
+    def apply(self, obj):
+        '''apply one object from the parent'''
+        handler = self.handler(obj.__class__)
+        if handler is not None:
+            handler(obj)
+
+    def apply_batch(self, batch):
+        '''apply a batch of objects from the parent'''
+        for obj in batch.items:
+            self.apply(obj)
+        self.batch_latency.add(time.time() - batch.queued)
+        self.batch_count += 1
+        self.batch_updates += len(batch.items)
+
+    def handle_layout(self, obj):
+        win_layout.set_wx_window_layout(self, obj)
+
+    def handle_position(self, obj):
+        '''move an object'''
+        state = self.state
+        object = self.find_object(obj.key, obj.layer)
+        if object is not None:
+            self.mark_dirty(object)
+            object.update_position(obj)
+            state.layers[object.layer].refresh(object.key)
+            if getattr(object, 'follow', False):
+                self.follow(object)
+            if obj.label is not None:
+                object.label = obj.label
+            if obj.colour is not None:
+                object.colour = obj.colour
+            self.mark_dirty(object, changed=True)
+
+    def handle_default_popup(self, obj):
+        self.state.default_popup = obj
+
+    def handle_information(self, obj):
+        state = self.state
+        # see if its a existing one or a new one
+        if obj.key in state.info:
+            state.info[obj.key].update(obj)
+        else:
+            state.info[obj.key] = obj
+        state.need_redraw = True
+
+    def handle_center(self, obj):
+        '''move center'''
+        state = self.state
+        (lat,lon) = obj.latlon
+        state.panel.re_center(state.width/2, state.height/2, lat, lon)
+        state.need_redraw = True
+
+    def handle_zoom(self, obj):
+        '''change zoom'''
+        self.state.panel.set_ground_width(obj.ground_width)
+        self.state.need_redraw = True
+
+    def handle_follow(self, obj):
+        '''enable/disable follow'''
+        self.state.follow = obj.enable
+
+    def handle_follow_object(self, obj):
+        '''enable/disable follow on an object'''
+        state = self.state
+        for layer in state.layers:
+            if obj.key in state.layers[layer]:
+                if hasattr(state.layers[layer][obj.key], 'follow'):
+                    state.layers[layer][obj.key].follow = obj.enable
+
+    def handle_brightness(self, obj):
+        '''set map brightness'''
+        self.state.brightness = obj.brightness
+        self.state.need_redraw = True
+
+    def handle_clear_layer(self, obj):
+        '''remove all objects from a layer'''
+        state = self.state
+        if obj.layer in state.layers:
+            state.layers.pop(obj.layer)
         state.need_redraw = True
 
+    def handle_remove_object(self, obj):
+        '''remove an object by key'''
+        self.remove_object(obj.key)
+
+    def handle_hide_object(self, obj):
+        '''hide an object by key'''
+        state = self.state
+        for layer in state.layers:
+            if obj.key in state.layers[layer]:
+                object = state.layers[layer][obj.key]
+                self.mark_dirty(object)
+                object.set_hidden(obj.hide)
+                state.layers[layer].refresh(obj.key)
+                self.mark_dirty(object, changed=True)
+
+    def send_ipc_stats(self):
+        '''send batch statistics to the parent'''
+        if self.batch_count == self.batch_count_sent:
+            return
+        self.batch_count_sent = self.batch_count
+        s = self.batch_latency
+        self.state.event_queue.put(SlipIPCStats(self.batch_count, self.batch_updates,
+                                                s.percentile(50), s.percentile(99), s.max))
+
     def on_idle(self, event):
         '''prevent the main loop spinning too fast'''
         state = self.state
@@ -206,91 +371,17 @@ class MPSlipMapFrame(wx.Frame):
         if now - self.last_layout_send > 1:
             self.last_layout_send = now
             state.event_queue.put(win_layout.get_wx_window_layout(self))
+            self.send_ipc_stats()
 
         # receive any display objects from the parent
         obj = None
 
         while not state.object_queue.empty():
             obj = state.object_queue.get()
-
-            if isinstance(obj, win_layout.WinLayout):
-                win_layout.set_wx_window_layout(self, obj)
-                
-            if isinstance(obj, SlipObject):
-                self.add_object(obj)
-
-            if isinstance(obj, SlipPosition):
-                # move an object
-                object = self.find_object(obj.key, obj.layer)
-                if object is not None:
-                    object.update_position(obj)
-                    if getattr(object, 'follow', False):
-                        self.follow(object)
-                    if obj.label is not None:
-                        object.label = obj.label
-                    if obj.colour is not None:
-                        object.colour = obj.colour
-                    state.need_redraw = True
-
-            if isinstance(obj, SlipDefaultPopup):
-                state.default_popup = obj
-
-            if isinstance(obj, SlipInformation):
-                # see if its a existing one or a new one
-                if obj.key in state.info:
-#                    print('update %s' % str(obj.key))
-                    state.info[obj.key].update(obj)
-                else:
-#                    print('add %s' % str(obj.key))
-                    state.info[obj.key] = obj
-                state.need_redraw = True
-
-            if isinstance(obj, SlipCenter):
-                # move center
-                (lat,lon) = obj.latlon
-                state.panel.re_center(state.width/2, state.height/2, lat, lon)
-                state.need_redraw = True
-
-            if isinstance(obj, SlipZoom):
-                # change zoom
-                state.panel.set_ground_width(obj.ground_width)
-                state.need_redraw = True
-                
-            if isinstance(obj, SlipFollow):
-                # enable/disable follow
-                state.follow = obj.enable
-
-            if isinstance(obj, SlipFollowObject):
-                # enable/disable follow on an object
-                for layer in state.layers:
-                    if obj.key in state.layers[layer]:
-                        if hasattr(state.layers[layer][obj.key], 'follow'):
-                            state.layers[layer][obj.key].follow = obj.enable
-                
-            if isinstance(obj, SlipBrightness):
-                # set map brightness
-                state.brightness = obj.brightness
-                state.need_redraw = True
-
-            if isinstance(obj, SlipClearLayer):
-                # remove all objects from a layer
-                if obj.layer in state.layers:
-                    state.layers.pop(obj.layer)
-                state.need_redraw = True
-
-            if isinstance(obj, SlipRemoveObject):
-                # remove an object by key
-                for layer in state.layers:
-                    if obj.key in state.layers[layer]:
-                        state.layers[layer].pop(obj.key)
-                state.need_redraw = True
-
-            if isinstance(obj, SlipHideObject):
-                # hide an object by key
-                for layer in state.layers:
-                    if obj.key in state.layers[layer]:
-                        state.layers[layer][obj.key].set_hidden(obj.hide)
-                state.need_redraw = True
+            if isinstance(obj, SlipBatch):
+                self.apply_batch(obj)
+            else:
+                self.apply(obj)
 
         if obj is None:
             time.sleep(0.05)
@@ -306,6 +397,7 @@ class MPSlipMapPanel(wx.Panel):
         self.state = state
         self.img = None
         self.map_img = None
+        self.base_img = None
         self.redraw_timer = wx.Timer(self)
         self.Bind(wx.EVT_TIMER, self.on_redraw_timer, self.redraw_timer)
         self.Bind(wx.EVT_SET_FOCUS, self.on_focus)
@@ -353,7 +445,7 @@ class MPSlipMapPanel(wx.Panel):
         self.imagePanel.Bind(wx.EVT_MOUSEWHEEL, self.on_mouse_wheel)
 
         # a function to convert from (lat,lon) to (px,py) on the map
-        self.pixmapper = functools.partial(self.pixel_coords)
+        self.pixmapper = SlipPixelMapper(self.pixel_coords, self.projection_view, self.projection)
 
         self.last_view = None
         self.redraw_map()
@@ -367,7 +459,19 @@ class MPSlipMapPanel(wx.Panel):
         '''return a tuple representing the current view'''
         state = self.state
         return (state.lat, state.lon, state.width, state.height,
-                state.ground_width, state.mt.tiles_pending())
+                state.ground_width, state.mt.tiles_pending(),
+                state.mt.tile_updates(), state.brightness,
+                state.mt.get_service(), state.download)
+
+    def projection(self):
+        '''return the projection from (lat,lon) to the map image'''
+        state = self.state
+        return state.mt.area_projection(state.lat, state.lon, state.width, state.ground_width)
+
+    def projection_view(self):
+        '''return a tuple that changes whenever pixel coordinates change'''
+        state = self.state
+        return (state.lat, state.lon, state.width, state.ground_width)
 
     def coordinates(self, x, y):
         '''return coordinates of a pixel in the map'''
@@ -466,52 +570,115 @@ class MPSlipMapPanel(wx.Panel):
         (lat,lon) = (latlon[0], latlon[1])
         return state.mt.coord_to_pixel(state.lat, state.lon, state.width, state.ground_width, lat, lon)
 
-    def draw_objects(self, objects, bounds, img):
-        '''draw objects on the image'''
-        keys = sorted(objects.keys())
-        for k in keys:
-            obj = objects[k]
+    def draw_objects(self, objects, bounds, img, rects=None):
+        '''draw objects on the image. If rects is given only objects
+        that may draw within one of those pixel rectangles are drawn'''
+        for obj in objects.visible(bounds):
             if not self.state.legend and isinstance(obj, SlipFlightModeLegend):
                 continue
-            bounds2 = obj.bounds()
-            if bounds2 is None or mp_util.bounds_overlap(bounds, bounds2):
-                obj.draw(img, self.pixmapper, bounds)
+            if rects is not None:
+                r = obj.pixel_bounds(self.pixmapper)
+                if r is not None and not any(rect_overlap(r, r2) for r2 in rects):
+                    continue
+            obj.draw(img, self.pixmapper, bounds)
+
+    def dirty_rects(self):
+        '''return the pixel rectangles that need repainting, clipped
+        to the image, or None if a full redraw is needed'''
+        state = self.state
+        rects = list(state.dirty_rects)
+        for obj in state.dirty_objects:
+            r = obj.pixel_bounds(self.pixmapper)
+            if r is None:
+                return None
+            rects.append(r)
+        ret = []
+        area = 0
+        for (x1, y1, x2, y2) in rects:
+            (x1, y1) = (max(x1, 0), max(y1, 0))
+            (x2, y2) = (min(x2, state.width), min(y2, state.height))
+            if x2 > x1 and y2 > y1:
+                ret.append((x1, y1, x2, y2))
+                area += (x2 - x1) * (y2 - y1)
+        if area > state.width * state.height // 2:
+            # cheaper to redraw everything
+            return None
+        return ret
+
+    def redraw_dirty(self, bounds):
+        '''repaint the areas of objects that have changed. Returns
+        False if a full redraw is needed'''
+        state = self.state
+        if self.img is None or self.base_img is None or self.img.shape != self.base_img.shape:
+            return False
+        rects = self.dirty_rects()
+        if rects is None:
+            return False
+        if not rects:
+            return True
+        img = self.base_img.copy()
+        for k in sorted(state.layers.keys()):
+            self.draw_objects(state.layers[k], bounds, img, rects)
+        for (x1, y1, x2, y2) in rects:
+            self.img[y1:y2, x1:x2] = img[y1:y2, x1:x2]
+        return True
+
+    def check_expired(self):
+        '''repaint the areas of objects that have stopped being drawn
+        since the last redraw, such as a click location with a timeout'''
+        state = self.state
+        if not state.expiring:
+            return
+        now = time.time()
+        for obj in state.expiring[:]:
+            if now > obj.expires():
+                state.expiring.remove(obj)
+                state.dirty_objects.append(obj)
 
     def redraw_map(self):
         '''redraw the map with current settings'''
         state = self.state
 
+        self.check_expired()
+
         view_same = (self.last_view is not None and self.map_img is not None and self.last_view == self.current_view())
 
-        if view_same and not state.need_redraw:
+        if view_same and not state.need_redraw and not state.dirty_rects and not state.dirty_objects:
             return
 
-        # get the new map
-        self.map_img = state.mt.area_to_image(state.lat, state.lon,
-                                              state.width, state.height, state.ground_width)
-        if state.brightness != 0: # valid state.brightness range is [-255, 255]
-            brightness = np.uint8(np.abs(state.brightness))
-            if state.brightness > 0:
-                self.map_img = np.where((255 - self.map_img) < brightness, 255, self.map_img + brightness)
-            else:
-                self.map_img = np.where((255 + self.map_img) < brightness, 0, self.map_img - brightness)
-            
+        # get the new map. When only objects have changed the composited
+        # map is reused
+        if not view_same:
+            self.map_img = state.mt.area_to_image(state.lat, state.lon,
+                                                  state.width, state.height, state.ground_width)
+            if state.brightness != 0: # valid state.brightness range is [-255, 255]
+                brightness = np.uint8(np.abs(state.brightness))
+                if state.brightness > 0:
+                    self.map_img = np.where((255 - self.map_img) < brightness, 255, self.map_img + brightness)
+                else:
+                    self.map_img = np.where((255 + self.map_img) < brightness, 0, self.map_img - brightness)
+
         # find display bounding box
         (lat2,lon2) = self.coordinates(state.width-1, state.height-1)
         bounds = (lat2, state.lon, state.lat-lat2, lon2-state.lon)
 
-        # get the image
-        img = self.map_img.copy()
+        # when only some objects have changed, repaint just their areas
+        if not view_same or state.need_redraw or not self.redraw_dirty(bounds):
+            # get the image
+            img = self.map_img.copy()
 
-        # possibly draw a grid
-        if state.grid:
-            SlipGrid('grid', layer=3, linewidth=1, colour=(255,255,0)).draw(img, self.pixmapper, bounds)
+            # possibly draw a grid
+            if state.grid:
+                SlipGrid('grid', layer=3, linewidth=1, colour=(255,255,0)).draw(img, self.pixmapper, bounds)
+            self.base_img = img.copy()
 
-        # draw layer objects
-        keys = state.layers.keys()
-        keys = sorted(list(keys))
-        for k in keys:
-            self.draw_objects(state.layers[k], bounds, img)
+            # draw layer objects
+            keys = state.layers.keys()
+            keys = sorted(list(keys))
+            for k in keys:
+                self.draw_objects(state.layers[k], bounds, img)
+            self.img = img
+        img = self.img
 
         # draw information objects
         for key in state.info:
@@ -527,6 +694,8 @@ class MPSlipMapPanel(wx.Panel):
         self.last_view = self.current_view()
         self.SetFocus()
         state.need_redraw = False
+        state.dirty_rects = []
+        state.dirty_objects = []
 
     def on_redraw_timer(self, event):
         '''the redraw timer ensures we show new map tiles as they
@@ -23,7 +23,108 @@ def image_shape(img):
     if hasattr(img, 'shape'):
         return (img.shape[1], img.shape[0])
     return (img.width, img.height)
-    
+
+def rect_union(r1, r2):
+    '''union of two (x1,y1,x2,y2) pixel rectangles, either of which may be None'''
+    if r1 is None:
+        return r2
+    if r2 is None:
+        return r1
+    return (min(r1[0], r2[0]), min(r1[1], r2[1]), max(r1[2], r2[2]), max(r1[3], r2[3]))
+
+def rect_overlap(r1, r2):
+    '''return true if two (x1,y1,x2,y2) pixel rectangles overlap'''
+    return r1[0] < r2[2] and r2[0] < r1[2] and r1[1] < r2[3] and r2[1] < r1[3]
+
+def points_rect(pixels, margin):
+    '''bounding pixel rectangle of a list of (x,y) pixels plus a margin'''
+    if not pixels:
+        return None
+    xs = [ p[0] for p in pixels ]
+    ys = [ p[1] for p in pixels ]
+    return (min(xs)-margin, min(ys)-margin, max(xs)+margin+1, max(ys)+margin+1)
+
+def array_rect(pixels, margin):
+    '''bounding pixel rectangle of an Nx2 array of pixels plus a margin'''
+    if len(pixels) == 0:
+        return None
+    (x1, y1) = pixels.min(axis=0)
+    (x2, y2) = pixels.max(axis=0)
+    return (int(x1)-margin, int(y1)-margin, int(x2)+margin+1, int(y2)+margin+1)
+
+_circle_offsets = {}
+
+def circle_offsets(radius):
+    '''return (dx, dy) arrays of the pixels of a circle outline as
+    drawn by cv2.circle, relative to its centre'''
+    if radius not in _circle_offsets:
+        size = 2*radius + 3
+        mask = np.zeros((size, size), np.uint8)
+        cv2.circle(mask, (radius+1, radius+1), radius, 255)
+        (dy, dx) = np.nonzero(mask)
+        _circle_offsets[radius] = (dx - radius - 1, dy - radius - 1)
+    return _circle_offsets[radius]
+
+def draw_circles(img, pixels, radius, colour):
+    '''draw circle outlines of the same radius and colour centred on
+    an Nx2 array of pixels, as cv2.circle would'''
+    (dx, dy) = circle_offsets(radius)
+    (width, height) = image_shape(img)
+    # only centres close enough to touch the image, each drawn once
+    x = pixels[:,0].astype(np.int64)
+    y = pixels[:,1].astype(np.int64)
+    near = (x >= -radius) & (x < width+radius) & (y >= -radius) & (y < height+radius)
+    centres = np.unique((y[near] + radius) * (width + 2*radius) + (x[near] + radius))
+    if len(centres) * len(dx) > width * height:
+        # dense centres: stamp the outline on a mask of the centres
+        mask = np.zeros((height+2*radius, width+2*radius), np.uint8)
+        mask.ravel()[centres] = 1
+        kernel = np.zeros((2*radius+1, 2*radius+1), np.uint8)
+        kernel[radius-dy, radius-dx] = 1
+        mask = cv2.dilate(mask, kernel)[radius:radius+height, radius:radius+width]
+        img[mask != 0] = colour
+        return
+    x = centres % (width + 2*radius) - radius
+    y = centres // (width + 2*radius) - radius
+    xs = (x[:,None] + dx[None,:]).ravel()
+    ys = (y[:,None] + dy[None,:]).ravel()
+    inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    img[ys[inside], xs[inside]] = colour
+
+# lists of at most this many points are projected and drawn one point
+# at a time, which is quicker than the array code for a handful of points
+SHORT_POLYGON = 32
+
+def latlon_array(points):
+    '''return an Nx2 array of lat/lon from a list of points, which may
+    have extra elements such as a colour'''
+    return np.array([ (p[0], p[1]) for p in points ], dtype=float).reshape(-1, 2)
+
+def project_points(pixmapper, points):
+    '''return an Nx2 integer array of pixels for a list of points'''
+    if hasattr(pixmapper, 'project_array') and len(points) > SHORT_POLYGON:
+        return pixmapper.project_array(latlon_array(points))
+    return np.array([ pixmapper(p) for p in points ], dtype=np.int32).reshape(-1, 2)
+
+class SlipPixelMapper(object):
+    '''convert (lat,lon) to pixel coordinates on the map image.
+    view() returns a key which changes whenever the projection changes,
+    so objects can keep their projected points until then'''
+    def __init__(self, pixel_coords, view, projection=None):
+        self.pixel_coords = pixel_coords
+        self.view = view
+        if projection is not None:
+            self.projection = projection
+
+    def __call__(self, latlon, reverse=False):
+        return self.pixel_coords(latlon, reverse)
+
+    def project_array(self, latlon):
+        '''convert an Nx2 array of lat/lon to pixels'''
+        if hasattr(self, 'projection'):
+            return self.projection().project_array(latlon)
+        return np.array([ self.pixel_coords(p) for p in latlon ], dtype=np.int32).reshape(-1, 2)
+
 
 class SlipObject:
     '''an object to display on the map'''
@@ -58,6 +159,11 @@ class SlipObject:
         '''default draw method'''
         pass
 
+    def expires(self):
+        '''return the time after which the object is no longer drawn,
+        or None if it does not change with time'''
+        return None
+
     def update_position(self, newpos):
         '''update object position'''
         if getattr(self, 'trail', None) is not None:
@@ -81,6 +187,37 @@ class SlipObject:
         '''return bounding box or None'''
         return None
 
+    def pixel_bounds(self, pixmapper):
+        '''return the (x1,y1,x2,y2) pixel rectangle the object draws
+        in, or None if not known'''
+        return None
+
+    def project(self, pixmapper, points):
+        '''return pixel coordinates of a list of points, cached until
+        the view changes'''
+        view = pixmapper.view() if hasattr(pixmapper, 'view') else None
+        cache = getattr(self, '_pix_cache', None)
+        if (view is not None and cache is not None and cache[0] == view and
+            (cache[1] is points or cache[1] == points)):
+            return cache[2]
+        pixels = [ pixmapper(p) for p in points ]
+        if view is not None:
+            self._pix_cache = (view, points, pixels)
+        return pixels
+
+    def project_array(self, pixmapper, points):
+        '''return an Nx2 array of pixels for a list of points, cached
+        until the view or the list changes. Pixmappers with a
+        project_array method convert all the points in one call'''
+        view = pixmapper.view() if hasattr(pixmapper, 'view') else None
+        cache = getattr(self, '_pix_array_cache', None)
+        if view is not None and cache is not None and cache[0] == view and cache[1] is points:
+            return cache[2]
+        pixels = project_points(pixmapper, points)
+        if view is not None:
+            self._pix_array_cache = (view, points, pixels)
+        return pixels
+
     def set_hidden(self, hidden):
         '''set hidden attribute'''
         self.hidden = hidden
@@ -94,9 +231,14 @@ class SlipLabel(SlipObject):
         self.label = label
 
     def draw_label(self, img, pixmapper):
-        pix1 = pixmapper(self.point)
+        pix1 = self.project(pixmapper, [self.point])[0]
         cv2.putText(img, self.label, pix1, cv2.FONT_HERSHEY_SIMPLEX, 0.5, self.colour)
 
+    def pixel_bounds(self, pixmapper):
+        (px, py) = self.project(pixmapper, [self.point])[0]
+        ((tw, th), baseline) = cv2.getTextSize(self.label, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)
+        return (px-1, py-th-2, px+tw+2, py+baseline+2)
+
     def draw(self, img, pixmapper, bounds):
         if self.hidden:
             return
@@ -149,17 +291,27 @@ class SlipCircle(SlipObject):
         self.linewidth = linewidth
         self.arrow = arrow
 
-    def draw(self, img, pixmapper, bounds):
-        if self.hidden:
-            return
-        center_px = pixmapper(self.latlon)
+    def pixel_circle(self, pixmapper):
+        '''return centre and radius in pixels'''
         # figure out pixels per meter
         ref_pt = (self.latlon[0] + 1.0, self.latlon[1])
+        (center_px, ref_px) = self.project(pixmapper, [self.latlon, ref_pt])
         dis = mp_util.gps_distance(self.latlon[0], self.latlon[1], ref_pt[0], ref_pt[1])
-        ref_px = pixmapper(ref_pt)
         dis_px = math.sqrt(float(center_px[1] - ref_px[1]) ** 2.0)
         pixels_per_meter = dis_px / dis
-        radius_px = int(self.radius * pixels_per_meter)
+        return (center_px, int(self.radius * pixels_per_meter))
+
+    def pixel_bounds(self, pixmapper):
+        (center_px, radius_px) = self.pixel_circle(pixmapper)
+        margin = radius_px + self.linewidth + 2
+        if self.arrow:
+            margin += 12
+        return points_rect([center_px], margin)
+
+    def draw(self, img, pixmapper, bounds):
+        if self.hidden:
+            return
+        (center_px, radius_px) = self.pixel_circle(pixmapper)
         cv2.circle(img, center_px, radius_px, self.color, self.linewidth)
         if self.arrow:
             SlipArrow(self.key, self.layer, (center_px[0]-radius_px, center_px[1]),
@@ -182,7 +334,9 @@ class SlipPolygon(SlipObject):
         self.linewidth = linewidth
         self.arrow = arrow
         self._bounds = mp_util.polygon_bounds(self.points)
-        self._pix_points = []
+        self._pix_array = None
+        self._pix_visible = None
+        self._segment_colours = None
         self._selected_vertex = None
 
     def bounds(self):
@@ -191,6 +345,36 @@ class SlipPolygon(SlipObject):
             return None
         return self._bounds
 
+    def pixel_bounds(self, pixmapper):
+        pixels = self.project_array(pixmapper, self.points)
+        cache = getattr(self, '_rect_cache', None)
+        if cache is not None and cache[0] is pixels:
+            return cache[1]
+        margin = self.linewidth*2 + 2
+        if self.arrow:
+            margin += 12
+        rect = array_rect(pixels, margin)
+        self._rect_cache = (pixels, rect)
+        return rect
+
+    def segment_colours(self):
+        '''return (ids, palette) for the line segments. ids gives the
+        palette index of each segment, and palette entries of None use
+        the polygon colour'''
+        if self._segment_colours is None:
+            palette = [None]
+            index = {}
+            ids = np.zeros(max(len(self.points)-1, 0), dtype=int)
+            for i in range(len(self.points)-1):
+                if len(self.points[i]) > 2:
+                    colour = tuple(self.points[i][2])
+                    if colour not in index:
+                        index[colour] = len(palette)
+                        palette.append(colour)
+                    ids[i] = index[colour]
+            self._segment_colours = (ids, palette)
+        return self._segment_colours
+
     def draw_line(self, img, pixmapper, pt1, pt2, colour, linewidth):
         '''draw a line on the image'''
         pix1 = pixmapper(pt1)
@@ -198,49 +382,85 @@ class SlipPolygon(SlipObject):
         (width, height) = image_shape(img)
         (ret, pix1, pix2) = cv2.clipLine((0, 0, width, height), pix1, pix2)
         if ret is False:
-            if len(self._pix_points) == 0:
-                self._pix_points.append(None)
-            self._pix_points.append(None)
             return
         cv2.line(img, pix1, pix2, colour, linewidth)
         cv2.circle(img, pix2, linewidth*2, colour)
-        if len(self._pix_points) == 0:
-            self._pix_points.append(pix1)
-        self._pix_points.append(pix2)
         if self.arrow:
-            xdiff = pix2[0]-pix1[0]
-            ydiff = pix2[1]-pix1[1]
-            if (xdiff*xdiff + ydiff*ydiff) > 400: # the segment is longer than 20 pix
-                SlipArrow(self.key, self.layer, (int(pix1[0]+xdiff/2.0), int(pix1[1]+ydiff/2.0)), self.colour,
-                          self.linewidth, math.atan2(ydiff, xdiff)+math.pi/2.0).draw(img)
+            self.draw_arrow(img, pix1, pix2)
+
+    def draw_arrow(self, img, pix1, pix2):
+        '''draw a direction arrow half way along a line'''
+        xdiff = pix2[0]-pix1[0]
+        ydiff = pix2[1]-pix1[1]
+        if (xdiff*xdiff + ydiff*ydiff) > 400: # the segment is longer than 20 pix
+            SlipArrow(self.key, self.layer, (int(pix1[0]+xdiff/2.0), int(pix1[1]+ydiff/2.0)), self.colour,
+                      self.linewidth, math.atan2(ydiff, xdiff)+math.pi/2.0).draw(img)
+
+    def draw_segments(self, img, pixels, width, height):
+        '''draw a short polygon one segment at a time'''
+        for i in range(len(pixels)-1):
+            (pix1, pix2) = (tuple(pixels[i]), tuple(pixels[i+1]))
+            if (min(pix1[0], pix2[0]) >= width or max(pix1[0], pix2[0]) < 0 or
+                min(pix1[1], pix2[1]) >= height or max(pix1[1], pix2[1]) < 0):
+                continue
+            if len(self.points[i]) > 2:
+                colour = self.points[i][2]
+            else:
+                colour = self.colour
+            cv2.line(img, pix1, pix2, colour, self.linewidth)
+            cv2.circle(img, pix2, self.linewidth*2, colour)
+            self._pix_visible[i:i+2] = True
+            if self.arrow:
+                self.draw_arrow(img, pix1, pix2)
 
     def draw(self, img, pixmapper, bounds):
-        '''draw a polygon on the image'''
+        '''draw a polygon on the image. Runs of visible segments of
+        the same colour are drawn as one polyline'''
         if self.hidden:
             return
-        self._pix_points = []
-        for i in range(len(self.points)-1):
-            if len(self.points[i]) > 2:
-                colour = self.points[i][2]
-            else:
+        pixels = self.project_array(pixmapper, self.points)
+        (width, height) = image_shape(img)
+        self._pix_array = pixels
+        self._pix_visible = np.zeros(len(pixels), dtype=bool)
+        if len(pixels) < 2:
+            return
+        if len(pixels) <= SHORT_POLYGON:
+            self.draw_segments(img, pixels.tolist(), width, height)
+            return
+        (p1, p2) = (pixels[:-1], pixels[1:])
+        visible = ((np.minimum(p1[:,0], p2[:,0]) < width) & (np.maximum(p1[:,0], p2[:,0]) >= 0) &
+                   (np.minimum(p1[:,1], p2[:,1]) < height) & (np.maximum(p1[:,1], p2[:,1]) >= 0))
+        (ids, palette) = self.segment_colours()
+        for cid in range(len(palette)):
+            segments = np.flatnonzero(visible & (ids == cid))
+            if len(segments) == 0:
+                continue
+            colour = palette[cid]
+            if colour is None:
                 colour = self.colour
-            self.draw_line(img, pixmapper, self.points[i], self.points[i+1],
-                           colour, self.linewidth)
+            runs = np.split(segments, np.flatnonzero(np.diff(segments) != 1) + 1)
+            cv2.polylines(img, [ pixels[r[0]:r[-1]+2] for r in runs ], False, colour, self.linewidth)
+            # mark the end of each segment
+            draw_circles(img, pixels[segments+1], self.linewidth*2, colour)
+        self._pix_visible[:-1] |= visible
+        self._pix_visible[1:] |= visible
+        if self.arrow:
+            for i in np.flatnonzero(visible):
+                self.draw_arrow(img, tuple(pixels[i]), tuple(pixels[i+1]))
 
     def clicked(self, px, py):
         '''see if the polygon has been clicked on.
         Consider it clicked if the pixel is within 6 of the point
         '''
-        if self.hidden:
+        if self.hidden or self._pix_array is None:
             return None
-        for i in range(len(self._pix_points)):
-            if self._pix_points[i] is None:
-                continue
-            (pixx,pixy) = self._pix_points[i]
-            if abs(px - pixx) < 6 and abs(py - pixy) < 6:
-                self._selected_vertex = i
-                return math.sqrt((px - pixx)**2 + (py - pixy)**2)
-        return None
+        d = np.abs(self._pix_array - np.array([px, py]))
+        near = np.flatnonzero(self._pix_visible & (d[:,0] < 6) & (d[:,1] < 6))
+        if len(near) == 0:
+            return None
+        i = int(near[0])
+        self._selected_vertex = i
+        return math.sqrt(float(d[i,0])**2 + float(d[i,1])**2)
 
     def selection_info(self):
         '''extra selection information sent when object is selected'''
@@ -346,6 +566,11 @@ class SlipFlightModeLegend(SlipObject):
 
         return img
 
+    def pixel_bounds(self, pixmapper):
+        if self._img is None:
+            return None
+        return (5, 5, 5+self._img.shape[1], 5+self._img.shape[0])
+
     def draw(self, img, pixmapper, bounds):
         '''draw legend on the image'''
         if self._img is None:
@@ -390,12 +615,17 @@ class SlipThumbnail(SlipObject):
                           self.border_colour, self.border_width)
         return self._img
 
+    def pixel_bounds(self, pixmapper):
+        (px, py) = self.project(pixmapper, [self.latlon])[0]
+        return (px - self.width//2 - 1, py - self.height//2 - 1,
+                px - self.width//2 + self.width + 1, py - self.height//2 + self.height + 1)
+
     def draw(self, img, pixmapper, bounds):
         '''draw the thumbnail on the image'''
         if self.hidden:
             return
         thumb = self.img()
-        (px,py) = pixmapper(self.latlon)
+        (px,py) = self.project(pixmapper, [self.latlon])[0]
 
         # find top left
         (w, h) = image_shape(thumb)
@@ -428,6 +658,7 @@ class SlipTrail:
         self.count = count
         self.points = points
         self.last_time = time.time()
+        self._pix_cache = None
 
     def update_position(self, newpos):
         '''update trail'''
@@ -438,13 +669,29 @@ class SlipTrail:
             while len(self.points) > self.count:
                 self.points.pop(0)
 
+    def project(self, pixmapper):
+        '''return an Nx2 array of pixels for the trail points, kept
+        until the view or the trail changes'''
+        view = pixmapper.view() if hasattr(pixmapper, 'view') else None
+        cache = self._pix_cache
+        if (view is not None and cache is not None and cache[0] == view and
+            cache[1] == len(self.points) and (len(self.points) == 0 or cache[2] is self.points[-1])):
+            return cache[3]
+        pixels = project_points(pixmapper, self.points)
+        if view is not None and len(self.points) > 0:
+            self._pix_cache = (view, len(self.points), self.points[-1], pixels)
+        return pixels
+
+    def pixel_bounds(self, pixmapper):
+        return array_rect(self.project(pixmapper), 2)
+
     def draw(self, img, pixmapper, bounds):
         '''draw the trail'''
-        for p in self.points:
-            (px,py) = pixmapper(p)
-            (width, height) = image_shape(img)
-            if px >= 0 and py >= 0 and px < width and py < height:
-                cv2.circle(img, (px,py), 1, self.colour)
+        pixels = self.project(pixmapper)
+        (width, height) = image_shape(img)
+        inside = ((pixels[:,0] >= 0) & (pixels[:,1] >= 0) &
+                  (pixels[:,0] < width) & (pixels[:,1] < height))
+        draw_circles(img, pixels[inside], 1, self.colour)
 
 
 class SlipIcon(SlipThumbnail):
@@ -470,6 +717,22 @@ class SlipIcon(SlipThumbnail):
             self._rotated = self._img
         return self._rotated
 
+    def pixel_bounds(self, pixmapper):
+        (px, py) = self.project(pixmapper, [self.latlon])[0]
+        if self.rotation:
+            (w, h) = (self.height, self.width)
+        else:
+            (w, h) = (self.width, self.height)
+        (x1, y1) = (px - w//2, py - h//2)
+        ret = (x1-1, y1-1, x1+w+1, y1+h+1)
+        if self.label is not None:
+            (lx, ly) = (max(x1, 0), max(y1, 0))
+            ((tw, th), baseline) = cv2.getTextSize(self.label, cv2.FONT_HERSHEY_SIMPLEX, 1.0, 1)
+            ret = rect_union(ret, (lx-1, ly-th-2, lx+tw+2, ly+baseline+2))
+        if self.trail is not None:
+            ret = rect_union(ret, self.trail.pixel_bounds(pixmapper))
+        return ret
+
     def draw(self, img, pixmapper, bounds):
         '''draw the icon on the image'''
 
@@ -480,7 +743,7 @@ class SlipIcon(SlipThumbnail):
             self.trail.draw(img, pixmapper, bounds)
 
         icon = self.img()
-        (px,py) = pixmapper(self.latlon)
+        (px,py) = self.project(pixmapper, [self.latlon])[0]
 
         # find top left
         (w, h) = image_shape(icon)
@@ -520,6 +783,17 @@ class SlipClickLocation(SlipObject):
         self.timeout = timeout
         self.start = time.time()
 
+    def pixel_bounds(self, pixmapper):
+        if self.location is None:
+            return (0, 0, 0, 0)
+        margin = self.length + self.linewidth + 1
+        return points_rect([pixmapper(self.location)], margin)
+
+    def expires(self):
+        if self.timeout == -1:
+            return None
+        return self.start + self.timeout
+
     def draw(self, img, pixmapper, bounds):
         '''X marks the spot'''
         if self.location is None:
@@ -580,6 +854,22 @@ class SlipHideObject:
         self.hide = hide
 
 
+class SlipBatch:
+    '''a batch of updates sent to the map process. queued is the time
+    the oldest update in the batch was queued'''
+    def __init__(self, items, queued):
+        self.items = items
+        self.queued = queued
+
+class SlipIPCStats:
+    '''update batch statistics sent back from the map process'''
+    def __init__(self, batches, updates, p50, p99, max):
+        self.batches = batches
+        self.updates = updates
+        self.p50 = p50
+        self.p99 = p99
+        self.max = max
+
 class SlipInformation:
     '''an object to display in the information box'''
     def __init__(self, key):
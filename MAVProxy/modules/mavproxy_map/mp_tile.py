@@ -12,25 +12,16 @@ released under GNU GPL v3 or later
 import collections
 import errno
 import hashlib
-import sys
 import math
-import threading
 import os
 import string
 import time
 import cv2
 import numpy as np
 
-if sys.version_info.major < 3:
-    from urllib2 import Request as url_request
-    from urllib2 import urlopen as url_open
-    from urllib2 import URLError as url_error
-else:
-    from urllib.request import Request as url_request
-    from urllib.request import urlopen as url_open
-    from urllib.error import URLError as url_error
-
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.mavproxy_map import mp_tiledownload
+from MAVProxy.modules.mavproxy_map import mp_tilestore
 
 class TileException(Exception):
     '''tile error class'''
@@ -67,6 +58,87 @@ BLANK_TILES = set(["d16657bbee25d7f15c583f5c5bf23f50",
 TILES_WIDTH = 256
 TILES_HEIGHT = 256
 
+# latitude limit of Web Mercator
+MAX_LATITUDE = 85.0511287798
+
+def mercator(lat, lon):
+    '''return Web Mercator (x,y) for lat/lon, which may be numpy arrays.
+    x and y run from 0 to 1 across the world, y from the north, so
+    multiplying by the number of tiles gives the tile numbers used by
+    coord_to_tile'''
+    lat = np.clip(np.asarray(lat, dtype=float), -MAX_LATITUDE, MAX_LATITUDE)
+    x = (np.asarray(lon, dtype=float) + 180.0) / 360.0
+    e = np.sin(np.radians(lat))
+    y = 0.5 - np.log((1+e)/(1-e)) / (4*math.pi)
+    return (x, y)
+
+def mercator_inverse(x, y):
+    '''return (lat,lon) for Web Mercator (x,y)'''
+    lon = np.asarray(x, dtype=float) * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(math.pi * (1 - 2*np.asarray(y, dtype=float)))))
+    return (lat, lon)
+
+class AreaProjection(object):
+    '''convert between lat/lon and pixels in an area image with
+    lat/lon at its top left, ground_width meters across width pixels.
+    Whole arrays of points can be converted in one call. An
+    AreaProjection can be used as the pixmapper for drawing slipmap
+    objects'''
+    def __init__(self, lat, lon, width, ground_width):
+        self.key = (lat, lon, width, ground_width)
+        pixel_width = ground_width / float(width)
+        # pixels per unit of mercator x, matching the ground scale at the top edge
+        self.scale = 2 * math.pi * mp_util.radius_of_earth * math.cos(math.radians(lat)) / pixel_width
+        (x0, y0) = mercator(lat, lon)
+        (self.x0, self.y0) = (float(x0), float(y0))
+
+    def view(self):
+        '''key for this projection'''
+        return self.key
+
+    def pixels(self, lat, lon):
+        '''return float (px,py) arrays for lat/lon arrays'''
+        (x, y) = mercator(lat, lon)
+        # wrap at the antimeridian, keeping points up to 3/4 of the
+        # world to the right of the left edge
+        dx = (x - self.x0 + 0.25) % 1.0 - 0.25
+        return (dx * self.scale, (y - self.y0) * self.scale)
+
+    def project_array(self, latlon):
+        '''return an Nx2 integer array of pixels for an Nx2 array of
+        lat/lon. Pixels are truncated towards zero, and limited to a
+        range that is safe for OpenCV drawing'''
+        latlon = np.asarray(latlon, dtype=float).reshape(-1, 2)
+        (px, py) = self.pixels(latlon[:,0], latlon[:,1])
+        ret = np.empty((len(latlon), 2), dtype=np.int32)
+        ret[:,0] = np.clip(px, -(1<<30), 1<<30)
+        ret[:,1] = np.clip(py, -(1<<30), 1<<30)
+        return ret
+
+    def coord(self, pixel):
+        '''return (lat,lon) for a pixel'''
+        (lat, lon) = mercator_inverse(self.x0 + pixel[0] / self.scale,
+                                      self.y0 + pixel[1] / self.scale)
+        return (float(lat), float((lon + 180.0) % 360.0 - 180.0))
+
+    def __call__(self, latlon, reverse=False):
+        '''return pixel coordinates (px,py) for a (lat,lon), or with
+        reverse set the (lat,lon) for a pixel'''
+        if reverse:
+            return self.coord(latlon)
+        return self.pixel(latlon[0], latlon[1])
+
+    def pixel(self, lat, lon):
+        '''project_array() for a single point, using scalar maths'''
+        lat = min(max(lat, -MAX_LATITUDE), MAX_LATITUDE)
+        x = (lon + 180.0) / 360.0
+        e = math.sin(math.radians(lat))
+        y = 0.5 - math.log((1+e)/(1-e)) / (4*math.pi)
+        dx = (x - self.x0 + 0.25) % 1.0 - 0.25
+        px = min(max(dx * self.scale, -(1<<30)), 1<<30)
+        py = min(max((y - self.y0) * self.scale, -(1<<30)), 1<<30)
+        return (int(px), int(py))
+
 class TileServiceInfo:
     '''a lookup object for the URL templates'''
     def __init__(self, x, y, zoom):
@@ -166,17 +238,11 @@ class MPTile:
     '''map tile object'''
     def __init__(self, cache_path=None, download=True, cache_size=500,
              service="MicrosoftSat", tile_delay=0.3, debug=False,
-             max_zoom=19, refresh_age=30*24*60*60):
+             max_zoom=19, refresh_age=30*24*60*60, download_workers=4,
+             tile_store=None):
 
         if cache_path is None:
-            try:
-                cache_path = os.path.join(os.environ['HOME'], '.tilecache')
-            except Exception:
-                if 'LOCALAPPDATA' in os.environ:
-                    cache_path = os.path.join(os.environ['LOCALAPPDATA'], '.tilecache')
-                else:
-                    import tempfile
-                    cache_path = os.path.join(tempfile.gettempdir(), '.tilecache')
+            cache_path = default_cache_path()
 
         if not os.path.exists(cache_path):
             mp_util.mkdir_p(cache_path)
@@ -194,9 +260,16 @@ class MPTile:
         if service not in TILE_SERVICES:
             raise TileException('unknown tile service %s' % service)
 
-        # _download_pending is a dictionary of TileInfo objects
-        self._download_pending = {}
-        self._download_thread = None
+        # tile_store is 'files' or 'sqlite', see mp_tilestore
+        self._store = mp_tilestore.open_store(cache_path, tile_store)
+        # tile_delay is the minimum interval between requests to each server
+        self._downloader = mp_tiledownload.TileDownloader(self.tile_downloaded,
+                                                          workers=download_workers,
+                                                          delay=tile_delay,
+                                                          debug=debug)
+        # tiles requested by earlier views are cancelled when the view changes
+        self._view_generation = 0
+        self._view_center = None
         self._loading = mp_icon('loading.jpg')
         self._unavailable = mp_icon('unavailable.jpg')
         try:
@@ -206,6 +279,13 @@ class MPTile:
             # which is a 3rd party package, not in python2.6 distribution
             import ordereddict
             self._tile_cache = ordereddict.OrderedDict()
+        # RGB tiles scaled for display, keyed by (tile key, width, height)
+        self._scaled_cache = self._tile_cache.__class__()
+        # the last composited area, reused when the view is panned
+        self._area = None
+        # count of tiles that have arrived, so views can be redrawn
+        self._tile_updates = 0
+        self._projection = None
 
     def set_service(self, service):
         '''set tile service'''
@@ -248,81 +328,119 @@ class MPTile:
 
     def tiles_pending(self):
         '''return number of tiles pending download'''
-        return len(self._download_pending)
-
-    def downloader(self):
-        '''the download thread'''
-        while self.tiles_pending() > 0:
-            time.sleep(self.tile_delay)
-
-            keys = sorted(self._download_pending.keys())
+        return self._downloader.pending()
+
+    def download_stats(self):
+        '''return (fetched, failed) tile download counts'''
+        return (self._downloader.fetched, self._downloader.failed)
+
+    def tiles_cached(self, tiles):
+        '''return the set of keys of tiles that are in the cache and not
+        due for refresh'''
+        fetch_times = self._store.fetch_times([t.key() for t in tiles])
+        now = time.time()
+        return set([k for k in fetch_times.keys() if fetch_times[k] + self.refresh_age >= now])
+
+    def tile_cached(self, tile):
+        '''return true if a tile is in the cache and not due for refresh'''
+        return tile.key() in self.tiles_cached([tile])
+
+    def average_tile_size(self):
+        '''return the average size in bytes of cached tiles, or None'''
+        return self._store.average_size(self.service)
+
+    def queue_download(self, tile):
+        '''queue a tile for download, nearest the centre of the most
+        recent view first'''
+        tile.generation = self._view_generation
+        if self._view_center is not None:
+            distance = tile.distance(self._view_center[0], self._view_center[1])
+        else:
+            distance = 0
+        url = tile.url(self.service)
+        headers = {}
+        if url.find('google') != -1:
+            headers['Referer'] = 'https://maps.google.com/'
+        self._downloader.request(tile.key(), tile, url, (-tile.generation, distance), headers)
+
+    def cancel_downloads(self):
+        '''cancel downloads of tiles not requested by the most recent view'''
+        generation = self._view_generation
+        self._downloader.cancel(lambda key, tile: tile.generation == generation)
+
+    def cancel_all_downloads(self):
+        '''cancel all queued downloads'''
+        self._downloader.cancel(lambda key, tile: False)
+
+    def tile_downloaded(self, tile_info, content_type, img, error):
+        '''called from a download thread when a tile has been fetched'''
+        self.store_tile(tile_info, content_type, img, error)
+        self._tile_updates += 1
+
+    def store_tile(self, tile_info, content_type, img, error):
+        '''store a downloaded tile, or mark it as unavailable'''
+        url = tile_info.url(self.service)
+        key = tile_info.key()
+        if error is not None:
+            if not key in self._tile_cache:
+                self._tile_cache[key] = self._unavailable
+            if self.debug:
+                print("Failed %s: %s" % (url, error))
+            return
+        if content_type.find('image') == -1:
+            if not key in self._tile_cache:
+                self._tile_cache[key] = self._unavailable
+            if self.debug:
+                print("non-image response %s" % url)
+            return
 
-            # work out which one to download next, choosing by request_time
-            tile_info = self._download_pending[keys[0]]
-            for key in keys:
-                if self._download_pending[key].request_time > tile_info.request_time:
-                    tile_info = self._download_pending[key]
+        # see if its a blank/unavailable tile
+        md5 = hashlib.md5(img).hexdigest()
+        if md5 in BLANK_TILES:
+            if self.debug:
+                print("blank tile %s" % url)
+            if not key in self._tile_cache:
+                self._tile_cache[key] = self._unavailable
+            return
 
-            url = tile_info.url(self.service)
-            path = self.tile_to_path(tile_info)
-            key = tile_info.key()
+        self._store.put(key, img, time.time())
 
-            try:
-                if self.debug:
-                    print("Downloading %s [%u left]" % (url, len(keys)))
-                req = url_request(url)
-                if url.find('google') != -1:
-                    req.add_header('Referer', 'https://maps.google.com/')
-                resp = url_open(req)
-                headers = resp.info()
-            except url_error as e:
-                #print('Error loading %s' % url)
-                if not key in self._tile_cache:
-                    self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
-                if self.debug:
-                    print("Failed %s: %s" % (url, str(e)))
-                continue
-            if 'content-type' not in headers or headers['content-type'].find('image') == -1:
-                if not key in self._tile_cache:
-                    self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
-                if self.debug:
-                    print("non-image response %s" % url)
-                continue
-            else:
-                img = resp.read()
-
-            # see if its a blank/unavailable tile
-            md5 = hashlib.md5(img).hexdigest()
-            if md5 in BLANK_TILES:
-                if self.debug:
-                    print("blank tile %s" % url)
-                    if not key in self._tile_cache:
-                        self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
-                continue
+    def decode_tile(self, tile, entry):
+        '''decode a tile from the store, adding it to the tile cache and
+        queueing a refresh if it is old'''
+        (data, fetch_time) = entry
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            return None
+        # if it is an old tile, then try to refresh
+        if fetch_time + self.refresh_age < time.time() and self.download:
+            self.queue_download(tile)
+        # add it to the tile cache
+        self._tile_cache[tile.key()] = img
+        while len(self._tile_cache) > self.cache_size:
+            self._tile_cache.popitem(0)
+        return img
 
-            mp_util.mkdir_p(os.path.dirname(path))
-            h = open(path+'.tmp','wb')
-            h.write(img)
-            h.close()
-            try:
-                os.unlink(path)
-            except Exception:
-                pass
-            os.rename(path+'.tmp', path)
-            self._download_pending.pop(key)
-        self._download_thread = None
-
-    def start_download_thread(self):
-        '''start the downloader'''
-        if self._download_thread:
+    def read_tile(self, tile):
+        '''read a tile from the store, or return None'''
+        entry = self._store.get(tile.key())
+        if entry is None:
+            return None
+        return self.decode_tile(tile, entry)
+
+    def prefetch_tiles(self, tiles):
+        '''read the tiles that are not in the tile cache from the store in
+        one batch'''
+        wanted = {}
+        for t in tiles:
+            key = t.key()
+            if key not in self._tile_cache:
+                wanted[key] = t
+        if not wanted:
             return
-        t = threading.Thread(target=self.downloader)
-        t.daemon = True
-        self._download_thread = t
-        t.start()
+        entries = self._store.get_many(wanted.keys())
+        for key in entries:
+            self.decode_tile(wanted[key], entries[key])
 
     def load_tile_lowres(self, tile):
         '''load a lower resolution tile from cache to fill in a
@@ -352,8 +470,11 @@ class MPTile:
                 if np.array_equal(img, np.array(self._unavailable)):
                     continue
             else:
-                path = self.tile_to_path(tile_info)
-                img = cv2.imread(path)
+                entry = self._store.get(key)
+                if entry is None:
+                    continue
+                (data, fetch_time) = entry
+                img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
                 if img is None:
                     continue
                 # add it to the tile cache
@@ -374,8 +495,10 @@ class MPTile:
             return scaled
         return None
 
-    def load_tile(self, tile):
-        '''load a tile from cache or tile server'''
+    def load_tile_final(self, tile):
+        '''load a tile from cache or tile server. Returns (img, final),
+        where final is False if the image is a placeholder for a tile
+        being downloaded'''
 
         # see if its in the tile cache
         key = tile.key()
@@ -385,43 +508,45 @@ class MPTile:
                 img = self.load_tile_lowres(tile)
                 if img is None:
                     img = self._unavailable
-            return img
-
+            return (img, True)
 
-        path = self.tile_to_path(tile)
-        ret = cv2.imread(path)
+        ret = self.read_tile(tile)
         if ret is not None:
-            # if it is an old tile, then try to refresh
-            if os.path.getmtime(path) + self.refresh_age < time.time():
-                try:
-                        self._download_pending[key].refresh_time()
-                except Exception:
-                        self._download_pending[key] = tile
-                self.start_download_thread()
-                    
-            # add it to the tile cache
-            self._tile_cache[key] = ret
-            while len(self._tile_cache) > self.cache_size:
-                self._tile_cache.popitem(0)
-            return ret
+            return (ret, True)
 
         if not self.download:
             img = self.load_tile_lowres(tile)
             if img is None:
                 img = self._unavailable
-            return img
+            return (img, True)
 
-        try:
-            self._download_pending[key].refresh_time()
-        except Exception:
-            self._download_pending[key] = tile
-        self.start_download_thread()
+        self.queue_download(tile)
 
         img = self.load_tile_lowres(tile)
         if img is None:
             img = self._loading
-        return img
+        return (img, False)
 
+    def load_tile(self, tile):
+        '''load a tile from cache or tile server'''
+        return self.load_tile_final(tile)[0]
+
+    def scaled_tile_final(self, tile):
+        '''return (img, final) for an RGB scaled tile. Final tiles are
+        kept in the scaled tile cache'''
+        width = int(TILES_WIDTH / tile.scale)
+        height = int(TILES_HEIGHT / tile.scale)
+        key = (tile.key(), width, height)
+        img = self._scaled_cache.get(key, None)
+        if img is not None:
+            return (img, True)
+        (full_tile, final) = self.load_tile_final(tile)
+        img = cv2.cvtColor(cv2.resize(full_tile, (height, width)), cv2.COLOR_BGR2RGB)
+        if final:
+            self._scaled_cache[key] = img
+            while len(self._scaled_cache) > self.cache_size:
+                self._scaled_cache.popitem(0)
+        return (img, final)
 
     def scaled_tile(self, tile):
         '''return a scaled tile'''
@@ -431,36 +556,29 @@ class MPTile:
         scaled_tile = cv2.resize(full_tile, (height, width))
         return scaled_tile
 
+    def tile_updates(self):
+        '''return a count that changes whenever a downloaded tile arrives'''
+        return self._tile_updates
 
-    def coord_from_area(self, x, y, lat, lon, width, ground_width):
-        '''return (lat,lon) for a pixel in an area image'''
-
-        pixel_width = ground_width / float(width)
-        dx = x * pixel_width
-        dy = y * pixel_width
 
-        return mp_util.gps_offset(lat, lon, dx, -dy)
+    def area_projection(self, lat, lon, width, ground_width):
+        '''return the AreaProjection for an area image'''
+        key = (lat, lon, width, ground_width)
+        if self._projection is None or self._projection.key != key:
+            self._projection = AreaProjection(lat, lon, width, ground_width)
+        return self._projection
 
+    def coord_from_area(self, x, y, lat, lon, width, ground_width):
+        '''return (lat,lon) for a pixel in an area image'''
+        return self.area_projection(lat, lon, width, ground_width).coord((x, y))
 
     def coord_to_pixel(self, lat, lon, width, ground_width, lat2, lon2):
         '''return pixel coordinate (px,py) for position (lat2,lon2)
         in an area image. Note that the results are relative to top,left
         and may be outside the image'''
-        pixel_width = ground_width / float(width)
-
         if lat is None or lon is None or lat2 is None or lon2 is None:
             return (0,0)
-
-        dx = mp_util.gps_distance(lat, lon, lat, lon2)
-        if lon2 < lon:
-            dx = -dx
-        dy = mp_util.gps_distance(lat, lon, lat2, lon)
-        if lat2 > lat:
-            dy = -dy
-
-        dx /= pixel_width
-        dy /= pixel_width
-        return (int(dx), int(dy))
+        return self.area_projection(lat, lon, width, ground_width)((lat2, lon2))
 
 
     def area_to_tile_list(self, lat, lon, width, height, ground_width, zoom=None):
@@ -526,28 +644,83 @@ class MPTile:
         lat/lon is the top left corner. The zoom is automatically
         chosen to avoid having to grow the tiles'''
 
-        img = np.zeros((height,width,3), np.uint8)
-
         tlist = self.area_to_tile_list(lat, lon, width, height, ground_width, zoom)
 
-        # order the display by distance from the middle, so the download happens
+        # downloads are ordered by distance from the middle, so the download happens
         # close to the middle of the image first
+        (midlat, midlon) = self.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
+        self._view_generation += 1
+        self._view_center = (midlat, midlon)
         if ordered:
-            (midlat, midlon) = self.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
             tlist.sort(key=lambda d: d.distance(midlat, midlon), reverse=True)
 
+        # read the tiles for the area from the store in one batch
+        self.prefetch_tiles(tlist)
+
+        # the image is a window onto a plane of scaled tiles, with its
+        # top left at (originx, originy) in that plane
+        if tlist:
+            t = tlist[0]
+            scaled_width = int(TILES_WIDTH / t.scale)
+            scaled_height = int(TILES_HEIGHT / t.scale)
+            view = (self.service, t.zoom, scaled_width, scaled_height, width, height)
+            originx = t.x * scaled_width - t.dstx + t.srcx
+            originy = t.y * scaled_height - t.dsty + t.srcy
+        else:
+            view = None
+            (originx, originy) = (0, 0)
+
+        # if the zoom and scale are unchanged and the view has moved less
+        # than its size, shift the last image and only draw the newly
+        # exposed tiles and the tiles that were still loading
+        img = np.zeros((height,width,3), np.uint8)
+        valid = None
+        placeholders = set()
+        prev = self._area
+        if prev is not None and view is not None and prev['view'] == view:
+            dx = originx - prev['originx']
+            dy = originy - prev['originy']
+            if abs(dx) < width and abs(dy) < height:
+                img[max(0,-dy):height-max(0,dy), max(0,-dx):width-max(0,dx)] = \
+                    prev['img'][max(0,dy):height-max(0,-dy), max(0,dx):width-max(0,-dx)]
+                valid = (max(0,-dx), max(0,-dy), width-max(0,dx), height-max(0,dy))
+                placeholders = prev['placeholders']
+
+        new_placeholders = set()
         for t in tlist:
-            scaled_tile = self.scaled_tile(t)
+            w = min(width - t.dstx, int(TILES_WIDTH / t.scale) - t.srcx)
+            h = min(height - t.dsty, int(TILES_HEIGHT / t.scale) - t.srcy)
+            if w <= 0 or h <= 0:
+                continue
+            key = t.key()
+            if (valid is not None and key not in placeholders and
+                t.dstx >= valid[0] and t.dsty >= valid[1] and
+                t.dstx + w <= valid[2] and t.dsty + h <= valid[3]):
+                continue
+            (scaled_tile, final) = self.scaled_tile_final(t)
+            if not final:
+                new_placeholders.add(key)
+            w = min(w, scaled_tile.shape[1] - t.srcx)
+            h = min(h, scaled_tile.shape[0] - t.srcy)
+            img[t.dsty:t.dsty+h, t.dstx:t.dstx+w] = scaled_tile[t.srcy:t.srcy+h, t.srcx:t.srcx+w]
 
-            w = min(width - t.dstx, scaled_tile.shape[1] - t.srcx)
-            h = min(height - t.dsty, scaled_tile.shape[0] - t.srcy)
-            if w > 0 and h > 0:
-                scaled_tile_roi = scaled_tile[t.srcy:t.srcy+h, t.srcx:t.srcx+w]
-                img[t.dsty:t.dsty+h, t.dstx:t.dstx+w] = scaled_tile_roi.copy()
+        self._area = { 'view' : view, 'originx' : originx, 'originy' : originy,
+                       'img' : img, 'placeholders' : new_placeholders }
 
-        # return as an RGB image
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        return img
+        # tiles that have scrolled out of view are no longer needed
+        self.cancel_downloads()
+
+        return img.copy()
+
+def default_cache_path():
+    '''return the default tile cache directory'''
+    try:
+        return os.path.join(os.environ['HOME'], '.tilecache')
+    except Exception:
+        if 'LOCALAPPDATA' in os.environ:
+            return os.path.join(os.environ['LOCALAPPDATA'], '.tilecache')
+        import tempfile
+        return os.path.join(tempfile.gettempdir(), '.tilecache')
 
 def mp_icon(filename):
     '''load an icon from the data directory'''
@@ -559,15 +732,14 @@ def mp_icon(filename):
         if name == "__main__":
             name = "MAVProxy.modules.mavproxy_map.mp_tile"
         stream = pkg_resources.resource_stream(name, "data/%s" % filename).read()
-        raw = np.fromstring(stream, dtype=np.uint8)
     except Exception:
         try:
-            stream = open(os.path.join(__file__, 'data', filename)).read()
-            raw = np.fromstring(stream, dtype=np.uint8)
+            stream = open(os.path.join(os.path.dirname(__file__), 'data', filename), 'rb').read()
         except Exception:
             #we're in a Windows exe, where pkg_resources doesn't work
             import pkgutil
-            raw = pkgutil.get_data( 'MAVProxy', 'modules//mavproxy_map//data//' + filename)
+            stream = pkgutil.get_data( 'MAVProxy', 'modules//mavproxy_map//data//' + filename)
+    raw = np.frombuffer(stream, dtype=np.uint8)
     img = cv2.imdecode(raw, cv2.IMREAD_COLOR)
     return img
 
@@ -582,7 +754,8 @@ if __name__ == "__main__":
     parser.add_option("--service", default="OviHybrid", help="tile service")
     parser.add_option("--zoom", default=None, type='int', help="zoom level")
     parser.add_option("--max-zoom", type='int', default=19, help="maximum tile zoom")
-    parser.add_option("--delay", type='float', default=1.0, help="tile download delay")
+    parser.add_option("--delay", type='float', default=1.0, help="minimum interval between requests to a tile server")
+    parser.add_option("--workers", type='int', default=4, help="number of download threads")
     parser.add_option("--boundary", default=None, help="region boundary")
     parser.add_option("--debug", action='store_true', default=False, help="show debug info")
     (opts, args) = parser.parse_args()
@@ -601,7 +774,8 @@ if __name__ == "__main__":
         print(lat, lon, ground_width)
 
     mt = MPTile(debug=opts.debug, service=opts.service,
-            tile_delay=opts.delay, max_zoom=opts.max_zoom)
+            tile_delay=opts.delay, max_zoom=opts.max_zoom,
+            download_workers=opts.workers)
     if opts.zoom is None:
         zooms = range(mt.min_zoom, mt.max_zoom+1)
     else:
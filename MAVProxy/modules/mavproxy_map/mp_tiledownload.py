@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+'''
+concurrent map tile downloader
+
+Tiles are queued in a heap ordered by a priority supplied by the
+caller, and fetched by a small pool of worker threads. Each worker
+keeps one keep-alive HTTP connection per server, and requests to each
+server are spaced by a minimum interval rather than a fixed sleep
+before every tile. Queued tiles can be cancelled, for example when
+they have scrolled out of view. The http_proxy, https_proxy and
+no_proxy settings are honoured as they are by urllib.
+'''
+
+import base64
+import heapq
+import sys
+import threading
+import time
+
+if sys.version_info.major < 3:
+    import httplib
+    from urlparse import urlsplit, urljoin, unquote
+    from urllib import getproxies, proxy_bypass
+else:
+    import http.client as httplib
+    from urllib.parse import urlsplit, urljoin, unquote
+    from urllib.request import getproxies, proxy_bypass
+
+class TileFetchError(Exception):
+    '''tile fetch error class'''
+    def __init__(self, msg):
+        Exception.__init__(self, msg)
+
+class HTTPFetcher(object):
+    '''fetch URLs over keep-alive connections, one per server'''
+    def __init__(self, timeout=20, user_agent='MAVProxy', proxies=None):
+        self.timeout = timeout
+        self.user_agent = user_agent
+        self.connections = {}
+        if proxies is None:
+            proxies = getproxies()
+        self.proxies = proxies
+
+    def proxy(self, scheme, netloc):
+        '''return (netloc, headers) for the proxy to use for a server,
+        or None for a direct connection'''
+        proxy = self.proxies.get(scheme, None)
+        if proxy is None:
+            return None
+        host = netloc.rsplit(':', 1)[0]
+        if self.bypass(host) or proxy_bypass(host):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        p = urlsplit(proxy)
+        headers = {}
+        if p.username is not None:
+            auth = '%s:%s' % (unquote(p.username), unquote(p.password or ''))
+            auth = base64.b64encode(auth.encode('utf-8')).decode('ascii')
+            headers['Proxy-Authorization'] = 'Basic ' + auth
+        netloc = p.hostname
+        if p.port is not None:
+            netloc += ':%u' % p.port
+        return (netloc, headers)
+
+    def bypass(self, host):
+        '''check host against the no_proxy list in our proxies'''
+        for name in self.proxies.get('no', '').split(','):
+            name = name.strip().lstrip('.')
+            if name == '*' or (name and (host == name or host.endswith('.' + name))):
+                return True
+        return False
+
+    def connection(self, scheme, netloc):
+        '''return (connection, proxy headers, absolute), where absolute
+        is set when requests must give the full URL to a HTTP proxy'''
+        key = (scheme, netloc)
+        conn = self.connections.get(key, None)
+        if conn is None:
+            proxy = self.proxy(scheme, netloc)
+            if proxy is None:
+                if scheme == 'https':
+                    conn = (httplib.HTTPSConnection(netloc, timeout=self.timeout), {}, False)
+                else:
+                    conn = (httplib.HTTPConnection(netloc, timeout=self.timeout), {}, False)
+            else:
+                (proxy_netloc, proxy_headers) = proxy
+                if scheme == 'https':
+                    # tunnel through the proxy with CONNECT
+                    c = httplib.HTTPSConnection(proxy_netloc, timeout=self.timeout)
+                    c.set_tunnel(netloc, headers=proxy_headers)
+                    conn = (c, {}, False)
+                else:
+                    c = httplib.HTTPConnection(proxy_netloc, timeout=self.timeout)
+                    conn = (c, proxy_headers, True)
+            self.connections[key] = conn
+        return conn
+
+    def close(self, scheme=None, netloc=None):
+        '''close one connection, or all of them'''
+        if scheme is None:
+            keys = list(self.connections.keys())
+        else:
+            keys = [(scheme, netloc)]
+        for key in keys:
+            conn = self.connections.pop(key, None)
+            if conn is not None:
+                conn[0].close()
+
+    def request(self, url, headers):
+        '''make one request, retrying once on a stale connection'''
+        u = urlsplit(url)
+        path = u.path or '/'
+        if u.query:
+            path += '?' + u.query
+        for attempt in range(2):
+            (conn, proxy_headers, absolute) = self.connection(u.scheme, u.netloc)
+            hdrs = headers
+            if proxy_headers:
+                hdrs = dict(headers)
+                hdrs.update(proxy_headers)
+            try:
+                if absolute:
+                    conn.request("GET", "%s://%s%s" % (u.scheme, u.netloc, path), headers=hdrs)
+                else:
+                    conn.request("GET", path, headers=hdrs)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (httplib.HTTPException, IOError) as ex:
+                self.close(u.scheme, u.netloc)
+                if attempt == 1:
+                    raise TileFetchError(str(ex))
+                continue
+            if resp.getheader('connection', '').lower() == 'close':
+                self.close(u.scheme, u.netloc)
+            return (resp, body)
+
+    def fetch(self, url, headers={}):
+        '''fetch a URL, following redirects. Returns (content_type, data)'''
+        hdrs = { 'User-Agent' : self.user_agent }
+        hdrs.update(headers)
+        for redirects in range(5):
+            (resp, body) = self.request(url, hdrs)
+            if resp.status in [301, 302, 303, 307, 308]:
+                url = urljoin(url, resp.getheader('Location'))
+                continue
+            if resp.status != 200:
+                raise TileFetchError("HTTP error %u" % resp.status)
+            return (resp.getheader('content-type', ''), body)
+        raise TileFetchError("too many redirects")
+
+class RateLimiter(object):
+    '''space requests to each server by a minimum interval'''
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_time = {}
+        self.lock = threading.Lock()
+
+    def wait(self, server):
+        '''wait until a request to server is allowed'''
+        with self.lock:
+            now = time.time()
+            t = max(now, self.next_time.get(server, 0))
+            self.next_time[server] = t + self.interval
+        if t > now:
+            time.sleep(t - now)
+
+class TileDownloader(object):
+    '''download tiles with a pool of worker threads. callback(tile,
+    content_type, data, error) is called from a worker thread when each
+    tile has been fetched or has failed'''
+    def __init__(self, callback, workers=4, delay=0.3, debug=False):
+        self.callback = callback
+        self.workers = workers
+        self.limiter = RateLimiter(delay)
+        self.debug = debug
+        self.heap = []
+        self.seq = 0
+        # tiles waiting to be fetched, key -> (priority, tile, url, headers)
+        self.queued = {}
+        # tiles being fetched
+        self.active = set()
+        self.cond = threading.Condition()
+        self.threads = []
+        self.fetched = 0
+        self.failed = 0
+        self.cancelled = 0
+
+    def set_delay(self, delay):
+        self.limiter.interval = delay
+
+    def pending(self):
+        '''return number of tiles queued or being fetched'''
+        return len(self.queued) + len(self.active)
+
+    def is_pending(self, key):
+        return key in self.queued or key in self.active
+
+    def request(self, key, tile, url, priority, headers={}):
+        '''queue a tile, or update the priority of a queued tile. Lower
+        priorities are fetched first'''
+        with self.cond:
+            if key in self.active:
+                return
+            old = self.queued.get(key, None)
+            if old is not None and old[0] == priority:
+                return
+            self.queued[key] = (priority, tile, url, headers)
+            self.seq += 1
+            heapq.heappush(self.heap, (priority, self.seq, key))
+            self.start_workers()
+            self.cond.notify()
+
+    def cancel(self, keep):
+        '''cancel queued tiles for which keep(key, tile) is False'''
+        with self.cond:
+            for key in list(self.queued.keys()):
+                if not keep(key, self.queued[key][1]):
+                    self.queued.pop(key)
+                    self.cancelled += 1
+            if not self.queued:
+                self.heap = []
+
+    def start_workers(self):
+        '''start worker threads. Called with the lock held'''
+        self.threads = [t for t in self.threads if t.is_alive()]
+        while len(self.threads) < self.workers:
+            t = threading.Thread(target=self.worker, name='tile_download')
+            t.daemon = True
+            self.threads.append(t)
+            t.start()
+
+    def next_tile(self):
+        '''wait for the highest priority tile. Returns (key, tile, url,
+        headers), or None if the worker has been idle for a while'''
+        with self.cond:
+            while True:
+                while self.heap:
+                    (priority, seq, key) = heapq.heappop(self.heap)
+                    entry = self.queued.get(key, None)
+                    if entry is None or entry[0] != priority:
+                        # cancelled, or superseded by a later request
+                        continue
+                    self.queued.pop(key)
+                    self.active.add(key)
+                    return (key,) + entry[1:]
+                t0 = time.time()
+                self.cond.wait(10)
+                if not self.heap and time.time() - t0 >= 10:
+                    return None
+
+    def worker(self):
+        '''worker thread'''
+        fetcher = HTTPFetcher()
+        while True:
+            next = self.next_tile()
+            if next is None:
+                break
+            (key, tile, url, headers) = next
+            try:
+                self.limiter.wait(urlsplit(url).netloc)
+                if self.debug:
+                    print("Downloading %s [%u left]" % (url, self.pending()))
+                (content_type, data) = fetcher.fetch(url, headers)
+                error = None
+                self.fetched += 1
+            except Exception as ex:
+                (content_type, data) = (None, None)
+                error = str(ex)
+                self.failed += 1
+            try:
+                self.callback(tile, content_type, data, error)
+            finally:
+                with self.cond:
+                    self.active.discard(key)
+        fetcher.close()
+        with self.cond:
+            if threading.current_thread() in self.threads:
+                self.threads.remove(threading.current_thread())
+            # a tile may have been queued as we were exiting
+            if self.heap:
+                self.start_workers()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+'''
+pre-seed the map tile cache for offline use
+
+Lists every tile over a range of zoom levels for a bounding box, a
+polygon, or a mission or fence path plus a buffer, then downloads the
+tiles that are not already in the cache. Tiles already cached are
+skipped, so an interrupted seed resumes where it stopped. The SRTM
+tiles for the area can be fetched at the same time.
+'''
+
+import math
+import sys
+import time
+
+from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.mavproxy_map import mp_tile
+
+# used for the download size estimate when the cache has no tiles to sample
+DEFAULT_TILE_BYTES = 20000
+
+class SeedRegion(object):
+    '''an area to seed: a polygon (closed) or path (not closed) of
+    (lat, lon) points, with a buffer in meters'''
+    def __init__(self, points, closed=True, buffer=0):
+        if len(points) == 0:
+            raise ValueError("empty seed region")
+        self.points = [ (p[0], p[1]) for p in points ]
+        self.closed = closed
+        self.buffer = buffer
+        # local flat earth projection around the first point
+        self.lat0 = self.points[0][0]
+        self.lon0 = self.points[0][1]
+        self.lon_scale = math.cos(math.radians(self.lat0))
+        self.xy = [ self.project(lat, lon) for (lat, lon) in self.points ]
+
+    def project(self, lat, lon):
+        '''return (x,y) in meters relative to the first point'''
+        deg = 2 * math.pi * mp_util.radius_of_earth / 360.0
+        return ((lon - self.lon0) * deg * self.lon_scale, (lat - self.lat0) * deg)
+
+    def bounds(self):
+        '''return (lat_min, lon_min, lat_max, lon_max) including the buffer'''
+        lats = [ p[0] for p in self.points ]
+        lons = [ p[1] for p in self.points ]
+        (lat_min, lon_min) = mp_util.gps_offset(min(lats), min(lons), -self.buffer, -self.buffer)
+        (lat_max, lon_max) = mp_util.gps_offset(max(lats), max(lons), self.buffer, self.buffer)
+        return (lat_min, lon_min, lat_max, lon_max)
+
+    def inside(self, x, y):
+        '''point in polygon test'''
+        if not self.closed or len(self.xy) < 3:
+            return False
+        ret = False
+        n = len(self.xy)
+        for i in range(n):
+            (x1, y1) = self.xy[i]
+            (x2, y2) = self.xy[(i+1) % n]
+            if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+                ret = not ret
+        return ret
+
+    def distance(self, x, y):
+        '''distance in meters from a point to the nearest edge'''
+        n = len(self.xy)
+        edges = n if self.closed and n > 2 else n - 1
+        if edges <= 0:
+            return math.hypot(x - self.xy[0][0], y - self.xy[0][1])
+        ret = None
+        for i in range(edges):
+            (x1, y1) = self.xy[i]
+            (x2, y2) = self.xy[(i+1) % n]
+            (dx, dy) = (x2 - x1, y2 - y1)
+            len2 = dx*dx + dy*dy
+            if len2 == 0:
+                t = 0
+            else:
+                t = max(0, min(1, ((x - x1) * dx + (y - y1) * dy) / len2))
+            d = math.hypot(x - (x1 + t*dx), y - (y1 + t*dy))
+            if ret is None or d < ret:
+                ret = d
+        return ret
+
+    def contains_tile(self, tile):
+        '''return true if any part of a tile may be within the region'''
+        (lat, lon) = tile.coord((mp_tile.TILES_WIDTH/2, mp_tile.TILES_HEIGHT/2))
+        (x, y) = self.project(lat, lon)
+        if self.inside(x, y):
+            return True
+        (width, height) = tile.size()
+        return self.distance(x, y) <= self.buffer + 0.5 * math.hypot(width, height)
+
+def bbox_region(lat1, lon1, lat2, lon2):
+    '''region for a bounding box'''
+    return SeedRegion([(lat1, lon1), (lat1, lon2), (lat2, lon2), (lat2, lon1)])
+
+def tile_list(mt, region, zoom):
+    '''return the tiles covering a region at one zoom level'''
+    (lat_min, lon_min, lat_max, lon_max) = region.bounds()
+    top_left = mt.coord_to_tile(lat_max, lon_min, zoom)
+    bottom_right = mt.coord_to_tile(lat_min, lon_max, zoom)
+    ret = []
+    for y in range(top_left.y, bottom_right.y+1):
+        for x in range(top_left.x, bottom_right.x+1):
+            tile = mp_tile.TileInfo((x,y), zoom, mt.service)
+            if region.contains_tile(tile):
+                ret.append(tile)
+    return ret
+
+def srtm_tiles(region):
+    '''return the (lat, lon) of the SRTM tiles covering a region'''
+    (lat_min, lon_min, lat_max, lon_max) = region.bounds()
+    ret = []
+    for lat in range(int(math.floor(lat_min)), int(math.floor(lat_max))+1):
+        for lon in range(int(math.floor(lon_min)), int(math.floor(lon_max))+1):
+            ret.append((lat, lon))
+    return ret
+
+class TileSeeder(object):
+    '''download the missing tiles for a region over a range of zooms'''
+    def __init__(self, mt, region, min_zoom, max_zoom):
+        self.mt = mt
+        self.region = region
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.tiles = []
+        self.missing = []
+        self.stopped = False
+        self.srtm_done = 0
+        self.srtm_total = 0
+
+    def scan(self):
+        '''list the tiles, and find the ones that need downloading'''
+        self.tiles = []
+        for zoom in range(self.min_zoom, self.max_zoom+1):
+            self.tiles.extend(tile_list(self.mt, self.region, zoom))
+        cached = self.mt.tiles_cached(self.tiles)
+        self.missing = [ t for t in self.tiles if t.key() not in cached ]
+        return len(self.missing)
+
+    def estimate(self):
+        '''return estimated download size in bytes'''
+        size = self.mt.average_tile_size()
+        if size is None:
+            size = DEFAULT_TILE_BYTES
+        return len(self.missing) * size
+
+    def summary(self):
+        return "%u tiles at zoom %u to %u, %u to download (about %.1f MB)" % (
+            len(self.tiles), self.min_zoom, self.max_zoom,
+            len(self.missing), self.estimate() / (1024.0*1024.0))
+
+    def progress(self):
+        '''return (done, total) for the tiles being downloaded'''
+        if not self.missing:
+            return (0, 0)
+        pending = self.mt.tiles_pending()
+        return (len(self.missing) - pending, len(self.missing))
+
+    def stop(self):
+        self.stopped = True
+        self.mt.cancel_all_downloads()
+
+    def run(self, callback=None, interval=2):
+        '''download the missing tiles, calling callback(done, total)
+        every interval seconds'''
+        for tile in self.missing:
+            self.mt.queue_download(tile)
+        last = 0
+        while self.mt.tiles_pending() > 0 and not self.stopped:
+            time.sleep(0.1)
+            if callback is not None and time.time() - last >= interval:
+                last = time.time()
+                (done, total) = self.progress()
+                callback(done, total)
+        if callback is not None:
+            (done, total) = self.progress()
+            callback(done, total)
+
+    def seed_srtm(self, elevation_model, timeout=60):
+        '''fetch the SRTM tiles for the region'''
+        tiles = srtm_tiles(self.region)
+        self.srtm_total = len(tiles)
+        self.srtm_done = 0
+        failed = []
+        for (lat, lon) in tiles:
+            if self.stopped:
+                break
+            if elevation_model.GetTile(lat, lon, timeout=timeout) is None:
+                failed.append((lat, lon))
+            self.srtm_done += 1
+        return failed
+
+def load_region(opts):
+    '''create a region from the command line options'''
+    if opts.bbox:
+        (lat1, lon1, lat2, lon2) = [ float(v) for v in opts.bbox.split(',') ]
+        region = bbox_region(lat1, lon1, lat2, lon2)
+    elif opts.polygon:
+        region = SeedRegion(mp_util.polygon_load(opts.polygon))
+    elif opts.mission:
+        from pymavlink import mavwp
+        wploader = mavwp.MAVWPLoader()
+        wploader.load(opts.mission)
+        region = SeedRegion(wploader.polygon(), closed=False)
+    elif opts.fence:
+        from pymavlink import mavwp
+        fenceloader = mavwp.MAVFenceLoader()
+        fenceloader.load(opts.fence)
+        region = SeedRegion(fenceloader.polygon())
+    else:
+        return None
+    region.buffer = opts.buffer
+    return region
+
+if __name__ == "__main__":
+
+    from optparse import OptionParser
+    parser = OptionParser("mp_tileseed.py [options]")
+    parser.add_option("--bbox", default=None, help="bounding box LAT1,LON1,LAT2,LON2")
+    parser.add_option("--polygon", default=None, help="polygon file")
+    parser.add_option("--mission", default=None, help="mission file")
+    parser.add_option("--fence", default=None, help="fence file")
+    parser.add_option("--buffer", type='float', default=500, help="buffer around the area in meters")
+    parser.add_option("--min-zoom", type='int', default=10, help="minimum zoom")
+    parser.add_option("--max-zoom", type='int', default=17, help="maximum zoom")
+    parser.add_option("--service", default="MicrosoftHyb", help="tile service")
+    parser.add_option("--url", default=None, help="custom tile server URL template, eg http://localhost:8080/${ZOOM}/${X}/${Y}.png")
+    parser.add_option("--cache-path", default=None, help="tile cache directory")
+    parser.add_option("--tile-store", default=None, help="tile store type (files or sqlite)")
+    parser.add_option("--workers", type='int', default=4, help="number of download threads")
+    parser.add_option("--delay", type='float', default=0.1, help="minimum interval between requests to a tile server")
+    parser.add_option("--srtm", action='store_true', default=False, help="also fetch SRTM terrain tiles")
+    parser.add_option("--dry-run", action='store_true', default=False, help="only show the tiles needed")
+    parser.add_option("--debug", action='store_true', default=False, help="show debug info")
+    (opts, args) = parser.parse_args()
+
+    region = load_region(opts)
+    if region is None:
+        print("Need one of --bbox, --polygon, --mission or --fence")
+        sys.exit(1)
+
+    service = opts.service
+    if opts.url is not None:
+        service = 'Custom'
+        mp_tile.TILE_SERVICES[service] = opts.url
+
+    mt = mp_tile.MPTile(cache_path=opts.cache_path, service=service,
+                        tile_delay=opts.delay, debug=opts.debug,
+                        download_workers=opts.workers, tile_store=opts.tile_store)
+    seeder = TileSeeder(mt, region, opts.min_zoom, opts.max_zoom)
+    seeder.scan()
+    print(seeder.summary())
+    if opts.dry_run:
+        if opts.srtm:
+            print("%u SRTM tiles" % len(srtm_tiles(region)))
+        sys.exit(0)
+
+    def show_progress(done, total):
+        print("Downloaded %u/%u tiles" % (done, total))
+
+    try:
+        seeder.run(show_progress)
+        if opts.srtm:
+            from MAVProxy.modules.mavproxy_map import mp_elevation
+            failed = seeder.seed_srtm(mp_elevation.ElevationModel(debug=opts.debug))
+            print("Fetched %u SRTM tiles, %u unavailable" % (seeder.srtm_total-len(failed), len(failed)))
+    except KeyboardInterrupt:
+        seeder.stop()
+        print("Stopped, run again to resume")
+    print("%u tiles fetched, %u failed" % mt.download_stats())
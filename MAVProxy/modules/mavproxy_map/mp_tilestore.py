@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+'''
+map tile cache storage
+
+Tiles are stored as encoded image bytes with the time they were
+fetched. Keys are TileInfo.key() tuples of ((x,y), zoom, service).
+
+DirectoryTileStore is the original layout of one file per tile under
+cache_path/service/zoom/y/x.img. SQLiteTileStore keeps each service in
+one MBTiles style SQLite file, cache_path/service.mbtiles, which is
+much faster with large caches on slow storage and is easy to copy
+between machines. Run this module to import a directory cache into
+SQLite files.
+'''
+
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from MAVProxy.modules.lib import mp_util
+
+class DirectoryTileStore(object):
+    '''one file per tile, with the file modification time as the fetch time'''
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+
+    def path(self, key):
+        '''return full path to a tile'''
+        ((x, y), zoom, service) = key
+        return os.path.join(self.cache_path, service,
+                            '%u' % zoom, '%u' % y, '%u.img' % x)
+
+    def get(self, key):
+        '''return (data, fetch_time) for a tile, or None'''
+        path = self.path(key)
+        try:
+            fetch_time = os.path.getmtime(path)
+            f = open(path, 'rb')
+            data = f.read()
+            f.close()
+        except (IOError, OSError):
+            return None
+        return (data, fetch_time)
+
+    def get_many(self, keys):
+        '''return a dictionary of key -> (data, fetch_time) for the
+        tiles that are in the store'''
+        ret = {}
+        for key in keys:
+            entry = self.get(key)
+            if entry is not None:
+                ret[key] = entry
+        return ret
+
+    def fetch_times(self, keys):
+        '''return a dictionary of key -> fetch_time for the tiles that
+        are in the store'''
+        ret = {}
+        for key in keys:
+            try:
+                ret[key] = os.path.getmtime(self.path(key))
+            except OSError:
+                pass
+        return ret
+
+    def put(self, key, data, fetch_time=None):
+        '''store a tile'''
+        path = self.path(key)
+        mp_util.mkdir_p(os.path.dirname(path))
+        h = open(path+'.tmp','wb')
+        h.write(data)
+        h.close()
+        try:
+            os.unlink(path)
+        except Exception:
+            pass
+        os.rename(path+'.tmp', path)
+        if fetch_time is not None:
+            os.utime(path, (fetch_time, fetch_time))
+
+    def average_size(self, service, samples=200):
+        '''return the average size of stored tiles, or None if empty'''
+        sizes = []
+        for (dirpath, dirnames, filenames) in os.walk(os.path.join(self.cache_path, service)):
+            for f in filenames:
+                if f.endswith('.img'):
+                    sizes.append(os.path.getsize(os.path.join(dirpath, f)))
+                    if len(sizes) >= samples:
+                        return sum(sizes) // len(sizes)
+        if not sizes:
+            return None
+        return sum(sizes) // len(sizes)
+
+    def tiles(self, service):
+        '''iterate over (key, path) for all tiles of a service'''
+        top = os.path.join(self.cache_path, service)
+        for (dirpath, dirnames, filenames) in os.walk(top):
+            rel = os.path.relpath(dirpath, top).split(os.sep)
+            if len(rel) != 2 or not rel[0].isdigit() or not rel[1].isdigit():
+                continue
+            (zoom, y) = (int(rel[0]), int(rel[1]))
+            for f in filenames:
+                if f.endswith('.img') and f[:-4].isdigit():
+                    yield (((int(f[:-4]), y), zoom, service), os.path.join(dirpath, f))
+
+    def services(self):
+        '''return the services with tiles in the store'''
+        ret = []
+        for d in sorted(os.listdir(self.cache_path)):
+            if os.path.isdir(os.path.join(self.cache_path, d)) and d != 'SRTM':
+                ret.append(d)
+        return ret
+
+    def close(self):
+        pass
+
+class SQLiteTileStore(object):
+    '''one MBTiles style SQLite file per service. The tiles table has
+    the standard MBTiles columns plus the fetch time. Each thread uses
+    its own connection'''
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.created = set()
+
+    def filename(self, service):
+        return os.path.join(self.cache_path, service + '.mbtiles')
+
+    def db(self, service):
+        '''return this thread's connection for a service'''
+        conns = getattr(self.local, 'conns', None)
+        if conns is None:
+            conns = {}
+            self.local.conns = conns
+        conn = conns.get(service, None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename(service), timeout=30)
+            with self.lock:
+                if service not in self.created:
+                    self.create(conn, service)
+                    self.created.add(service)
+            conns[service] = conn
+        return conn
+
+    def create(self, conn, service):
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+        conn.execute('''CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER,
+                        tile_row INTEGER, tile_data BLOB, fetch_time REAL,
+                        PRIMARY KEY (zoom_level, tile_column, tile_row))''')
+        conn.execute("INSERT OR IGNORE INTO metadata VALUES ('name', ?)", (service,))
+        conn.execute("INSERT OR IGNORE INTO metadata VALUES ('format', 'jpg')")
+        conn.commit()
+
+    @staticmethod
+    def row(zoom, y):
+        '''MBTiles rows count from the bottom'''
+        return (1<<zoom) - 1 - y
+
+    def get(self, key):
+        '''return (data, fetch_time) for a tile, or None'''
+        ((x, y), zoom, service) = key
+        cur = self.db(service).execute(
+            "SELECT tile_data, fetch_time FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+            (zoom, x, self.row(zoom, y)))
+        r = cur.fetchone()
+        if r is None:
+            return None
+        return (bytes(r[0]), r[1])
+
+    def query_many(self, keys, columns):
+        '''query a set of tiles with one range query per service and zoom'''
+        groups = {}
+        for key in keys:
+            ((x, y), zoom, service) = key
+            groups.setdefault((service, zoom), set()).add((x, y))
+        for ((service, zoom), wanted) in groups.items():
+            xs = [ w[0] for w in wanted ]
+            rows = [ self.row(zoom, w[1]) for w in wanted ]
+            cur = self.db(service).execute(
+                "SELECT tile_column, tile_row, %s FROM tiles WHERE zoom_level=? AND "
+                "tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?" % columns,
+                (zoom, min(xs), max(xs), min(rows), max(rows)))
+            for r in cur:
+                tile = (r[0], self.row(zoom, r[1]))
+                if tile in wanted:
+                    yield ((tile, zoom, service), r[2:])
+
+    def get_many(self, keys):
+        '''return a dictionary of key -> (data, fetch_time) for the
+        tiles that are in the store'''
+        ret = {}
+        for (key, r) in self.query_many(keys, "tile_data, fetch_time"):
+            ret[key] = (bytes(r[0]), r[1])
+        return ret
+
+    def fetch_times(self, keys):
+        '''return a dictionary of key -> fetch_time for the tiles that
+        are in the store'''
+        ret = {}
+        for (key, r) in self.query_many(keys, "fetch_time"):
+            ret[key] = r[0]
+        return ret
+
+    def put(self, key, data, fetch_time=None, commit=True):
+        '''store a tile'''
+        ((x, y), zoom, service) = key
+        if fetch_time is None:
+            fetch_time = time.time()
+        conn = self.db(service)
+        conn.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?)",
+                     (zoom, x, self.row(zoom, y), sqlite3.Binary(data), fetch_time))
+        if commit:
+            conn.commit()
+
+    def commit(self, service):
+        self.db(service).commit()
+
+    def average_size(self, service, samples=200):
+        '''return the average size of stored tiles, or None if empty'''
+        if not os.path.exists(self.filename(service)):
+            return None
+        cur = self.db(service).execute(
+            "SELECT AVG(LENGTH(tile_data)) FROM (SELECT tile_data FROM tiles LIMIT ?)", (samples,))
+        r = cur.fetchone()
+        if r is None or r[0] is None:
+            return None
+        return int(r[0])
+
+    def close(self):
+        conns = getattr(self.local, 'conns', {})
+        for conn in conns.values():
+            conn.close()
+        self.local.conns = {}
+
+TILE_STORES = {
+    'files' : DirectoryTileStore,
+    'sqlite' : SQLiteTileStore,
+    }
+
+def open_store(cache_path, store_type=None):
+    '''open a tile store. The type defaults to the MAP_TILE_STORE
+    environment variable, or files'''
+    if store_type is None:
+        store_type = os.environ.get('MAP_TILE_STORE', 'files')
+    if store_type not in TILE_STORES:
+        raise ValueError("unknown tile store %s" % store_type)
+    return TILE_STORES[store_type](cache_path)
+
+def import_directory(cache_path, services=None, progress=None):
+    '''import a directory tile cache into SQLite stores. Returns the
+    number of tiles imported'''
+    src = DirectoryTileStore(cache_path)
+    dst = SQLiteTileStore(cache_path)
+    if services is None:
+        services = src.services()
+    count = 0
+    for service in services:
+        for (key, path) in src.tiles(service):
+            try:
+                fetch_time = os.path.getmtime(path)
+                f = open(path, 'rb')
+                data = f.read()
+                f.close()
+            except (IOError, OSError):
+                continue
+            dst.put(key, data, fetch_time, commit=False)
+            count += 1
+            if count % 1000 == 0:
+                dst.commit(service)
+                if progress is not None:
+                    progress(service, count)
+        dst.commit(service)
+    dst.close()
+    return count
+
+if __name__ == "__main__":
+
+    from optparse import OptionParser
+    parser = OptionParser("mp_tilestore.py [options]")
+    parser.add_option("--cache-path", default=None, help="tile cache directory")
+    parser.add_option("--service", action='append', default=None, help="service to import (default all)")
+    (opts, args) = parser.parse_args()
+
+    cache_path = opts.cache_path
+    if cache_path is None:
+        from MAVProxy.modules.mavproxy_map import mp_tile
+        cache_path = mp_tile.default_cache_path()
+
+    def show_progress(service, count):
+        sys.stdout.write("\r%s: imported %u tiles" % (service, count))
+        sys.stdout.flush()
+
+    t0 = time.time()
+    count = import_directory(cache_path, opts.service, show_progress)
+    print("\nImported %u tiles in %.1fs. Set MAP_TILE_STORE=sqlite to use them" % (count, time.time()-t0))
@@ -21,12 +21,23 @@ import os
 import zipfile
 import array
 import math
+import threading
+from collections import OrderedDict
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import multiproc
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 childTileDownload = {}
 childFileListDownload = {}
 filelistDownloadActive = 0
+# tiles may be looked up from more than one thread, such as the terrain
+# precompute thread. This lock makes checking for a running download and
+# starting a new one a single step, so a tile is only downloaded once
+download_lock = threading.RLock()
 
 class NoSuchTileError(Exception):
     """Raised when there is no tile for a region."""
@@ -127,11 +138,12 @@ class SRTMDownloader():
         global childFileListDownload
         global filelistDownloadActive
         mypid = os.getpid()
-        if mypid not in childFileListDownload or not childFileListDownload[mypid].is_alive():
-            childFileListDownload[mypid] = multiproc.Process(target=self.createFileListHTTP)
-            filelistDownloadActive = 1
-            childFileListDownload[mypid].start()
-            filelistDownloadActive = 0
+        with download_lock:
+            if mypid not in childFileListDownload or not childFileListDownload[mypid].is_alive():
+                childFileListDownload[mypid] = multiproc.Process(target=self.createFileListHTTP)
+                filelistDownloadActive = 1
+                childFileListDownload[mypid].start()
+                filelistDownloadActive = 0
 
     def getURIWithRedirect(self, url):
         '''fetch a URL with redirect handling'''
@@ -239,6 +251,11 @@ class SRTMDownloader():
         """Get a SRTM tile object. This function can return either an SRTM1 or
             SRTM3 object depending on what is available, however currently it
             only returns SRTM3 objects."""
+        with download_lock:
+            return self._getTile(lat, lon)
+
+    def _getTile(self, lat, lon):
+        """getTile() with download_lock held"""
         global childFileListDownload
         global filelistDownloadActive
         mypid = os.getpid()
@@ -280,8 +297,8 @@ class SRTMDownloader():
         elif mypid in childTileDownload and childTileDownload[mypid].is_alive():
             '''print("Still Getting Tile")'''
             return 0
-        # TODO: Currently we create a new tile object each time.
-        # Caching is required for improved performance.
+        # tiles are memory mapped, so creating a tile object is cheap
+        # after the first use. Callers should keep tiles in a TileCache
         try:
             return SRTMTile(os.path.join(self.cachedir, filename), int(lat), int(lon))
         except InvalidTileError:
@@ -317,24 +334,57 @@ class SRTMTile:
         only have to look at a single tile.
         """
     def __init__(self, f, lat, lon):
+        self.lat = lat
+        self.lon = lon
+        if numpy is not None:
+            self.data = self.load_raw(f)
+        else:
+            self.data = array.array('h', self.unzip(f))
+            if sys.byteorder == 'little':
+                self.data.byteswap()
+        self.size = int(math.sqrt(len(self.data)))
+        # Currently only SRTM1/3 is supported
+        if self.size not in (1201, 3601) or len(self.data) != self.size * self.size:
+            raise InvalidTileError(lat, lon)
+
+    def unzip(self, f):
+        """return the big-endian sample data from a .hgt.zip file"""
         try:
             zipf = zipfile.ZipFile(f, 'r')
+            names = zipf.namelist()
+            if len(names) != 1:
+                raise InvalidTileError(self.lat, self.lon)
+            data = zipf.read(names[0])
+            zipf.close()
+        except InvalidTileError:
+            raise
         except Exception:
-            raise InvalidTileError(lat, lon)
-        names = zipf.namelist()
-        if len(names) != 1:
-            raise InvalidTileError(lat, lon)
-        data = zipf.read(names[0])
-        self.size = int(math.sqrt(len(data)/2)) # 2 bytes per sample
-        # Currently only SRTM1/3 is supported
-        if self.size not in (1201, 3601):
-            raise InvalidTileError(lat, lon)
-        self.data = array.array('h', data)
-        self.data.byteswap()
-        if len(self.data) != self.size * self.size:
-            raise InvalidTileError(lat, lon)
-        self.lat = lat
-        self.lon = lon
+            raise InvalidTileError(self.lat, self.lon)
+        if len(data) not in (1201*1201*2, 3601*3601*2):
+            raise InvalidTileError(self.lat, self.lon)
+        return data
+
+    def load_raw(self, f):
+        """memory map the native-endian decompressed tile, creating it
+            from the zip file the first time the tile is used"""
+        rawname = raw_filename(f)
+        try:
+            stale = os.path.getmtime(rawname) < os.path.getmtime(f)
+        except OSError:
+            stale = True
+        if stale:
+            data = numpy.frombuffer(self.unzip(f), dtype='>i2').astype(numpy.int16)
+            tmpname = rawname + ".tmp%u" % os.getpid()
+            data.tofile(tmpname)
+            try:
+                os.unlink(rawname)
+            except OSError:
+                pass
+            os.rename(tmpname, rawname)
+        try:
+            return numpy.memmap(rawname, dtype=numpy.int16, mode='r')
+        except Exception:
+            raise InvalidTileError(self.lat, self.lon)
 
     @staticmethod
     def _avg(value1, value2, weight):
@@ -376,7 +426,7 @@ class SRTMTile:
         # Same as calcOffset, inlined for performance reasons
         offset = x + self.size * (self.size - y - 1)
         #print(offset)
-        value = self.data[offset]
+        value = int(self.data[offset])
         if value == -32768:
             return -1 # -32768 is a special value for areas with no data
         return value
@@ -411,6 +461,81 @@ class SRTMTile:
         #        value00, value10, value1, value01, value11, value2, value))
         return value
 
+    def getAltitudeArray(self, lats, lons):
+        """Get the altitudes of arrays of lat lon pairs inside this tile,
+            interpolating the same way as getAltitudeFromLatLon.
+        """
+        x = (numpy.asarray(lons, dtype=float) - self.lon) * (self.size - 1)
+        y = (numpy.asarray(lats, dtype=float) - self.lat) * (self.size - 1)
+        if len(x) and (x.min() < 0 or x.max() >= self.size - 1 or
+                       y.min() < 0 or y.max() >= self.size - 1):
+            raise WrongTileError(self.lat, self.lon, self.lat+y.min()/(self.size-1), self.lon+x.min()/(self.size-1))
+        x_int = x.astype(int)
+        y_int = y.astype(int)
+        x_frac = x - x_int
+        y_frac = y - y_int
+        data = numpy.asarray(self.data)
+        # offsets of the (x_int, y_int) and (x_int, y_int+1) pixels, see calcOffset
+        offset0 = x_int + self.size * (self.size - y_int - 1)
+        offset1 = offset0 - self.size
+        value00 = data[offset0].astype(float)
+        value10 = data[offset0+1].astype(float)
+        value01 = data[offset1].astype(float)
+        value11 = data[offset1+1].astype(float)
+        for v in (value00, value10, value01, value11):
+            v[v == -32768] = -1 # -32768 is a special value for areas with no data
+        value1 = value10 * x_frac + value00 * (1 - x_frac)
+        value2 = value11 * x_frac + value01 * (1 - x_frac)
+        return value2 * y_frac + value1 * (1 - y_frac)
+
+def raw_filename(f):
+    """name of the native-endian decompressed file for a .hgt.zip tile"""
+    if f.endswith(".zip"):
+        f = f[:-4]
+    return "%s.%s.raw" % (f, sys.byteorder)
+
+class TileCache(object):
+    """bounded least recently used cache of open tiles, keyed by
+        (cachedir, lat, lon). One cache is shared by all users of SRTM
+        data in a process"""
+    def __init__(self, max_tiles=16):
+        self.max_tiles = max_tiles
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """return a cached tile or None"""
+        with self.lock:
+            tile = self.tiles.pop(key, None)
+            if tile is None:
+                self.misses += 1
+                return None
+            self.tiles[key] = tile
+            self.hits += 1
+            return tile
+
+    def put(self, key, tile):
+        """add a tile, closing the least recently used tile if full"""
+        with self.lock:
+            self.tiles.pop(key, None)
+            self.tiles[key] = tile
+            while len(self.tiles) > self.max_tiles:
+                self.tiles.popitem(last=False)
+
+    def set_max_tiles(self, max_tiles):
+        with self.lock:
+            self.max_tiles = max(1, max_tiles)
+            while len(self.tiles) > self.max_tiles:
+                self.tiles.popitem(last=False)
+
+    def __len__(self):
+        return len(self.tiles)
+
+# the process wide tile cache
+tile_cache = TileCache()
+
 class SRTMOceanTile(SRTMTile):
     '''a tile for areas of zero altitude'''
     def __init__(self, lat, lon):
@@ -420,6 +545,9 @@ class SRTMOceanTile(SRTMTile):
     def getAltitudeFromLatLon(self, lat, lon):
         return 0
 
+    def getAltitudeArray(self, lats, lons):
+        return numpy.zeros(len(lats))
+
 
 class parseHTMLDirectoryListing(HTMLParser):
 
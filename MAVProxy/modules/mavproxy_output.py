@@ -2,6 +2,8 @@
 '''enable run-time addition and removal of UDP clients , just like --out on the cnd line'''
 ''' TO USE:
     output add 10.11.12.13:14550
+    output add 10.11.12.13:14551 allow=HEARTBEAT,GPS*,ATTITUDE rate=ATTITUDE:2
+    output add 10.11.12.13:14552 deny=PARAM_VALUE,RC_CHANNELS*
     output list
     output remove 3      # to remove 3rd output
 '''
@@ -11,6 +13,7 @@ from pymavlink import mavutil
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_forward
 
 class OutputModule(mp_module.MPModule):
     def __init__(self, mpstate):
@@ -23,8 +26,8 @@ class OutputModule(mp_module.MPModule):
         if len(args) < 1 or args[0] == "list":
             self.cmd_output_list()
         elif args[0] == "add":
-            if len(args) != 2:
-                print("Usage: output add OUTPUT")
+            if len(args) < 2:
+                print("Usage: output add OUTPUT [allow=TYPES] [deny=TYPES] [rate=TYPE:HZ,...]")
                 return
             self.cmd_output_add(args[1:])
         elif args[0] == "remove":
@@ -45,16 +48,58 @@ class OutputModule(mp_module.MPModule):
         print("%u outputs" % len(self.mpstate.mav_outputs))
         for i in range(len(self.mpstate.mav_outputs)):
             conn = self.mpstate.mav_outputs[i]
-            print("%u: %s" % (i, conn.address))
+            print("%u: %s (%s)" % (i, conn.address, self.output_counters(conn)))
+            filt = getattr(conn, 'fwd_filter', None)
+            if filt is not None:
+                print("   %s (%u filtered, %u decimated)" % (str(filt), filt.filtered, filt.decimated))
         if len(self.mpstate.sysid_outputs) > 0:
             print("%u sysid outputs" % len(self.mpstate.sysid_outputs))
             for sysid in self.mpstate.sysid_outputs:
                 conn = self.mpstate.sysid_outputs[sysid]
-                print("%u: %s" % (sysid, conn.address))
+                print("%u: %s (%s)" % (sysid, conn.address, self.output_counters(conn)))
+
+    def output_counters(self, conn):
+        '''return forwarding counters for an output as a string'''
+        ret = "%u packets, %u bytes" % (getattr(conn, 'fwd_packets', 0),
+                                         getattr(conn, 'fwd_bytes', 0))
+        errors = getattr(conn, 'fwd_errors', 0)
+        if errors:
+            ret += ", %u write errors" % errors
+        return ret
+
+    def parse_output_filter(self, args):
+        '''parse allow=, deny= and rate= options into an OutputFilter,
+        returning None if there are no options'''
+        allow = None
+        deny = None
+        rates = {}
+        for a in args:
+            if not '=' in a:
+                raise ValueError("bad option %s" % a)
+            (key, value) = a.split('=', 1)
+            items = [ v for v in value.split(',') if v ]
+            if key == 'allow':
+                allow = items
+            elif key == 'deny':
+                deny = items
+            elif key == 'rate':
+                for item in items:
+                    (mtype, rate) = item.split(':')
+                    rates[mtype] = float(rate)
+            else:
+                raise ValueError("unknown option %s" % key)
+        if allow is None and deny is None and not rates:
+            return None
+        return mp_forward.OutputFilter(allow=allow, deny=deny, rates=rates)
 
     def cmd_output_add(self, args):
         '''add new output'''
         device = args[0]
+        try:
+            filt = self.parse_output_filter(args[1:])
+        except ValueError as ex:
+            print("Bad output options: %s" % ex)
+            return
         print("Adding output %s" % device)
         try:
             conn = mavutil.mavlink_connection(device, input=False, source_system=self.settings.source_system)
@@ -62,7 +107,9 @@ class OutputModule(mp_module.MPModule):
         except Exception:
             print("Failed to connect to %s" % device)
             return
+        conn.fwd_filter = filt
         self.mpstate.mav_outputs.append(conn)
+        self.mpstate.select_registry.add_connection(conn, 'output')
         try:
             mp_util.child_fd_list_add(conn.port.fileno())
         except Exception:
@@ -84,8 +131,10 @@ class OutputModule(mp_module.MPModule):
         except Exception:
             pass
         if sysid in self.mpstate.sysid_outputs:
+            self.mpstate.select_registry.remove_connection(self.mpstate.sysid_outputs[sysid])
             self.mpstate.sysid_outputs[sysid].close()
         self.mpstate.sysid_outputs[sysid] = conn
+        self.mpstate.select_registry.add_connection(conn, 'output')
 
     def cmd_output_remove(self, args):
         '''remove an output'''
@@ -94,6 +143,7 @@ class OutputModule(mp_module.MPModule):
             conn = self.mpstate.mav_outputs[i]
             if str(i) == device or conn.address == device:
                 print("Removing output %s" % conn.address)
+                self.mpstate.select_registry.remove_connection(conn)
                 try:
                     mp_util.child_fd_list_add(conn.port.fileno())
                 except Exception:
@@ -104,6 +154,8 @@ class OutputModule(mp_module.MPModule):
 
     def idle_task(self):
         '''called on idle'''
+        # send any rate limited packets that are now due
+        self.mpstate.forwarder.send_due(self.mpstate.mav_outputs)
         for m in self.mpstate.mav_outputs:
             m.source_system = self.settings.source_system
             m.mav.srcSystem = m.source_system
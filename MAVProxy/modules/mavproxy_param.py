@@ -6,13 +6,51 @@ from pymavlink import mavutil, mavparm
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import multiproc
+from MAVProxy.modules.lib import mp_paramfetch
+from MAVProxy.modules.lib import mp_paramcache
+from MAVProxy.modules.lib import mp_parammeta
+from MAVProxy.modules.lib import mp_paramset
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import *
 
+# seconds to wait for AUTOPILOT_VERSION before fetching without the cache
+CACHE_IDENTIFY_TIMEOUT = 3
+# seconds to wait for the vehicle to confirm the cached parameters
+CACHE_VALIDATE_TIMEOUT = 3
+# minimum seconds between saves of the cache when parameters change
+CACHE_SAVE_INTERVAL = 5
+
+def read_param_file(filename, wildcard='*'):
+    '''return a list of (name, value) from a parameter file, parsed as
+    MAVParmDict.load does, or None if the file can't be read'''
+    try:
+        f = open(filename, mode='r')
+    except Exception as e:
+        print("Failed to open file '%s': %s" % (filename, str(e)))
+        return None
+    ret = []
+    for line in f:
+        line = line.split('#')[0].strip()
+        if not line:
+            continue
+        a = line.replace(',',' ').split()
+        if len(a) != 2 or not fnmatch.fnmatch(a[0].upper(), wildcard.upper()):
+            continue
+        try:
+            if a[1].lower().startswith('0x'):
+                value = int(a[1][2:], 16)
+            else:
+                value = float(a[1])
+        except ValueError:
+            continue
+        ret.append((a[0], value))
+    f.close()
+    return ret
+
 class ParamState:
     '''this class is separated to make it possible to use the parameter
        functions on a secondary connection'''
-    def __init__(self, mav_param, logdir, vehicle_name, parm_file):
+    def __init__(self, mav_param, logdir, vehicle_name, parm_file, cache=None):
         self.mav_param_set = set()
         self.mav_param_count = 0
         self.param_period = mavutil.periodic_event(1)
@@ -21,11 +59,33 @@ class ParamState:
         self.logdir = logdir
         self.vehicle_name = vehicle_name
         self.parm_file = parm_file
-        self.fetch_set = None
+        self.fetcher = mp_paramfetch.ParamFetcher()
         self.xml_filepath = None
         self.new_sysid_timestamp = time.time()
         self.autopilot_type_by_sysid = {}
         self.param_types = {}
+        # index -> (name, value, type) of received parameters
+        self.param_index = {}
+        self.setter = None
+        self.mpstate = None
+        self.cache = cache
+        self.cache_key = None
+        self.cache_entry = None
+        self.cache_hash = None
+        self.cache_count_ok = False
+        self.cache_changed = False
+        self.cache_saved = 0
+        self.cache_period = mavutil.periodic_event(1)
+        # the identify timeout starts when the vehicle is first heard
+        self.cache_time = None
+        # names of cached parameters the vehicle has not sent yet, and
+        # the fetcher that refreshes them
+        self.cache_unconfirmed = set()
+        self.cache_refresh = None
+        if cache is not None:
+            self.cache_state = 'identify'
+        else:
+            self.cache_state = None
 
     def handle_px4_param_value(self, m):
         '''special handling for the px4 style of PARAM_VALUE'''
@@ -70,11 +130,17 @@ class ParamState:
         if m.get_type() == 'PARAM_VALUE':
             value = self.handle_px4_param_value(m)
             param_id = "%.16s" % m.param_id
+            if param_id == '_HASH_CHECK':
+                self.cache_check_hash(master, m.param_value)
+                return
+            if self.cache_state == 'validate':
+                self.cache_validate(master, m.param_count)
             # Note: the xml specifies param_index is a uint16, so -1 in that field will show as 65535
             # We accept both -1 and 65535 as 'unknown index' to future proof us against someday having that
             # xml fixed.
-            if self.fetch_set is not None:
-                self.fetch_set.discard(m.param_index)
+            self.fetcher.received(m.param_index, m.param_count)
+            if self.cache_refresh is not None:
+                self.cache_refresh.received(m.param_index, m.param_count)
             if m.param_index != -1 and m.param_index != 65535 and m.param_index not in self.mav_param_set:
                 added_new_parameter = True
                 self.mav_param_set.add(m.param_index)
@@ -83,6 +149,18 @@ class ParamState:
             if m.param_count != -1:
                 self.mav_param_count = m.param_count
             self.mav_param[str(param_id)] = value
+            self.cache_unconfirmed.discard(str(param_id))
+            if self.cache_refresh is not None and (self.cache_refresh.complete() or not self.cache_unconfirmed):
+                refresh = self.cache_refresh
+                self.cache_refresh = None
+                self.fetch_complete(master, "Refreshed %u cached parameters (%.1f params/s)" % (
+                    refresh.nreceived, refresh.rate()))
+            if m.param_index != -1 and m.param_index != 65535:
+                self.param_index[m.param_index] = (str(param_id), value, m.param_type)
+                self.cache_changed = True
+            if self.setter is not None:
+                self.setter.received(param_id, value)
+                self.set_check(master)
             if param_id in self.fetch_one and self.fetch_one[param_id] > 0:
                 self.fetch_one[param_id] -= 1
                 if isinstance(value, float):
@@ -90,35 +168,247 @@ class ParamState:
                 else:
                     print("%s = %s" % (param_id, str(value)))
             if added_new_parameter and len(self.mav_param_set) == m.param_count:
-                print("Received %u parameters" % m.param_count)
-                if self.logdir is not None:
-                    self.mav_param.save(os.path.join(self.logdir, self.parm_file), '*', verbose=True)
-                self.fetch_set = None
-            if self.fetch_set is not None and len(self.fetch_set) == 0:
+                self.fetch_complete(master, "Received %u parameters (%.1f params/s)" % (
+                    m.param_count, self.fetcher.rate()))
+            elif self.fetcher.inflight:
+                # a reply frees space in the request window
                 self.fetch_check(master, force=True)
         elif m.get_type() == 'HEARTBEAT':
             if m.get_srcComponent() == 1:
                 # remember autopilot types so we can handle PX4 parameters
                 self.autopilot_type_by_sysid[m.get_srcSystem()] = m.autopilot
+            if self.cache_state == 'identify' and self.cache_time is None:
+                self.cache_time = time.time()
+        elif m.get_type() == 'AUTOPILOT_VERSION':
+            if self.cache_state == 'identify':
+                self.cache_identify(master, m)
+            elif self.cache is not None and self.cache_key is None:
+                # too late to use the cache, but we can still save it
+                uid = mp_paramcache.vehicle_uid(m)
+                if uid is not None:
+                    self.cache_key = (m.get_srcSystem(), m.get_srcComponent(), uid)
+                    self.cache_changed = True
+
+    def fetch_complete(self, master, msg=None, check_hash=True):
+        '''all parameters are known: report it, save them in the log
+        directory and ask for the parameter hash for the cache'''
+        if msg is not None:
+            print(msg)
+        if self.logdir is not None:
+            self.mav_param.save(os.path.join(self.logdir, self.parm_file), '*', verbose=True)
+        if check_hash and self.cache_key is not None and master is not None:
+            # vehicles that support it reply with a hash of all parameters
+            master.param_fetch_one('_HASH_CHECK')
+
+    def cache_identify(self, master, m):
+        '''load the cached parameters for a vehicle once we know its
+        unique ID, and ask the vehicle for its parameter count and hash'''
+        self.cache_state = None
+        uid = mp_paramcache.vehicle_uid(m)
+        if uid is None:
+            return
+        (sysid, compid) = (m.get_srcSystem(), m.get_srcComponent())
+        self.cache_key = (sysid, compid, uid)
+        entry = self.cache.load(self.cache_key)
+        if entry is None or len(self.mav_param_set) != 0 or master is None:
+            return
+        px4 = (self.autopilot_type_by_sysid.get(sysid,-1) == mavutil.mavlink.MAV_AUTOPILOT_PX4 or
+               compid == mavutil.mavlink.MAV_COMP_ID_UDP_BRIDGE)
+        for (name, value, ptype) in entry['params'].values():
+            self.mav_param[name] = value
+            if px4 and ptype != mavutil.mavlink.MAV_PARAM_TYPE_REAL32:
+                self.param_types[name.upper()] = ptype
+        print("Loaded %u cached parameters" % len(entry['params']))
+        self.cache_entry = entry
+        self.cache_state = 'validate'
+        self.cache_time = time.time()
+        self.cache_count_ok = False
+        # any parameter will tell us the count
+        master.param_fetch_one(0)
+        if entry['hash'] is not None:
+            master.param_fetch_one('_HASH_CHECK')
+
+    def cache_validate(self, master, count):
+        '''check the parameter count against the cache'''
+        if count != self.cache_entry['count']:
+            print("Parameter count changed from %u to %u" % (self.cache_entry['count'], count))
+            self.cache_reject(master)
+            return
+        self.cache_count_ok = True
+        if self.cache_entry['hash'] is None:
+            self.cache_accept(master, confirmed=False)
+
+    def cache_check_hash(self, master, value):
+        '''handle the parameter hash from the vehicle'''
+        h = mp_paramcache.hash_value(value)
+        if self.cache_hash != h:
+            self.cache_hash = h
+            self.cache_changed = True
+        if self.cache_state != 'validate':
+            return
+        if h == self.cache_entry['hash']:
+            self.cache_accept(master)
+        else:
+            print("Parameter hash changed")
+            self.cache_reject(master)
+
+    def cache_accept(self, master, confirmed=True):
+        '''use the cached parameters, fetching only those missing from
+        the cache. If the hash did not confirm the values they are
+        refreshed in the background, and marked unconfirmed until then'''
+        entry = self.cache_entry
+        count = entry['count']
+        indices = [ idx for idx in entry['params'].keys() if idx < count ]
+        for idx in indices:
+            if idx not in self.param_index:
+                self.param_index[idx] = entry['params'][idx]
+        self.mav_param_set.update(indices)
+        self.mav_param_count = count
+        self.fetcher.reset()
+        self.fetcher.preload(self.mav_param_set, count)
+        self.cache_hash = entry['hash']
+        self.cache_state = None
+        self.cache_entry = None
+        print("Using %u cached parameters, %u to fetch" % (len(indices), count - len(indices)))
+        if self.fetcher.complete():
+            # no PARAM_VALUE will complete the set. The hash is already
+            # known, or is asked for once the refresh finishes
+            self.fetch_complete(master, check_hash=False)
+        if not confirmed:
+            self.cache_unconfirmed = set([ entry['params'][idx][0] for idx in indices ])
+            self.cache_refresh = mp_paramfetch.ParamFetcher()
+            self.cache_refresh.set_count(count)
+            if master is not None:
+                master.param_fetch_all()
+
+    def cache_reject(self, master):
+        '''discard the cached parameters and fetch them all'''
+        for (name, value, ptype) in self.cache_entry['params'].values():
+            self.mav_param.pop(name, None)
+        self.cache_unconfirmed = set()
+        self.cache_refresh = None
+        self.cache_state = None
+        self.cache_entry = None
+        self.mav_param_set = set()
+        self.param_index = {}
+        self.fetcher.reset()
+        self.fetch_check(master, force=True)
+
+    def cache_update(self, master):
+        '''wait for the vehicle identity and cache validation, and save
+        the cache when parameters have changed. Returns True while the
+        parameter download should wait for the cache'''
+        now = time.time()
+        if self.cache_state == 'identify':
+            if len(self.mav_param_set) != 0:
+                self.cache_state = None
+                return False
+            if self.cache_time is None:
+                # wait to hear from the vehicle
+                return True
+            if now - self.cache_time > CACHE_IDENTIFY_TIMEOUT:
+                self.cache_state = None
+                return False
+            if self.cache_period.trigger():
+                master.mav.command_long_send(master.target_system, master.target_component,
+                                             mavutil.mavlink.MAV_CMD_REQUEST_AUTOPILOT_CAPABILITIES,
+                                             0, 1, 0, 0, 0, 0, 0, 0)
+            return True
+        if self.cache_state == 'validate':
+            if now - self.cache_time <= CACHE_VALIDATE_TIMEOUT:
+                return True
+            if self.cache_count_ok:
+                # the vehicle does not support the hash, so trust the count
+                # until the values are refreshed
+                self.cache_accept(master, confirmed=False)
+            else:
+                print("No reply to cache check")
+                self.cache_reject(master)
+            return False
+        if (self.cache_key is not None and self.cache_changed and
+            now - self.cache_saved > CACHE_SAVE_INTERVAL and
+            self.mav_param_count > 0 and len(self.mav_param_set) == self.mav_param_count):
+            self.cache.save(self.cache_key, self.mav_param_count, self.param_index, self.cache_hash)
+            self.cache_changed = False
+            self.cache_saved = now
+        return False
 
     def fetch_check(self, master, force=False):
-        '''check for missing parameters periodically'''
-        if self.param_period.trigger() or force:
-            if master is None:
-                return
-            if len(self.mav_param_set) == 0:
+        '''request all parameters until some arrive, then re-request
+        missing parameters by index'''
+        if master is None:
+            return
+        if self.cache is not None and self.cache_update(master):
+            return
+        if len(self.mav_param_set) == 0:
+            if self.param_period.trigger() or force:
                 master.param_fetch_all()
-            elif self.mav_param_count != 0 and len(self.mav_param_set) != self.mav_param_count:
-                if master.time_since('PARAM_VALUE') >= 1 or force:
-                    diff = set(range(self.mav_param_count)).difference(self.mav_param_set)
-                    count = 0
-                    while len(diff) > 0 and count < 10:
-                        idx = diff.pop()
-                        master.param_fetch_one(idx)
-                        if self.fetch_set is None:
-                            self.fetch_set = set()
-                        self.fetch_set.add(idx)
-                        count += 1
+            return
+        self.fetcher.update(master)
+        if self.cache_refresh is not None:
+            self.cache_refresh.update(master)
+
+    def set_check(self, master):
+        '''send pending parameter sets, and report when they are done'''
+        if self.setter is None or master is None:
+            return
+        self.setter.update(master)
+        if self.setter.done():
+            print(self.setter.summary())
+            self.setter = None
+
+    def start_set(self, master, changes, unchanged=[]):
+        '''start setting a list of (name, old_value, new_value), adding
+        to any sets already running'''
+        if self.setter is None:
+            self.setter = mp_paramset.ParamSetter(changes, unchanged, ptypes=self.param_types)
+            self.setter.on_confirm = self.param_confirmed
+        else:
+            self.setter.add(changes, unchanged)
+        self.set_check(master)
+
+    def param_confirmed(self, name, value):
+        '''a parameter set has been confirmed by the vehicle'''
+        if self.mpstate is not None and name in ["WP_LOITER_RAD", "LAND_BREAK_PATH"]:
+            #need to redraw rally points
+            if self.mpstate.module('rally') is not None:
+                self.mpstate.module('rally').set_last_change(time.time())
+            #need to redraw loiter points
+            if self.mpstate.module('wp') is not None:
+                self.mpstate.module('wp').wploader.last_change = time.time()
+
+    def param_load(self, master, args, check=True):
+        '''load parameters from a file, setting those that differ'''
+        dry_run = False
+        for flag in ["-n", "--dry-run"]:
+            if flag in args:
+                args.remove(flag)
+                dry_run = True
+        if len(args) < 1:
+            print("Usage: param load <filename> [wildcard] [--dry-run]")
+            return
+        filename = args[0].strip('"')
+        if len(args) > 1:
+            param_wildcard = args[1]
+        else:
+            param_wildcard = "*"
+        values = read_param_file(filename, param_wildcard)
+        if values is None:
+            return
+        # some parameters should not be loaded from files
+        values = [ (name, value) for (name, value) in values if name not in self.mav_param.exclude_load ]
+        for (name, value) in values:
+            self.check_range(name.upper(), value)
+        (changes, unchanged, unknown) = mp_paramset.plan(self.mav_param, values, check, self.cache_unconfirmed)
+        if dry_run:
+            mp_paramset.show_diff(changes, unchanged, unknown)
+            return
+        for name in unknown:
+            print("Unknown parameter %s" % name)
+        print("Loaded %u parameters from %s (%u to change)" % (len(values), filename, len(changes)))
+        if master is None:
+            return
+        self.start_set(master, changes, unchanged)
 
     def param_help_download(self):
         '''download XML files for parameters'''
@@ -141,35 +431,34 @@ class ParamState:
     def param_use_xml_filepath(self, filepath):
         self.xml_filepath = filepath
 
-    def param_help_tree(self):
-        '''return a "help tree", a map between a parameter and its metadata.  May return None if help is not available'''
+    def param_help_path(self, verbose=True):
+        '''return the path of the parameter XML file, or None'''
         if self.xml_filepath is not None:
-            print("param: using xml_filepath=%s" % self.xml_filepath)
+            if verbose:
+                print("param: using xml_filepath=%s" % self.xml_filepath)
             path = self.xml_filepath
         else:
             if self.vehicle_name is None:
-                print("Unknown vehicle type")
+                if verbose:
+                    print("Unknown vehicle type")
                 return None
             path = mp_util.dot_mavproxy("%s.xml" % self.vehicle_name)
             if not os.path.exists(path):
-                print("Please run 'param download' first (vehicle_name=%s)" % self.vehicle_name)
+                if verbose:
+                    print("Please run 'param download' first (vehicle_name=%s)" % self.vehicle_name)
                 return None
         if not os.path.exists(path):
-            print("Param XML (%s) does not exist" % path)
+            if verbose:
+                print("Param XML (%s) does not exist" % path)
+            return None
+        return path
+
+    def param_help_index(self, verbose=True):
+        '''return the parameter documentation index. May return None if help is not available'''
+        path = self.param_help_path(verbose)
+        if path is None:
             return None
-        xml = open(path,'rb').read()
-        from lxml import objectify
-        objectify.enable_recursive_str()
-        tree = objectify.fromstring(xml)
-        htree = {}
-        for p in tree.vehicles.parameters.param:
-            n = p.get('name').split(':')[1]
-            htree[n] = p
-        for lib in tree.libraries.parameters:
-            for p in lib.param:
-                n = p.get('name')
-                htree[n] = p
-        return htree
+        return mp_parammeta.load_index(path)
 
     def param_set_xml_filepath(self, args):
         self.xml_filepath = args[0]
@@ -180,16 +469,11 @@ class ParamState:
             print("Usage: param apropos keyword")
             return
 
-        htree = self.param_help_tree()
-        if htree is None:
+        index = self.param_help_index()
+        if index is None:
             return
 
-        contains = {}
-        for keyword in args:
-            for param in htree.keys():
-                if str(htree[param]).find(keyword) != -1:
-                    contains[param] = True
-        for param in contains.keys():
+        for param in index.search(args):
             print("%s" % (param,))
 
     def param_help(self, args):
@@ -198,38 +482,55 @@ class ParamState:
             print("Usage: param help PARAMETER_NAME")
             return
 
-        htree = self.param_help_tree()
-        if htree is None:
+        index = self.param_help_index()
+        if index is None:
             return
 
         for h in args:
             h = h.upper()
-            if h in htree:
-                help = htree[h]
-                print("%s: %s\n" % (h, help.get('humanName')))
-                print(help.get('documentation'))
-                try:
-                    print("\n")
-                    for f in help.field:
-                        print("%s : %s" % (f.get('name'), str(f)))
-                except Exception as e:
-                    pass
-                try:
-                    # The entry "values" has been blatted by a cython
-                    # function at this point, so we instead get the
-                    # "values" by offset rather than name.
-                    children = help.getchildren()
-                    vchild = children[0]
-                    values = vchild.getchildren()
-                    if len(values):
-                        print("\nValues: ")
-                        for v in values:
-                            print("\t%s : %s" % (v.get('code'), str(v)))
-                except Exception as e:
-                    print("Caught exception %s" % repr(e))
-                    pass
-            else:
+            help = index.get(h)
+            if help is None:
                 print("Parameter '%s' not found in documentation" % h)
+                continue
+            print("%s: %s\n" % (h, help.human_name))
+            print(help.documentation)
+            if help.fields:
+                print("\n")
+            for (name, text) in help.fields:
+                print("%s : %s" % (name, text))
+            if help.values:
+                print("\nValues: ")
+                for (code, desc) in help.values:
+                    print("\t%s : %s" % (code, desc))
+
+    def check_range(self, name, value):
+        '''warn if a value is outside the documented range of a parameter'''
+        index = self.param_help_index(verbose=False)
+        if index is None:
+            return
+        try:
+            msg = index.check_range(name, value)
+        except ValueError:
+            return
+        if msg is not None:
+            print("Warning: %s" % msg)
+
+    def cmd_cache(self, args):
+        '''parameter cache commands'''
+        if self.cache is None:
+            print("Parameter cache disabled")
+            return
+        if len(args) == 0 or args[0] not in ["status", "clear"]:
+            print("Usage: param cache <status|clear>")
+            return
+        if self.cache_key is None:
+            print("Vehicle unique ID not known")
+            return
+        if args[0] == "status":
+            print("Cache file %s" % self.cache.filename(self.cache_key))
+        elif args[0] == "clear":
+            self.cache.remove(self.cache_key)
+            print("Removed cached parameters")
 
     def status(self, master, mpstate):
         return(len(self.mav_param_set), self.mav_param_count)
@@ -237,7 +538,7 @@ class ParamState:
     def handle_command(self, master, mpstate, args):
         '''handle parameter commands'''
         param_wildcard = "*"
-        usage="Usage: param <fetch|save|set|show|load|preload|forceload|diff|download|help>"
+        usage="Usage: param <fetch|save|set|show|load|preload|forceload|diff|download|help|cache>"
         if len(args) < 1:
             print(usage)
             return
@@ -245,6 +546,7 @@ class ParamState:
             if len(args) == 1:
                 master.param_fetch_all()
                 self.mav_param_set = set()
+                self.fetcher.reset()
                 print("Requested parameter list")
             else:
                 found = False
@@ -300,46 +602,33 @@ class ParamState:
                 return
             param = args[1]
             value = args[2]
-            if value.startswith('0x'):
-                value = int(value, base=16)
+            try:
+                if value.startswith('0x'):
+                    value = int(value, base=16)
+                else:
+                    value = float(value)
+            except ValueError:
+                print("Invalid value '%s'" % value)
+                return
             if not param.upper() in self.mav_param:
                 print("Unable to find parameter '%s'" % param)
                 return
             uname = param.upper()
-            ptype = None
-            if uname in self.param_types:
-                ptype = self.param_types[uname]
-            self.mav_param.mavset(master, uname, value, retries=3, parm_type=ptype)
-
-            if (param.upper() == "WP_LOITER_RAD" or param.upper() == "LAND_BREAK_PATH"):
-                #need to redraw rally points
-                mpstate.module('rally').set_last_change(time.time())
-                #need to redraw loiter points
-                mpstate.module('wp').wploader.last_change = time.time()
+            self.check_range(uname, value)
+            self.mpstate = mpstate
+            self.start_set(master, [(uname, self.mav_param[uname], value)])
 
         elif args[0] == "load":
-            if len(args) < 2:
-                print("Usage: param load <filename> [wildcard]")
-                return
-            if len(args) > 2:
-                param_wildcard = args[2]
-            else:
-                param_wildcard = "*"
-            self.mav_param.load(args[1].strip('"'), param_wildcard, master)
+            self.mpstate = mpstate
+            self.param_load(master, args[1:])
         elif args[0] == "preload":
             if len(args) < 2:
                 print("Usage: param preload <filename>")
                 return
             self.mav_param.load(args[1].strip('"'))
         elif args[0] == "forceload":
-            if len(args) < 2:
-                print("Usage: param forceload <filename> [wildcard]")
-                return
-            if len(args) > 2:
-                param_wildcard = args[2]
-            else:
-                param_wildcard = "*"
-            self.mav_param.load(args[1].strip('"'), param_wildcard, master, check=False)
+            self.mpstate = mpstate
+            self.param_load(master, args[1:], check=False)
         elif args[0] == "download":
             self.param_help_download()
         elif args[0] == "apropos":
@@ -355,7 +644,11 @@ class ParamState:
                 pattern = "*"
             self.mav_param.show(pattern)
         elif args[0] == "status":
-            print("Have %u/%u params" % (len(self.mav_param_set), self.mav_param_count))
+            print(self.fetcher.status())
+            if self.setter is not None:
+                print(self.setter.status())
+        elif args[0] == "cache":
+            self.cmd_cache(args[1:])
         else:
             print(usage)
 
@@ -370,8 +663,9 @@ class ParamModule(mp_module.MPModule):
         self.add_command('param', self.cmd_param, "parameter handling",
                          ["<download|status>",
                           "<set|show|fetch|help|apropos> (PARAMETER)",
-                          "<load|save|diff> (FILENAME)",
-                          "<set_xml_filepath> (FILEPATH)"
+                          "<load|forceload|save|diff> (FILENAME)",
+                          "<set_xml_filepath> (FILEPATH)",
+                          "cache <status|clear>"
                          ])
         if mp_util.has_wxpython:
             self.menu = MPMenuSubMenu('Parameter',
@@ -405,7 +699,10 @@ class ParamModule(mp_module.MPModule):
         if sysid not in [(0,0),(1,1),(1,0)]:
 
             fname = 'mav_%u_%u.parm' % (sysid[0], sysid[1])
-        self.pstate[sysid] = ParamState(self.mpstate.mav_param_by_sysid[sysid], self.logdir, self.vehicle_name, fname)
+        cache = None
+        if self.settings.param_cache:
+            cache = mp_paramcache.ParamCache()
+        self.pstate[sysid] = ParamState(self.mpstate.mav_param_by_sysid[sysid], self.logdir, self.vehicle_name, fname, cache=cache)
         if self.continue_mode and self.logdir is not None:
             parmfile = os.path.join(self.logdir, fname)
             if os.path.exists(parmfile):
@@ -444,6 +741,7 @@ class ParamModule(mp_module.MPModule):
         sysid = self.get_sysid()
         self.pstate[sysid].vehicle_name = self.vehicle_name
         self.pstate[sysid].fetch_check(self.master)
+        self.pstate[sysid].set_check(self.master)
         if self.module('console') is not None and not self.menu_added_console:
             self.menu_added_console = True
             self.module('console').add_menu(self.menu)
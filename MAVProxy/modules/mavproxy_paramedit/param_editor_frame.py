@@ -13,6 +13,7 @@ import math
 from MAVProxy.modules.lib import multiproc
 from MAVProxy.modules.mavproxy_paramedit import checklisteditor as cle
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_parammeta
 from MAVProxy.modules.mavproxy_paramedit import ph_event
 ParamEditorEvent = ph_event.ParamEditorEvent
 
@@ -337,28 +338,28 @@ class ParamEditorFrame(wx.Frame):
             self.display_list.SetCellBackgroundColour(row, PE_VALUE,
                                                       wx.Colour(152, 251, 152))
         self.set_row_size(row)
+        info = self.htree.get(name, None)
         try:
-            for f in self.htree[name].field:
-                if f.get('name') == "Bitmask":
-                    bits = str(f).split(',')
-                    self.display_list.SetCellEditor(row, PE_OPTION, cle.GridCheckListEditor(bits, PE_VALUE, pvalue))
-                    val = ""
-                    binary = bin(int(pvalue))[2:]
-                    for i in [(len(binary)-ones-1) for ones in range(len(binary)) if binary[ones] == '1']:
-                        val = val + str(bits[i]) + "\n"
-                    self.display_list.SetCellValue(row, PE_OPTION, str(val))
-                    self.set_row_size(row, 25*len(bits))
-                    return
+            bitmask = info.field("Bitmask")
+            if bitmask is not None:
+                bits = bitmask.split(',')
+                self.display_list.SetCellEditor(row, PE_OPTION, cle.GridCheckListEditor(bits, PE_VALUE, pvalue))
+                val = ""
+                binary = bin(int(pvalue))[2:]
+                for i in [(len(binary)-ones-1) for ones in range(len(binary)) if binary[ones] == '1']:
+                    val = val + str(bits[i]) + "\n"
+                self.display_list.SetCellValue(row, PE_OPTION, str(val))
+                self.set_row_size(row, 25*len(bits))
+                return
         except Exception as e:
             pass
         try:
-            if self.htree[name].values is not None:
-                v = self.htree[name].findall('values')[0].getchildren()
-                for i in range(len(v)):
-                    if float(v[i].get('code')) == pvalue:
-                        selected = str(v[i].get('code'))+":"+str(v[i])
+            if info.values:
+                v = [ "%s:%s" % (code, desc) for (code, desc) in info.values ]
+                for i in range(len(info.values)):
+                    if float(info.values[i][0]) == pvalue:
+                        selected = v[i]
                         sel_ind = i
-                    v[i] = str(v[i].get('code'))+":"+str(v[i])
                 self.display_list.SetCellEditor(row, PE_OPTION, cle.GridDropListEditor(v, PE_VALUE, sel_ind))
                 self.display_list.SetCellValue(row, PE_OPTION, str(selected))
                 return
@@ -366,12 +367,10 @@ class ParamEditorFrame(wx.Frame):
             pass
         Range = {}
         try:
-            for f in self.htree[name].field:
-                if f.get('name') == "Increment":
-                    Range['Increment'] = float(f)
-                if f.get('name') == "Range":
-                    Range['Min'] = float(str(f).split(' ')[0])
-                    Range['Max'] = float(str(f).split(' ')[1])
+            if info.field("Increment") is not None:
+                Range['Increment'] = float(info.field("Increment"))
+            if info.range() is not None:
+                (Range['Min'], Range['Max']) = info.range()
         except Exception as e:
             pass
         if len(Range) > 1:
@@ -390,22 +389,14 @@ class ParamEditorFrame(wx.Frame):
         # Provide data derived from XML
         unit = ""
         option = ""
-        try:
-            desc = str(self.htree[name].get('humanName')) + "\n\n" + str(self.htree[name].get('documentation'))
-        except Exception as e:
-            desc = str(e)
-        try:
-            for f in self.htree[name].field:
-                if f.get('name') == "Units":
-                    unit = str(f)
-        except Exception as e:
-            unit = ""
-        try:
-            for f in self.htree[name].field:
-                if f.get('name') == "Range":
-                    option = "Range:"+str(f)
-        except Exception as e:
-            option = ""
+        info = self.htree.get(name, None)
+        if info is None:
+            return(unit, option, repr(name))
+        desc = info.human_name + "\n\n" + info.documentation
+        if info.units() is not None:
+            unit = info.units()
+        if info.field("Range") is not None:
+            option = "Range:" + info.field("Range")
         return(unit, option, desc)
 
     def Read_File(self, event):  # wxGlade: ParamEditor.<event_handler>
@@ -524,11 +515,9 @@ class ParamEditorFrame(wx.Frame):
             if key.lower() in param.lower():
                 temp[param] = value
             else:
-                try:
-                    if key.lower() in (self.htree[param].get('documentation').lower() + self.htree[param].get('humanName').lower()):
-                        temp[param] = value
-                except Exception as e:
-                    continue
+                info = self.htree.get(param, None)
+                if info is not None and key.lower() in (info.documentation.lower() + info.human_name.lower()):
+                    temp[param] = value
         self.redraw_grid(temp)
         self.gui_event_queue_lock.release()
 
@@ -581,20 +570,9 @@ class ParamEditorFrame(wx.Frame):
                 self.param_help_download()
         else:
             return
-        try:
-            xml = open(path, 'rb').read()
-            from lxml import objectify
-            objectify.enable_recursive_str()
-            tree = objectify.fromstring(xml)
-            for p in tree.vehicles.parameters.param:
-                n = p.get('name').split(':')[1]
-                self.htree[n] = p
-            for lib in tree.libraries.parameters:
-                for p in lib.param:
-                    n = p.get('name')
-                    self.htree[n] = p
-        except Exception as e:
-            print (e)
+        index = mp_parammeta.load_index(path)
+        if index is not None:
+            self.htree = index.params
 
 # end of class ParamEditor
 
@@ -7,6 +7,8 @@ from pymavlink import mavutil
 import time, os, platform
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_paramset
+from MAVProxy.modules.lib import mp_pointxfer
 
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import *
@@ -15,9 +17,11 @@ class RallyModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(RallyModule, self).__init__(mpstate, "rally", "rally point control", public = True)
         self.rallyloader_by_sysid = {}
-        self.add_command('rally', self.cmd_rally, "rally point control", ["<add|clear|land|list|move|remove|>",
+        self.add_command('rally', self.cmd_rally, "rally point control", ["<add|clear|land|list|move|remove|status|>",
                                     "<load|save> (FILENAME)"])
         self.have_list = False
+        # runs uploads and downloads
+        self.transfers = mp_pointxfer.TransferRunner(self, "Rally", "RALLY_POINT")
         self.abort_alt = 50
         self.abort_first_send_time = 0
         self.abort_previous_send_time = 0
@@ -98,6 +102,7 @@ class RallyModule(mp_module.MPModule):
                 print("Unable to send abort command!\n")
                 self.abort_ack_received = True
 
+        self.transfers.update()
 
     def cmd_rally_add(self, args):
         '''handle rally add'''
@@ -123,6 +128,8 @@ class RallyModule(mp_module.MPModule):
         if not self.have_list:
             print("Please list rally points first")
             return
+        if self.transfers.busy():
+            return
 
         if (self.rallyloader.rally_count() > 4):
             print("Only 5 rally points possible per flight plan.")
@@ -136,8 +143,7 @@ class RallyModule(mp_module.MPModule):
         land_hdg = 0.0
 
         self.rallyloader.create_and_append_rally_point(latlon[0] * 1e7, latlon[1] * 1e7, alt, break_alt, land_hdg, flag)
-        self.send_rally_points()
-        print("Added Rally point at %s %f %f, autoland: %s" % (str(latlon), alt, break_alt, bool(flag & 2)))
+        self.send_rally_points("Added Rally point at %s %f %f, autoland: %s" % (str(latlon), alt, break_alt, bool(flag & 2)))
 
     def cmd_rally_alt(self, args):
         '''handle rally alt change'''
@@ -147,6 +153,8 @@ class RallyModule(mp_module.MPModule):
         if not self.have_list:
             print("Please list rally points first")
             return
+        if self.transfers.busy():
+            return
 
         idx = int(args[0])
         if idx <= 0 or idx > self.rallyloader.rally_count():
@@ -159,9 +167,7 @@ class RallyModule(mp_module.MPModule):
             new_break_alt = int(args[2])
 
         self.rallyloader.set_alt(idx, new_alt, new_break_alt)
-        self.send_rally_point(idx-1)
-        self.fetch_rally_point(idx-1)
-        self.rallyloader.reindex()
+        self.upload_rally_points([idx-1], "Changed altitude of rally point %u" % idx)
 
     def cmd_rally_move(self, args):
         '''handle rally move'''
@@ -171,6 +177,8 @@ class RallyModule(mp_module.MPModule):
         if not self.have_list:
             print("Please list rally points first")
             return
+        if self.transfers.busy():
+            return
 
         idx = int(args[0])
         if idx <= 0 or idx > self.rallyloader.rally_count():
@@ -186,13 +194,7 @@ class RallyModule(mp_module.MPModule):
 
         oldpos = (rpoint.lat*1e-7, rpoint.lng*1e-7)
         self.rallyloader.move(idx, latlon[0], latlon[1])
-        self.send_rally_point(idx-1)
-        p = self.fetch_rally_point(idx-1)
-        if p.lat != int(latlon[0]*1e7) or p.lng != int(latlon[1]*1e7):
-            print("Rally move failed")
-            return
-        self.rallyloader.reindex()
-        print("Moved rally point from %s to %s at %fm" % (str(oldpos), str(latlon), rpoint.alt))
+        self.upload_rally_points([idx-1], "Moved rally point from %s to %s at %fm" % (str(oldpos), str(latlon), rpoint.alt))
 
 
     def cmd_rally(self, args):
@@ -209,8 +211,10 @@ class RallyModule(mp_module.MPModule):
             self.cmd_rally_move(args[1:])
 
         elif args[0] == "clear":
+            if self.transfers.busy():
+                return
             self.rallyloader.clear()
-            self.mav_param.mavset(self.master,'RALLY_TOTAL',0,3)
+            self.send_rally_points("Cleared rally points")
 
         elif args[0] == "remove":
             if not self.have_list:
@@ -219,17 +223,20 @@ class RallyModule(mp_module.MPModule):
             if (len(args) < 2):
                 print("Usage: rally remove RALLYNUM")
                 return
+            if self.transfers.busy():
+                return
             self.rallyloader.remove(int(args[1]))
             self.send_rally_points()
 
         elif args[0] == "list":
             self.list_rally_points()
-            self.have_list = True
 
         elif args[0] == "load":
             if (len(args) < 2):
                 print("Usage: rally load filename")
                 return
+            if self.transfers.busy():
+                return
 
             try:
                 self.rallyloader.load(args[1].strip('"'))
@@ -237,11 +244,9 @@ class RallyModule(mp_module.MPModule):
                 print("Unable to load %s - %s" % (args[1], msg))
                 return
 
-            self.send_rally_points()
+            self.send_rally_points("Loaded %u rally points from %s" % (self.rallyloader.rally_count(), args[1]))
             self.have_list = True
 
-            print("Loaded %u rally points from %s" % (self.rallyloader.rally_count(), args[1]))
-
         elif args[0] == "save":
             if (len(args) < 2):
                 print("Usage: rally save filename")
@@ -254,6 +259,9 @@ class RallyModule(mp_module.MPModule):
         elif args[0] == "alt":
             self.cmd_rally_alt(args[1:])
 
+        elif args[0] == "status":
+            print(self.transfers.status())
+
         elif args[0] == "land":
             if (len(args) >= 2 and args[1] == "abort"):
                 self.abort_ack_received = False
@@ -275,6 +283,7 @@ class RallyModule(mp_module.MPModule):
     def mavlink_packet(self, m):
         '''handle incoming mavlink packet'''
         type = m.get_type()
+        self.transfers.mavlink_packet(m)
         if type in ['COMMAND_ACK']:
             if m.command == mavutil.mavlink.MAV_CMD_DO_GO_AROUND:
                 if (m.result == 0 and self.abort_ack_received == False):
@@ -304,41 +313,58 @@ class RallyModule(mp_module.MPModule):
         p.target_component = self.target_component
         self.master.mav.send(p)
 
-    def send_rally_points(self):
-        '''send rally points from rallyloader'''
-        self.mav_param.mavset(self.master,'RALLY_TOTAL',self.rallyloader.rally_count(),3)
+    def verify_rally_point(self, i, p2):
+        '''check a rally point fetched back against the one sent'''
+        p = self.rallyloader.rally_point(i)
+        return (int(p.lat) == p2.lat and int(p.lng) == p2.lng and
+                int(p.alt) == p2.alt and int(p.break_alt) == p2.break_alt)
 
-        for i in range(self.rallyloader.rally_count()):
-            self.send_rally_point(i)
+    def upload_rally_points(self, indices, message, setup=[]):
+        '''start sending some rally points, fetching each back to check
+        it. setup is a list of parameters to set first'''
+        self.rallyloader.reindex()
+        stages = []
+        if setup:
+            stages.append(mp_paramset.ParamSetter([ (name, self.mav_param.get(name, None), value) for (name, value) in setup ],
+                                                  verbose=False))
+        stages.append(mp_pointxfer.PointTransfer(indices, self.fetch_rally_point,
+                                                 send=self.send_rally_point, verify=self.verify_rally_point))
+        def done(transfer):
+            print(message)
+        return self.transfers.start(mp_pointxfer.Transfer("Rally upload", stages), done)
+
+    def send_rally_points(self, message=None):
+        '''start sending rally points from rallyloader'''
+        count = self.rallyloader.rally_count()
+        if message is None:
+            message = "Sent %u rally points" % count
+        return self.upload_rally_points(range(count), message, setup=[('RALLY_TOTAL', count)])
 
     def fetch_rally_point(self, i):
-        '''fetch one rally point'''
+        '''request one rally point'''
         self.master.mav.rally_fetch_point_send(self.target_system,
                                                     self.target_component, i)
-        tstart = time.time()
-        p = None
-        while time.time() - tstart < 1:
-            p = self.master.recv_match(type='RALLY_POINT', blocking=False)
-            if p is not None:
-                break
-            time.sleep(0.1)
-            continue
-        if p is None:
-            self.console.error("Failed to fetch rally point %u" % i)
-            return None
-        return p
 
     def list_rally_points(self):
-        self.rallyloader.clear()
+        '''start fetching the rally points'''
+        if self.transfers.busy():
+            return
         rally_count = self.mav_param.get('RALLY_TOTAL',0)
         if rally_count == 0:
+            self.rallyloader.clear()
+            self.have_list = True
             print("No rally points")
             return
-        for i in range(int(rally_count)):
-            p = self.fetch_rally_point(i)
-            if p is None:
-                return
-            self.rallyloader.append_rally_point(p)
+        xfer = mp_pointxfer.PointTransfer(range(int(rally_count)), self.fetch_rally_point)
+        self.transfers.start(mp_pointxfer.Transfer("Rally download", [xfer]),
+                            lambda transfer: self.list_rally_points_done(xfer))
+
+    def list_rally_points_done(self, xfer):
+        '''all rally points have arrived'''
+        self.rallyloader.clear()
+        for i in sorted(xfer.points.keys()):
+            self.rallyloader.append_rally_point(xfer.points[i])
+        self.have_list = True
 
         for i in range(self.rallyloader.rally_count()):
             p = self.rallyloader.rally_point(i)
@@ -353,7 +379,7 @@ class RallyModule(mp_module.MPModule):
             print("Saved rally points to %s" % ral_file_path)
 
     def print_usage(self):
-        print("Usage: rally <list|load|land|save|add|remove|move|clear|alt>")
+        print("Usage: rally <list|load|land|save|add|remove|move|clear|alt|status>")
 
 def init(mpstate):
     '''initialise module'''
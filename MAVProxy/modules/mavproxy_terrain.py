@@ -2,32 +2,234 @@
   MAVProxy terrain handling module
 """
 
+import math
+import threading
 import time
 
+from collections import OrderedDict
+
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
+
+import numpy
+
 from MAVProxy.modules.mavproxy_map import mp_elevation
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import mp_profile
 from MAVProxy.modules.lib import mp_settings
 
+# ArduPilot terrain grid layout. A grid block is 8x7 bits of 4x4
+# points, and blocks overlap by one bit
+TERRAIN_GRID_MAVLINK_SIZE = 4
+TERRAIN_GRID_BLOCK_MUL_X = 7
+TERRAIN_GRID_BLOCK_MUL_Y = 8
+TERRAIN_GRID_BLOCK_SPACING_X = (TERRAIN_GRID_BLOCK_MUL_X-1)*TERRAIN_GRID_MAVLINK_SIZE
+TERRAIN_GRID_BLOCK_SPACING_Y = (TERRAIN_GRID_BLOCK_MUL_Y-1)*TERRAIN_GRID_MAVLINK_SIZE
+TERRAIN_BLOCK_BITS = TERRAIN_GRID_BLOCK_MUL_X * TERRAIN_GRID_BLOCK_MUL_Y
+
+LOCATION_SCALING_FACTOR = 0.011131884502145034
+LOCATION_SCALING_FACTOR_INV = 89.83204953368922
+
+def longitude_scale(lat_e7):
+    '''ArduPilot longitude scale for a latitude in 1e-7 degrees'''
+    return max(math.cos(math.radians(lat_e7 * 1.0e-7)), 0.01)
+
+def c_div(a, b):
+    '''integer division rounding towards zero, as in C'''
+    q = abs(a) // abs(b)
+    if (a < 0) != (b < 0):
+        return -q
+    return q
+
+def grid_block(lat, lon, grid_spacing):
+    '''return the (lat, lon) in 1e-7 degrees of the south west corner of
+    the grid block the autopilot will request for a position, following
+    AP_Terrain::calculate_grid_info'''
+    lat_e7 = int(lat * 1.0e7)
+    lon_e7 = int(lon * 1.0e7)
+    # grids start on integer degrees
+    lat_degrees = c_div(lat_e7 - 9999999 if lat_e7 < 0 else lat_e7, 10000000)
+    lon_degrees = c_div(lon_e7 - 9999999 if lon_e7 < 0 else lon_e7, 10000000)
+    ref_lat = lat_degrees * 10000000
+    ref_lon = lon_degrees * 10000000
+    north = (lat_e7 - ref_lat) * LOCATION_SCALING_FACTOR
+    east = (lon_e7 - ref_lon) * LOCATION_SCALING_FACTOR * longitude_scale((lat_e7 + ref_lat) // 2)
+    grid_idx_x = int(north / grid_spacing) // TERRAIN_GRID_BLOCK_SPACING_X
+    grid_idx_y = int(east / grid_spacing) // TERRAIN_GRID_BLOCK_SPACING_Y
+    ofs_north = grid_idx_x * TERRAIN_GRID_BLOCK_SPACING_X * float(grid_spacing)
+    ofs_east = grid_idx_y * TERRAIN_GRID_BLOCK_SPACING_Y * float(grid_spacing)
+    dlat = int(ofs_north * LOCATION_SCALING_FACTOR_INV)
+    dlon = int((ofs_east * LOCATION_SCALING_FACTOR_INV) / longitude_scale(ref_lat + dlat // 2))
+    return (ref_lat + dlat, ref_lon + dlon)
+
+class TerrainBlockCache(object):
+    '''LRU cache of fully computed terrain grid blocks, keyed by
+    (lat, lon, grid_spacing) with lat/lon in 1e-7 degrees. Each block
+    is a list of the 16 heights for each of the 56 bits, or None for
+    bits with no terrain data'''
+    def __init__(self, elevation_model, max_blocks=64):
+        self.elevation_model = elevation_model
+        self.max_blocks = max_blocks
+        self.blocks = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.computed = 0
+        self.speculative = 0
+        self.speculative_used = 0
+        self.compute_time = mp_profile.TimingStats()
+        self.pending = set()
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.worker, name='terrain_blocks')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def compute(self, key):
+        '''compute the heights of all bits of a grid block'''
+        t0 = mp_profile.clock()
+        (lat_e7, lon_e7, grid_spacing) = key
+        lat = lat_e7 * 1.0e-7
+        lon = lon_e7 * 1.0e-7
+        bit_spacing = grid_spacing * 4
+        lats = []
+        lons = []
+        for bit in range(TERRAIN_BLOCK_BITS):
+            (lat1, lon1) = mp_util.gps_offset(lat, lon,
+                                              east=bit_spacing * (bit % 8),
+                                              north=bit_spacing * (bit // 8))
+            for i in range(4*4):
+                y = i % 4
+                x = i // 4
+                (lat2,lon2) = mp_util.gps_offset(lat1, lon1,
+                                                 east=grid_spacing * y,
+                                                 north=grid_spacing * x)
+                lats.append(lat2)
+                lons.append(lon2)
+        alts = self.elevation_model.GetElevationArray(lats, lons)
+        block = []
+        for bit in range(TERRAIN_BLOCK_BITS):
+            data = alts[bit*16:(bit+1)*16]
+            if numpy.isnan(data).any():
+                block.append(None)
+            else:
+                block.append([int(alt) for alt in data])
+        self.compute_time.add(mp_profile.clock() - t0)
+        self.computed += 1
+        return block
+
+    def store(self, key, block, speculative=False):
+        '''add a block to the cache. Blocks with missing data are not
+        kept so they are recomputed once the SRTM tile arrives'''
+        if None in block:
+            return
+        with self.lock:
+            self.blocks.pop(key, None)
+            self.blocks[key] = (block, speculative)
+            while len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+
+    def find(self, key, tolerance):
+        '''return the key of a cached block matching key. Speculative
+        blocks are computed from our own copy of the autopilot grid
+        calculation, so allow for rounding differences of up to
+        tolerance in 1e-7 degrees. Must be called with the lock held'''
+        if key in self.blocks:
+            return key
+        if tolerance > 0:
+            for k in self.blocks.keys():
+                if (k[2] == key[2] and
+                    abs(k[0] - key[0]) <= tolerance and
+                    abs(k[1] - key[1]) <= tolerance):
+                    return k
+        return None
+
+    def lookup(self, key, tolerance):
+        '''return a cached block or None'''
+        with self.lock:
+            found = self.find(key, tolerance)
+            if found is None:
+                return None
+            (block, speculative) = self.blocks.pop(found)
+            self.blocks[found] = (block, False)
+            if speculative:
+                self.speculative_used += 1
+            return block
+
+    def get(self, key, tolerance=0):
+        '''get a block, computing it if needed'''
+        block = self.lookup(key, tolerance)
+        if block is not None:
+            self.hits += 1
+            return block
+        self.misses += 1
+        block = self.compute(key)
+        self.store(key, block)
+        return block
+
+    def precompute(self, key, tolerance=0):
+        '''queue a block for computation on the worker thread'''
+        with self.lock:
+            if key in self.pending or self.find(key, tolerance) is not None:
+                return
+            self.pending.add(key)
+        self.queue.put(key)
+
+    def worker(self):
+        '''compute speculative blocks'''
+        while True:
+            key = self.queue.get()
+            if key is None:
+                break
+            try:
+                block = self.compute(key)
+                self.store(key, block, speculative=True)
+                self.speculative += 1
+            except Exception as ex:
+                print("terrain precompute failed: %s" % ex)
+            with self.lock:
+                self.pending.discard(key)
+
+    def stop(self):
+        self.queue.put(None)
+
 class TerrainModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(TerrainModule, self).__init__(mpstate, "terrain", "terrain handling", public=False)
 
         self.ElevationModel = mp_elevation.ElevationModel()
         self.current_request = None
+        self.current_block = None
+        self.request_time = None
         self.sent_mask = 0
         self.last_send_time = time.time()
+        self.last_precompute = 0
+        self.last_grid_spacing = None
         self.requests_received = 0
         self.blocks_sent = 0
         self.check_lat = 0
         self.check_lon = 0
+        self.request_latency = mp_profile.TimingStats()
         self.add_command('terrain', self.cmd_terrain, "terrain control",
                          ["<status|check>",
                           'set (TERRAINSETTING)'])
         self.terrain_settings = mp_settings.MPSettings(
-            [ ('debug', int, 0) ]
+            [ ('debug', int, 0),
+              ('burst', int, 8),
+              ('send_rate', float, 5.0),
+              ('cache_blocks', int, 64),
+              ('lookahead', float, 30.0),
+              ('match_tolerance', int, 100) ]
             )
         self.add_completion_function('(TERRAINSETTING)', self.terrain_settings.completion)
+        self.block_cache = TerrainBlockCache(self.ElevationModel, self.terrain_settings.cache_blocks)
+        self.subscribe(['TERRAIN_REQUEST', 'TERRAIN_REPORT', 'GLOBAL_POSITION_INT'])
+
+    def unload(self):
+        self.block_cache.stop()
+        super(TerrainModule, self).unload()
 
     def cmd_terrain(self, args):
         '''terrain command parser'''
@@ -36,11 +238,21 @@ class TerrainModule(mp_module.MPModule):
             print(usage)
             return
         if args[0] == "status":
+            cache = self.block_cache
             print("blocks_sent: %u requests_received: %u" % (
                 self.blocks_sent,
                 self.requests_received))
+            print("grid blocks: cached %u hits %u misses %u precomputed %u (used %u)" % (
+                len(cache.blocks), cache.hits, cache.misses,
+                cache.speculative, cache.speculative_used))
+            print("block compute p50 %.1fms request latency p50 %.1fms p99 %.1fms max %.1fms" % (
+                cache.compute_time.percentile(50)*1000,
+                self.request_latency.percentile(50)*1000,
+                self.request_latency.percentile(99)*1000,
+                self.request_latency.max*1000))
         elif args[0] == "set":
             self.terrain_settings.command(args[1:])
+            self.block_cache.max_blocks = max(1, self.terrain_settings.cache_blocks)
         elif args[0] == "check":
             self.cmd_terrain_check(args[1:])
         else:
@@ -66,6 +278,9 @@ class TerrainModule(mp_module.MPModule):
         # add some status fields
         if type == 'TERRAIN_REQUEST':
             self.current_request = msg
+            self.current_block = None
+            self.request_time = time.time()
+            self.last_grid_spacing = msg.grid_spacing
             self.sent_mask = 0
             self.requests_received += 1
         elif type == 'TERRAIN_REPORT':
@@ -75,28 +290,40 @@ class TerrainModule(mp_module.MPModule):
                 print(msg)
                 self.check_lat = 0
                 self.check_lon = 0
+        elif type == 'GLOBAL_POSITION_INT':
+            self.precompute_ahead(msg)
+
+    def precompute_ahead(self, msg):
+        '''queue the grid blocks along the velocity vector for
+        computation before the autopilot asks for them'''
+        now = time.time()
+        if self.last_grid_spacing is None or now - self.last_precompute < 1.0:
+            return
+        self.last_precompute = now
+        lat = msg.lat * 1.0e-7
+        lon = msg.lon * 1.0e-7
+        vn = msg.vx * 0.01
+        ve = msg.vy * 0.01
+        spacing = self.last_grid_spacing
+        block_size = TERRAIN_GRID_BLOCK_SPACING_X * spacing
+        distance = math.sqrt(vn**2 + ve**2) * self.terrain_settings.lookahead
+        steps = min(int(distance / block_size) + 1, 10)
+        for i in range(steps+1):
+            frac = i / float(steps)
+            (lat2, lon2) = mp_util.gps_offset(lat, lon,
+                                              east=ve * self.terrain_settings.lookahead * frac,
+                                              north=vn * self.terrain_settings.lookahead * frac)
+            (block_lat, block_lon) = grid_block(lat2, lon2, spacing)
+            self.block_cache.precompute((block_lat, block_lon, spacing),
+                                        self.terrain_settings.match_tolerance)
 
     def send_terrain_data_bit(self, bit):
         '''send some terrain data'''
-        lat = self.current_request.lat * 1.0e-7
-        lon = self.current_request.lon * 1.0e-7
-        bit_spacing = self.current_request.grid_spacing * 4
-        (lat, lon) = mp_util.gps_offset(lat, lon,
-                                        east=bit_spacing * (bit % 8),
-                                        north=bit_spacing * (bit // 8))
-        data = []
-        for i in range(4*4):
-            y = i % 4
-            x = i // 4
-            (lat2,lon2) = mp_util.gps_offset(lat, lon,
-                                             east=self.current_request.grid_spacing * y,
-                                             north=self.current_request.grid_spacing * x)
-            alt = self.ElevationModel.GetElevation(lat2, lon2)
-            if alt is None:
-                if self.terrain_settings.debug:
-                    print("no alt ", lat2, lon2)
-                return
-            data.append(int(alt))
+        data = self.current_block[bit]
+        if data is None:
+            if self.terrain_settings.debug:
+                print("no alt for bit %u" % bit)
+            return False
         self.master.mav.terrain_data_send(self.current_request.lat,
                                           self.current_request.lon,
                                           self.current_request.grid_spacing,
@@ -115,24 +342,40 @@ class TerrainModule(mp_module.MPModule):
                                              north=28*self.current_request.grid_spacing)
             print("--lat=%f --lon=%f %.1f" % (
                 lat2, lon2, self.ElevationModel.GetElevation(lat2, lon2)))
-
+        return True
 
     def send_terrain_data(self):
-        '''send some terrain data'''
-        for bit in range(56):
-            if self.current_request.mask & (1<<bit) and self.sent_mask & (1<<bit) == 0:
-                self.send_terrain_data_bit(bit)
-                return
+        '''send a burst of terrain data'''
+        req = self.current_request
+        if self.current_block is None:
+            key = (req.lat, req.lon, req.grid_spacing)
+            self.current_block = self.block_cache.get(key, self.terrain_settings.match_tolerance)
+        sent = 0
+        missing = False
+        for bit in range(TERRAIN_BLOCK_BITS):
+            if req.mask & (1<<bit) and self.sent_mask & (1<<bit) == 0:
+                if sent >= self.terrain_settings.burst:
+                    return
+                if self.send_terrain_data_bit(bit):
+                    sent += 1
+                else:
+                    missing = True
+        if missing:
+            # retry the missing bits once the SRTM tile is available
+            self.current_block = None
+            self.last_send_time = time.time()
+            return
         # no bits to send
+        self.request_latency.add(time.time() - self.request_time)
         self.current_request = None
+        self.current_block = None
         self.sent_mask = 0
 
     def idle_task(self):
         '''called when idle'''
         if self.current_request is None:
             return
-        if time.time() - self.last_send_time < 0.2:
-            # limit to 5 per second
+        if time.time() - self.last_send_time < 1.0 / max(self.terrain_settings.send_rate, 0.1):
             return
         self.send_terrain_data()
 
@@ -153,6 +153,7 @@ class TrackerModule(mp_module.MPModule):
 
         self.pstate.handle_mavlink_packet(self.connection, m)
         self.pstate.fetch_check(self.connection)
+        self.pstate.set_check(self.connection)
 
         if self.module('map') is None:
             return
@@ -29,6 +29,11 @@ from lxml import objectify
 import pkg_resources
 from builtins import input
 
+try:
+    from MAVProxy.modules.lib import mp_logcache
+except ImportError:
+    mp_logcache = None
+
 grui = []
 last_xlim = None
 flightmodes = None
@@ -61,6 +66,7 @@ class MEState(object):
               MPSetting('legend', str, 'upper left', 'legend position'),
               MPSetting('legend2', str, 'upper right', 'legend2 position'),
               MPSetting('title', str, None, 'Graph title'),
+              MPSetting('log_cache', bool, True, 'cache decoded logs', tab='Log'),
               ]
             )
 
@@ -690,16 +696,41 @@ def cmd_loadfile(args):
         fileargs = fileargs.replace("\\", "/")
     loadfile(fileargs.strip('"'))
 
+def load_columns(filename):
+    '''load a log through the column cache, decoding it and saving
+    the cache if needed. Returns a LogReplay or None'''
+    columns = mp_logcache.load_cache(filename)
+    if columns is not None:
+        mestate.console.write("using cache %s" % mp_logcache.cache_filename(filename))
+    else:
+        mlog = mavutil.mavlink_connection(filename, notimestamps=False,
+                                          zero_time_base=False,
+                                          progress_callback=progress_bar)
+        mestate.console.write("\nDecoding ")
+        columns = mp_logcache.build_columns(mlog, progress=progress_bar)
+        mp_logcache.save_cache(filename, columns)
+    return mp_logcache.LogReplay(columns, filename)
+
 def loadfile(args):
     '''load a log file (path given by arg)'''
     mestate.console.write("Loading %s...\n" % args)
     t0 = time.time()
-    mlog = mavutil.mavlink_connection(args, notimestamps=False,
-                                      zero_time_base=False,
-                                      progress_callback=progress_bar)
+    mlog = None
+    if mestate.settings.log_cache and mp_logcache is not None:
+        try:
+            mlog = load_columns(args)
+        except Exception as ex:
+            mestate.console.write("\nlog cache failed: %s\n" % ex)
+    if mlog is not None:
+        msgs = mlog.last_messages()
+    else:
+        mlog = mavutil.mavlink_connection(args, notimestamps=False,
+                                          zero_time_base=False,
+                                          progress_callback=progress_bar)
+        msgs = mlog.messages
     mestate.filename = args
     mestate.mlog = mlog
-    mestate.status.msgs = mlog.messages
+    mestate.status.msgs = msgs
     t1 = time.time()
     mestate.console.write("\ndone (%u messages in %.1fs)\n" % (mestate.mlog._count, t1-t0))
 
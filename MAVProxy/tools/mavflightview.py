@@ -13,18 +13,14 @@ from pymavlink import mavutil, mavwp, mavextra
 from MAVProxy.modules.mavproxy_map import mp_slipmap, mp_tile
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import multiproc
-import functools
+from MAVProxy.modules.lib import mp_parallel
+from MAVProxy.modules.lib import mp_tlogindex
 
 import cv2
 
 def create_map(title):
     '''create map object'''
 
-def pixel_coords(latlon, ground_width=0, mt=None, topleft=None, width=None):
-    '''return pixel coordinates in the map image for a (lat,lon)'''
-    (lat,lon) = (latlon[0], latlon[1])
-    return mt.coord_to_pixel(topleft[0], topleft[1], width, ground_width, lat, lon)
-
 def create_imagefile(options, filename, latlon, ground_width, path_objs, mission_obj, fence_obj, width=600, height=600, used_flightmodes=[], mav_type=None):
     '''create path and mission as an image file'''
     mt = mp_tile.MPTile(service=options.service)
@@ -37,7 +33,7 @@ def create_imagefile(options, filename, latlon, ground_width, path_objs, mission
     map_img = mt.area_to_image(latlon[0], latlon[1],
                                width, height, ground_width)
     # a function to convert from (lat,lon) to (px,py) on the map
-    pixmapper = functools.partial(pixel_coords, ground_width=ground_width, mt=mt, topleft=latlon, width=width)
+    pixmapper = mt.area_projection(latlon[0], latlon[1], width, ground_width)
     for path_obj in path_objs:
         path_obj.draw(map_img, pixmapper, None)
     if mission_obj is not None:
@@ -225,23 +221,9 @@ def colour_for_flightmode(mav_type, fmode, instance=0):
     colour = (r,g,b)
     return colour
 
-def mavflightview_mav(mlog, options=None, flightmode_selections=[]):
-    '''create a map for a log file'''
-    wp = mavwp.MAVWPLoader()
-    if options.mission is not None:
-        wp.load(options.mission)
-    fen = mavwp.MAVFenceLoader()
-    if options.fence is not None:
-        fen.load(options.fence)
-    all_false = True
-    for s in flightmode_selections:
-        if s:
-            all_false = False
-    idx = 0
-    path = [[]]
-    instances = {}
-    ekf_counter = 0
-    nkf_counter = 0
+def mavflightview_types(options):
+    '''return (types, recv_match_types): the position message types to
+    plot, and all the message types that need to be read'''
     types = ['MISSION_ITEM','CMD']
     if options.types is not None:
         types.extend(options.types.split(','))
@@ -265,6 +247,37 @@ def mavflightview_mav(mlog, options=None, flightmode_selections=[]):
         re_caps = re.compile('[A-Z_][A-Z0-9_]+')
         caps = set(re.findall(re_caps, colour_source))
         recv_match_types.extend(caps)
+    if options.condition is not None:
+        # the condition needs its message types to be current
+        re_caps = re.compile('[A-Z_][A-Z0-9_]+')
+        recv_match_types.extend(set(re.findall(re_caps, options.condition)))
+    return (types, recv_match_types)
+
+def open_log(filename, options, **kwargs):
+    '''open a log, reading only the message types the map needs
+    through the tlog index if the log has one'''
+    mlog = mavutil.mavlink_connection(filename, **kwargs)
+    (types, recv_match_types) = mavflightview_types(options)
+    return mp_tlogindex.indexed_reader(mlog, filename, recv_match_types)
+
+def mavflightview_mav(mlog, options=None, flightmode_selections=[]):
+    '''create a map for a log file'''
+    wp = mavwp.MAVWPLoader()
+    if options.mission is not None:
+        wp.load(options.mission)
+    fen = mavwp.MAVFenceLoader()
+    if options.fence is not None:
+        fen.load(options.fence)
+    all_false = True
+    for s in flightmode_selections:
+        if s:
+            all_false = False
+    idx = 0
+    path = [[]]
+    instances = {}
+    ekf_counter = 0
+    nkf_counter = 0
+    (types, recv_match_types) = mavflightview_types(options)
 
     print("Looking for types %s" % str(types))
 
@@ -467,13 +480,36 @@ def mavflightview_show(path, wp, fen, used_flightmodes, mav_type, options, title
 
 def mavflightview(filename, options):
     print("Loading %s ..." % filename)
-    mlog = mavutil.mavlink_connection(filename)
+    mlog = open_log(filename, options)
     stuff = mavflightview_mav(mlog, options)
     if stuff is None:
         return
     [path, wp, fen, used_flightmodes, mav_type] = stuff
     mavflightview_show(path, wp, fen, used_flightmodes, mav_type, options, title=filename)
 
+def mavflightview_load(index, args):
+    '''load the map data for one log, run in a worker process'''
+    (filename, options) = args
+    mlog = open_log(filename, options,
+                    progress_callback=lambda pct: mp_parallel.report_progress(index, pct))
+    return mavflightview_mav(mlog, options)
+
+def mavflightview_files(filenames, options):
+    '''load several logs in parallel, then show each of them'''
+    def progress_bar(pct):
+        sys.stdout.write("\rLoading %u logs %3u%%" % (len(filenames), pct))
+        sys.stdout.flush()
+    results = mp_parallel.map_logs(mavflightview_load,
+                                   [ (f, options) for f in filenames ],
+                                   workers=getattr(options, 'workers', 0),
+                                   progress=progress_bar)
+    print("")
+    for (filename, stuff) in zip(filenames, results):
+        if stuff is None:
+            continue
+        [path, wp, fen, used_flightmodes, mav_type] = stuff
+        mavflightview_show(path, wp, fen, used_flightmodes, mav_type, options, title=filename)
+
 class mavflightview_options(object):
     def __init__(self):
         self.service = "MicrosoftHyb"
@@ -496,6 +532,7 @@ class mavflightview_options(object):
         self.rate = 0
         self._flightmodes = []
         self.colour_source = 'flightmode'
+        self.workers = 0
 
 if __name__ == "__main__":
     multiproc.freeze_support()
@@ -522,6 +559,7 @@ if __name__ == "__main__":
     parser.add_option("--nkf-sample", type='int', default=1, help="sub-sampling of NKF messages")
     parser.add_option("--rate", type='int', default=0, help="maximum message rate to display (0 means all points)")
     parser.add_option("--colour-source", type="str", default="flightmode", help="expression with range 0f..255f used for point colour")
+    parser.add_option("--workers", type='int', default=0, help="number of processes for loading multiple logs (0 for one per CPU)")
     parser.add_option("--no-flightmode-legend", action="store_false", default=True, dest="show_flightmode_legend", help="hide legend for colour used for flight modes")
 
     (opts, args) = parser.parse_args()
@@ -533,5 +571,7 @@ if __name__ == "__main__":
     if opts.multi:
         multi_map = None
 
-    for f in args:
-        mavflightview(f, opts)
+    if len(args) > 1:
+        mavflightview_files(args, opts)
+    else:
+        mavflightview(args[0], opts)
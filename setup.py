@@ -91,7 +91,8 @@ on how to use MAVProxy.''',
                'MAVProxy/tools/mavflightview.py',
                'MAVProxy/tools/MAVExplorer.py',
                'MAVProxy/modules/mavproxy_map/mp_slipmap.py',
-               'MAVProxy/modules/mavproxy_map/mp_tile.py'],
+               'MAVProxy/modules/mavproxy_map/mp_tile.py',
+               'MAVProxy/modules/mavproxy_map/mp_tileseed.py'],
       package_data={'MAVProxy':
                     package_data}
     )